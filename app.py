@@ -1,27 +1,154 @@
-import os, io, requests, pandas as pd
+import os, io, sys, argparse, signal, subprocess, requests, shutil, zipfile
 from datetime import timedelta
-from slack_sdk import WebClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
-from openpyxl import load_workbook
-from openpyxl.workbook import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-import msal
 import re
 import time
+import json
+import sqlite3
+import threading
+import contextlib
+import functools
+import hashlib
+from urllib.parse import quote
+import random
+from collections import Counter
+from requests.adapters import HTTPAdapter
+# pandas/numpy, openpyxl, slack_sdk y msal se importan dentro de las funciones que los usan:
+# la mayoría de los runs escriben pocas filas y el arranque del contenedor domina el tiempo total
 
-slack_bot_token=os.environ["SLACK_BOT_TOKEN"]
-channel_id=os.environ["SLACK_CHANNEL_ID"]
-client_id=os.environ["AZURE_CLIENT_ID"]
-refresh_token=os.environ.get("GRAPH_REFRESH_TOKEN","")
-onedrive_upn=os.environ["ONEDRIVE_UPN"]
-onedrive_file_path=os.environ.get("ONEDRIVE_FILE_PATH","/Documents/BlackBox.xlsx")
-# target_hour_local eliminado - ya no se usa restricción de hora
-dev_team_member_ids=[i.strip() for i in os.environ.get("DEV_TEAM_MEMBER_IDS","").split(",") if i.strip()]
-debug_mode=os.environ.get("DEBUG_MODE","0")=="1"
-refresh_token_path=os.environ.get("REFRESH_TOKEN_PATH","/data/graph_refresh_token")
-device_flow_wait_seconds=int(os.environ.get("DEVICE_FLOW_WAIT_SECONDS","600"))  # 10 min
-graph_scope=os.environ.get("GRAPH_SCOPE","offline_access Files.ReadWrite").strip() or "offline_access Files.ReadWrite"
+RETRY_STATUSES={429,503,504}
+
+_config_loaded=False
+
+def load_config():
+    """
+    Lee la configuración desde variables de entorno. Se llama al ejecutar (main, daemon, backfill),
+    no al importar: "import app" funciona sin secretos. Idempotente.
+    """
+    global slack_bot_token, channel_ids, channel_id, client_id, refresh_token, onedrive_upn
+    global onedrive_file_path, dev_team_member_ids, dev_team_member_set, debug_mode
+    global refresh_token_path, device_flow_wait_seconds, graph_scope, sync_state_path
+    global sync_overlap_seconds, sync_backfill_days, dedup_index_path, token_cache_path
+    global token_refresh_margin_seconds, token_min_run_seconds, graph_base_url, login_base_url, http_timeout_seconds
+    global http_max_retries, http_backoff_seconds, http_backoff_max_seconds, workbook_cache_path
+    global upload_session_threshold_bytes, upload_chunk_bytes, upload_resume_attempts
+    global upload_conflict_attempts, upload_conflict_backoff_seconds, write_backend
+    global slack_rate_per_minute, slack_fetch_workers, slack_max_429_retries, fetch_replies
+    global slack_replies_concurrency, replies_cache_path, pipelined, daemon_interval_seconds
+    global daemon_cron, backfill_slice_days, backfill_checkpoint_path, rows_vectorize_threshold
+    global metrics_jsonl_path, metrics_prom_path, archive_rotation, archive_grace_days, archive_file_path
+    global edit_tracking_days, edit_tracking_interval_seconds, kpi_summary, origin_usergroup_ids, origin_cache_path
+    global origin_cache_ttl_seconds, origin_bot_label, workbook_streaming, streaming_threshold_bytes
+    global spool_max_bytes, local_backup_path, slack_users_rate_per_minute
+    global _config_loaded
+    if _config_loaded:
+        return
+    slack_bot_token=os.environ["SLACK_BOT_TOKEN"]
+    # SLACK_CHANNEL_ID acepta una lista separada por comas; channel_id es el primero (compatibilidad)
+    channel_ids=[c.strip() for c in os.environ["SLACK_CHANNEL_ID"].split(",") if c.strip()]
+    channel_id=channel_ids[0]
+    client_id=os.environ["AZURE_CLIENT_ID"]
+    refresh_token=os.environ.get("GRAPH_REFRESH_TOKEN","")
+    onedrive_upn=os.environ["ONEDRIVE_UPN"]
+    onedrive_file_path=os.environ.get("ONEDRIVE_FILE_PATH","/Documents/BlackBox.xlsx")
+    # target_hour_local eliminado - ya no se usa restricción de hora
+    dev_team_member_ids=[i.strip() for i in os.environ.get("DEV_TEAM_MEMBER_IDS","").split(",") if i.strip()]
+    dev_team_member_set=set(dev_team_member_ids)
+    # Origen "Producto" también por user groups de Slack (usergroups.users.list, scope usergroups:read),
+    # cacheados en disco y re-consultados como mucho una vez cada ORIGIN_CACHE_TTL_SECONDS
+    origin_usergroup_ids=[g.strip() for g in os.environ.get("ORIGIN_USERGROUP_IDS","").split(",") if g.strip()]
+    origin_cache_ttl_seconds=float(os.environ.get("ORIGIN_CACHE_TTL_SECONDS","3600"))
+    # Si se define, los usuarios bot (users.info, scope users:read) quedan con este origen
+    origin_bot_label=os.environ.get("ORIGIN_BOT_LABEL","").strip()
+    debug_mode=os.environ.get("DEBUG_MODE","0")=="1"
+    refresh_token_path=os.environ.get("REFRESH_TOKEN_PATH","/data/graph_refresh_token")
+    device_flow_wait_seconds=int(os.environ.get("DEVICE_FLOW_WAIT_SECONDS","600"))  # 10 min
+    graph_scope=os.environ.get("GRAPH_SCOPE","offline_access Files.ReadWrite").strip() or "offline_access Files.ReadWrite"
+    # Estado de sincronización (high-water mark por canal), junto al refresh token
+    sync_state_path=os.environ.get("SYNC_STATE_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","sync_state.json")
+    sync_overlap_seconds=int(os.environ.get("SYNC_OVERLAP_SECONDS","300"))  # 5 min de solape de seguridad
+    sync_backfill_days=int(os.environ.get("SYNC_BACKFILL_DAYS","3"))  # primer run: desde 00:00 del día (hoy - N)
+    # Índice local de duplicados (SQLite), reconstruible desde la columna oculta de claves del workbook
+    dedup_index_path=os.environ.get("DEDUP_INDEX_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","dedup_index.sqlite")
+    # Cache de tokens MSAL (access + refresh), reutiliza access tokens vigentes entre runs
+    token_cache_path=os.environ.get("TOKEN_CACHE_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","msal_token_cache.json")
+    token_refresh_margin_seconds=int(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS","900"))  # refresco en segundo plano si vence antes
+    # Vida mínima para usar un token del cache en todo el run (descargas/subidas largas); bajo esto se refresca antes de empezar
+    token_min_run_seconds=int(os.environ.get("TOKEN_MIN_RUN_SECONDS","600"))
+    # Cliente HTTP compartido para Graph/login (keep-alive, timeouts y reintentos)
+    graph_base_url=os.environ.get("GRAPH_BASE_URL","https://graph.microsoft.com/v1.0").rstrip("/")
+    login_base_url=os.environ.get("AZURE_LOGIN_URL","https://login.microsoftonline.com").rstrip("/")
+    http_timeout_seconds=float(os.environ.get("HTTP_TIMEOUT_SECONDS","60"))
+    http_max_retries=int(os.environ.get("HTTP_MAX_RETRIES","4"))
+    http_backoff_seconds=float(os.environ.get("HTTP_BACKOFF_SECONDS","1"))
+    http_backoff_max_seconds=float(os.environ.get("HTTP_BACKOFF_MAX_SECONDS","60"))
+    # Cache local del último workbook subido/descargado, indexado por cTag/eTag del item
+    workbook_cache_path=os.environ.get("WORKBOOK_CACHE_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","workbook_cache.xlsx")
+    # Upload por sesión (createUploadSession) para workbooks grandes, en chunks reanudables
+    upload_session_threshold_bytes=int(os.environ.get("UPLOAD_SESSION_THRESHOLD_BYTES",str(4*1024*1024)))
+    upload_chunk_bytes=max(1,int(os.environ.get("UPLOAD_CHUNK_BYTES",str(10*327680)))//327680)*327680  # múltiplo de 320 KiB (requisito Graph)
+    upload_resume_attempts=int(os.environ.get("UPLOAD_RESUME_ATTEMPTS","5"))
+    # Concurrencia optimista: PUT condicionado con If-Match; ante conflicto se re-descarga y se re-aplican las filas
+    upload_conflict_attempts=int(os.environ.get("UPLOAD_CONFLICT_ATTEMPTS","4"))
+    upload_conflict_backoff_seconds=float(os.environ.get("UPLOAD_CONFLICT_BACKOFF_SECONDS","5"))
+    # Copia local del workbook cuando la subida falla por error (no por conflicto): un solo archivo, sobrescrito
+    # en cada falla. Opcional: el índice se revierte y el high-water mark no avanza, así que el run siguiente
+    # re-aplica las filas igual
+    local_backup_path=os.environ.get("LOCAL_BACKUP_PATH","").strip()
+    # Ediciones/borrados en Slack: se re-leen los últimos N días y se actualiza la celda SLACK in situ (0 = desactivado).
+    # Cada re-lectura pagina N días de conversations.history por canal (Tier 3) y arma filas para todos esos mensajes,
+    # así que se hace como mucho una vez cada EDIT_TRACKING_INTERVAL_SECONDS; los runs intermedios (p.ej. ciclos del
+    # daemon) solo leen la ventana incremental
+    edit_tracking_days=float(os.environ.get("EDIT_TRACKING_DAYS","7"))
+    edit_tracking_interval_seconds=int(os.environ.get("EDIT_TRACKING_INTERVAL_SECONDS","3600"))
+    # Hoja "Resumen KPI": conteos por día/semana y origen, y por ESTADO FINAL, desde agregados persistidos
+    kpi_summary=os.environ.get("KPI_SUMMARY","1")=="1"
+    # Rotación (WRITE_BACKEND=file): hojas de meses cerrados pasan a un workbook de archivo por año; el activo queda chico
+    archive_rotation=os.environ.get("ARCHIVE_ROTATION","1")=="1"
+    archive_grace_days=int(os.environ.get("ARCHIVE_GRACE_DAYS","3"))  # días del mes siguiente antes de archivar
+    archive_file_path=os.environ.get("ARCHIVE_FILE_PATH","").strip() or os.path.splitext(onedrive_file_path)[0]+"_{year}"+os.path.splitext(onedrive_file_path)[1]
+    # Modo streaming (WRITE_BACKEND=file): solo se parsean las hojas tocadas; el resto del xlsx se copia sin parsear.
+    # "auto" lo usa desde STREAMING_THRESHOLD_BYTES, "1" siempre, "0" nunca
+    workbook_streaming=os.environ.get("WORKBOOK_STREAMING","auto").strip().lower() or "auto"
+    streaming_threshold_bytes=int(os.environ.get("STREAMING_THRESHOLD_BYTES",str(8*1024*1024)))
+    spool_max_bytes=int(os.environ.get("SPOOL_MAX_BYTES",str(4*1024*1024)))  # temporales en memoria hasta este tamaño
+    # Backend de escritura: "file" (descarga/sube el xlsx completo) o "workbook_api" (append server-side vía Graph Excel API)
+    write_backend=os.environ.get("WRITE_BACKEND","file").strip().lower() or "file"
+    # Slack: fetch concurrente por canal bajo un limitador compartido (conversations.history es Tier 3, ~50/min)
+    slack_rate_per_minute=float(os.environ.get("SLACK_RATE_PER_MINUTE","50"))
+    # users.info (ORIGIN_BOT_LABEL) es Tier 4 (~100/min) con su propio límite en Slack: limitador aparte, no frena el fetch
+    slack_users_rate_per_minute=float(os.environ.get("SLACK_USERS_RATE_PER_MINUTE","100"))
+    slack_fetch_workers=int(os.environ.get("SLACK_FETCH_WORKERS","4"))
+    slack_max_429_retries=int(os.environ.get("SLACK_MAX_429_RETRIES","5"))
+    # Respuestas en hilos: conversations.replies solo para hilos nuevos o con cambios (cache por thread_ts/latest_reply)
+    fetch_replies=os.environ.get("SLACK_FETCH_REPLIES","0")=="1"
+    slack_replies_concurrency=int(os.environ.get("SLACK_REPLIES_CONCURRENCY","4"))
+    replies_cache_path=os.environ.get("REPLIES_CACHE_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","replies_cache.json")
+    origin_cache_path=os.environ.get("ORIGIN_CACHE_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","origin_cache.json")
+    # Modo pipeline: Slack (fetch + build_df) en paralelo con la descarga + parseo del workbook
+    pipelined=os.environ.get("PIPELINED","0")=="1"
+    # Modo daemon (python app.py --daemon): proceso residente, sync cada N segundos o según expresión cron (hora Chile)
+    daemon_interval_seconds=float(os.environ.get("DAEMON_INTERVAL_SECONDS","300"))
+    daemon_cron=os.environ.get("DAEMON_CRON","").strip()
+    # Backfill histórico (python app.py backfill --from YYYY-MM-DD --to YYYY-MM-DD): tramos en paralelo con checkpoint
+    backfill_slice_days=max(1,int(os.environ.get("BACKFILL_SLICE_DAYS","7")))
+    backfill_checkpoint_path=os.environ.get("BACKFILL_CHECKPOINT_PATH","").strip() or os.path.join(os.path.dirname(refresh_token_path) or ".","backfill_checkpoint.jsonl")
+    # Lotes de más de N mensajes se convierten con pandas (vectorizado); los chicos en Python puro
+    rows_vectorize_threshold=int(os.environ.get("ROWS_VECTORIZE_THRESHOLD","5000"))
+    # Métricas por ejecución, opcionales: una línea JSON por run (el archivo solo crece: rotarlo afuera, p.ej. logrotate)
+    # y textfile Prometheus (se reescribe en cada run)
+    metrics_jsonl_path=os.environ.get("METRICS_JSONL_PATH","").strip()
+    metrics_prom_path=os.environ.get("METRICS_PROM_PATH","").strip()  # p.ej. /var/lib/node_exporter/textfile/slack_excel.prom
+    _config_loaded=True
+
+SHEET_COLUMNS=["Fecha aproximada","Origen","SLACK","Diagnóstico causa raíz","Propuesta (Tarea en ClickUp cuando sea desarrollable /Cambio sistema)","ESTADO FINAL"]
+KEY_COLUMN="slack_key"  # columna oculta (G) con "<channel>:<ts>", estable para reconstruir el índice
+KEY_COLUMN_LETTER="G"
+KEY_INDEX=len(SHEET_COLUMNS)
+# Resumen del hilo (opcional, SLACK_FETCH_REPLIES=1): columnas visibles después de la clave
+REPLY_COLUMNS=["Respuestas","Primera respuesta (min)"]
 
 def now_scl():
     return datetime.now(tz=ZoneInfo("America/Santiago"))
@@ -58,18 +185,420 @@ def save_refresh_token(token: str):
     except Exception as e:
         print(f"[WARN] No se pudo guardar refresh token en {refresh_token_path}: {e}")
 
-def acquire_token():
+def atomic_write(path, data):
+    """
+    Escribe el archivo completo en un temporal y lo renombra (evita archivos a medio escribir).
+    data: str, bytes o un archivo binario (se copia por bloques desde el inicio).
+    """
+    d=os.path.dirname(path)
+    if d:
+        os.makedirs(d,exist_ok=True)
+    mode="w" if isinstance(data,str) else "wb"
+    tmp=f"{path}.tmp{os.getpid()}"
+    with open(tmp,mode,**({} if mode=="wb" else {"encoding":"utf-8"})) as f:
+        if hasattr(data,"read"):
+            data.seek(0)
+            shutil.copyfileobj(data,f,STREAM_CHUNK)
+        else:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,path)
+
+STREAM_CHUNK=1<<20  # bloque de copia/lectura de archivos y partes del zip (1 MiB)
+
+def payload_size(data):
+    """Tamaño de bytes o de un archivo binario (modo streaming)."""
+    if hasattr(data,"read"):
+        data.seek(0,os.SEEK_END)
+        return data.tell()
+    return len(data)
+
+def payload_chunk(data, start, end):
+    """Bytes [start, end] (inclusive) de bytes o de un archivo binario."""
+    if hasattr(data,"read"):
+        data.seek(start)
+        return data.read(end+1-start)
+    return data[start:end+1]
+
+def load_sync_state() -> dict:
+    """Lee el estado de sincronización: {channel_id: {"last_ts": "<ts Slack>", "edits_at": epoch}}."""
+    try:
+        if sync_state_path and os.path.exists(sync_state_path):
+            with open(sync_state_path,"r",encoding="utf-8") as f:
+                st=json.load(f)
+                if isinstance(st,dict):
+                    return st
+    except Exception as e:
+        print(f"[WARN] No se pudo leer SYNC_STATE_PATH={sync_state_path}: {e}")
+    return {}
+
+def save_sync_state(state: dict):
+    """Persiste el estado de sincronización de forma atómica."""
+    if not sync_state_path:
+        return
+    try:
+        atomic_write(sync_state_path,json.dumps(state,indent=2,sort_keys=True))
+        print(f"[INFO] Estado de sincronización guardado en {sync_state_path}")
+    except Exception as e:
+        print(f"[WARN] No se pudo guardar estado de sincronización en {sync_state_path}: {e}")
+
+def sync_window(state, channel, now_local):
+    """
+    Calcula (oldest, descripción) para el fetch de Slack.
+    Con high-water mark: desde last_ts menos el solape de seguridad.
+    Sin estado (primer run): backfill acotado desde 00:00 del día (hoy - SYNC_BACKFILL_DAYS).
+    """
+    last_ts=(state.get(channel) or {}).get("last_ts")
+    if last_ts:
+        oldest=max(float(last_ts)-sync_overlap_seconds,0.0)
+        return str(oldest), f"incremental desde last_ts={last_ts} (solape {sync_overlap_seconds}s)"
+    start_local=now_local.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=sync_backfill_days)
+    return str(start_local.astimezone(timezone.utc).timestamp()), f"backfill inicial desde {start_local} (hora Chile)"
+
+def advance_sync_state(state, recs, edits=None):
+    """
+    Avanza el high-water mark de cada canal con el mayor ts visto en recs y lo persiste.
+    edits: EditWindow ya aplicada; registra la re-lectura de ediciones (edits_at) de sus canales.
+    """
+    newest={}
+    for r in recs:
+        ch=r.channel or channel_id
+        ts=r.ts
+        if ts and (ch not in newest or float(ts)>float(newest[ch])):
+            newest[ch]=ts
+    for ch,ts in newest.items():
+        state.setdefault(ch,{})["last_ts"]=ts
+    for ch,(_,latest) in (edits.windows.items() if edits is not None else ()):
+        state.setdefault(ch,{})["edits_at"]=latest
+    if newest or edits is not None:
+        save_sync_state(state)
+
+def edits_due(state, now):
+    """Toca re-leer ediciones: algún canal sin re-lectura en los últimos EDIT_TRACKING_INTERVAL_SECONDS."""
+    if edit_tracking_days<=0:
+        return False
+    return any(now-float((state.get(ch) or {}).get("edits_at") or 0)>=edit_tracking_interval_seconds for ch in channel_ids)
+
+def pending_rows(rows, index, state):
+    """
+    Descarta las filas que el solape del high-water mark vuelve a traer: las que ya están en el
+    índice local o, sin índice, las de ts <= last_ts del canal (escritas en un run anterior).
+    Así un run sin mensajes nuevos no abre ni sube el workbook.
+    """
+    if index is not None:
+        existing=index.existing(r[KEY_INDEX] for r in rows)
+        return [r for r in rows if r[KEY_INDEX] not in existing]
+    return [r for r in rows if past_high_water(state, r[KEY_INDEX])]
+
+def past_high_water(state, key):
+    """La clave "<channel>:<ts>" es posterior al last_ts de su canal (no escrita en runs anteriores)."""
+    ch,ts=key.split(":",1)
+    last_ts=(state.get(ch) or {}).get("last_ts")
+    return not last_ts or float(ts)>float(last_ts)
+
+class Metrics:
+    """
+    Instrumentación de una ejecución (thread-safe): duración acumulada por fase (las fases
+    pueden anidarse, p.ej. dl_excel dentro de open_workbook) y contadores
+    (bytes, páginas/llamadas Slack, filas, duplicados, reintentos), más las respuestas HTTP de
+    Graph/login por status. Se reinicia al inicio de cada run.
+    """
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started=time.time()
+            self.phases={}  # fase -> [segundos, veces]
+            self.counters=Counter()
+            self.http_status=Counter()  # status HTTP (o "error" de red) -> cantidad
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        t0=time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed=time.perf_counter()-t0
+            with self.lock:
+                p=self.phases.setdefault(phase,[0.0,0])
+                p[0]+=elapsed
+                p[1]+=1
+
+    def timed(self, phase):
+        """Decorador: span alrededor de cada llamada a la función."""
+        def wrap(fn):
+            @functools.wraps(fn)
+            def run(*args, **kwargs):
+                with self.span(phase):
+                    return fn(*args, **kwargs)
+            return run
+        return wrap
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name]+=n
+
+    def http_response(self, status):
+        """Cuenta una respuesta HTTP (desde cualquier hilo: pipeline, subida/prefetch en segundo plano)."""
+        with self.lock:
+            self.http_status[status]+=1
+
+    def http_summary(self):
+        with self.lock:
+            return dict(self.http_status)
+
+    def snapshot(self, mode, status):
+        with self.lock:
+            return {
+                "ts":datetime.now(tz=timezone.utc).isoformat(timespec="seconds"),
+                "mode":mode,
+                "status":status,
+                "duration_s":round(time.time()-self.started,3),
+                "phases":{k:{"seconds":round(v[0],4),"count":v[1]} for k,v in sorted(self.phases.items())},
+                "counters":dict(sorted(self.counters.items())),
+                "http_status":{str(k):v for k,v in sorted(self.http_status.items(),key=lambda kv: str(kv[0]))},
+            }
+
+metrics=Metrics()
+
+def prometheus_text(snap):
+    """Snapshot -> formato textfile de Prometheus (gauges con el valor del último run)."""
+    lines=[
+        "# HELP slack_excel_last_run_timestamp_seconds Fin del último run (epoch).",
+        "# TYPE slack_excel_last_run_timestamp_seconds gauge",
+        f'slack_excel_last_run_timestamp_seconds{{mode="{snap["mode"]}"}} {time.time():.0f}',
+        "# HELP slack_excel_last_run_duration_seconds Duración total del último run.",
+        "# TYPE slack_excel_last_run_duration_seconds gauge",
+        f'slack_excel_last_run_duration_seconds{{mode="{snap["mode"]}"}} {snap["duration_s"]}',
+        "# HELP slack_excel_last_run_success 1 si el último run terminó bien.",
+        "# TYPE slack_excel_last_run_success gauge",
+        f'slack_excel_last_run_success{{mode="{snap["mode"]}"}} {1 if snap["status"] in ("ok","no_rows") else 0}',
+        "# HELP slack_excel_phase_seconds Tiempo por fase en el último run.",
+        "# TYPE slack_excel_phase_seconds gauge",
+    ]
+    lines+=[f'slack_excel_phase_seconds{{mode="{snap["mode"]}",phase="{k}"}} {v["seconds"]}' for k,v in snap["phases"].items()]
+    lines+=["# HELP slack_excel_events Contadores del último run (bytes, llamadas, filas, reintentos).","# TYPE slack_excel_events gauge"]
+    lines+=[f'slack_excel_events{{mode="{snap["mode"]}",name="{k}"}} {v}' for k,v in snap["counters"].items()]
+    lines+=["# HELP slack_excel_http_responses Respuestas HTTP de Graph/login por status en el último run.","# TYPE slack_excel_http_responses gauge"]
+    lines+=[f'slack_excel_http_responses{{mode="{snap["mode"]}",status="{k}"}} {v}' for k,v in snap["http_status"].items()]
+    return "\n".join(lines)+"\n"
+
+def export_metrics(mode, status):
+    """Agrega el run a METRICS_JSONL_PATH y reescribe METRICS_PROM_PATH (si está configurado)."""
+    snap=metrics.snapshot(mode,status)
+    print(f"[INFO] Métricas: {json.dumps(snap['phases'])} {json.dumps(snap['counters'])}")
+    try:
+        if metrics_jsonl_path:
+            d=os.path.dirname(metrics_jsonl_path)
+            if d:
+                os.makedirs(d,exist_ok=True)
+            with open(metrics_jsonl_path,"a",encoding="utf-8") as f:
+                f.write(json.dumps(snap,sort_keys=True)+"\n")
+        if metrics_prom_path:
+            # El textfile collector lee el archivo en cualquier momento: escritura atómica
+            atomic_write(metrics_prom_path,prometheus_text(snap))
+    except Exception as e:
+        print(f"[WARN] No se pudieron exportar métricas: {e}")
+
+def instrumented(mode):
+    """
+    Decorador de los puntos de entrada (main, backfill): métricas limpias, espera de las tareas en
+    segundo plano y un registro exportado por run.
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            load_config()
+            metrics.reset()
+            status="error"
+            try:
+                result=fn(*args, **kwargs)
+                status="upload_failed" if result is False else "no_rows" if result is None else "ok"
+                return result
+            finally:
+                # También ante excepción: no cortar un refresco de token a mitad de la rotación
+                finish_background_tasks()
+                export_metrics(mode,status)
+        return run
+    return wrap
+
+_http_session=None
+_http_lock=threading.Lock()
+
+def http_session():
+    """Sesión requests compartida (pool keep-alive por host)."""
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            sess=requests.Session()
+            adapter=HTTPAdapter(pool_connections=4,pool_maxsize=16)
+            sess.mount("https://",adapter)
+            sess.mount("http://",adapter)
+            _http_session=sess
+        return _http_session
+
+def retry_delay(r, attempt):
+    """Espera antes del próximo intento: Retry-After si viene, si no backoff exponencial con jitter."""
+    ra=r.headers.get("Retry-After") if r is not None else None
+    if ra:
+        try:
+            return min(float(ra),http_backoff_max_seconds)
+        except ValueError:
+            pass
+    return min(http_backoff_seconds*(2**attempt),http_backoff_max_seconds)*(0.5+random.random()/2)
+
+def http_request(method, url, timeout=None, **kwargs):
+    """
+    Request HTTP por la sesión compartida, con timeout por llamada y reintentos
+    (429/503/504 y errores de red). Retorna la última respuesta; no lanza por status.
+    """
+    sess=http_session()
+    for attempt in range(http_max_retries+1):
+        try:
+            r=sess.request(method,url,timeout=timeout or http_timeout_seconds,**kwargs)
+        except (requests.ConnectionError,requests.Timeout) as e:
+            metrics.http_response("error")
+            if attempt>=http_max_retries:
+                raise
+            metrics.inc("http_retries")
+            delay=retry_delay(None,attempt)
+            print(f"[WARN] {method} {url.split('?')[0]}: error de red ({e}); reintento en {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        metrics.http_response(r.status_code)
+        if r.status_code not in RETRY_STATUSES or attempt>=http_max_retries:
+            return r
+        metrics.inc("http_retries")
+        if r.status_code==429:
+            metrics.inc("http_throttled")
+        delay=retry_delay(r,attempt)
+        print(f"[WARN] {method} {url.split('?')[0]}: status {r.status_code}; reintento {attempt+1}/{http_max_retries} en {delay:.1f}s")
+        time.sleep(delay)
+    return r
+
+def drive_item_url(path, suffix=""):
+    """URL Graph de un item del drive del usuario por ruta (p.ej. suffix=":/content")."""
+    return f"{graph_base_url}/users/{onedrive_upn}/drive/root:{path}{suffix}"
+
+_background_tasks=[]
+
+def background_token_refresh():
+    try:
+        acquire_token(force_refresh=True, allow_device_flow=False)
+        print("[INFO] Access token refrescado en segundo plano")
+    except Exception as e:
+        print(f"[WARN] token: refresco en segundo plano falló: {e}")
+
+def finish_background_tasks(timeout=30):
+    """Espera tareas en segundo plano (p.ej. refresco de token) antes de terminar el proceso."""
+    while _background_tasks:
+        _background_tasks.pop().join(timeout)
+
+def load_token_cache():
+    import msal
+    cache=msal.SerializableTokenCache()
+    try:
+        if token_cache_path and os.path.exists(token_cache_path):
+            with open(token_cache_path,"r",encoding="utf-8") as f:
+                cache.deserialize(f.read())
+    except Exception as e:
+        print(f"[WARN] No se pudo leer TOKEN_CACHE_PATH={token_cache_path}: {e}")
+    return cache
+
+def save_token_cache(cache):
+    """Persiste el cache MSAL de forma atómica, solo si cambió."""
+    if not token_cache_path or not cache.has_state_changed:
+        return
+    try:
+        atomic_write(token_cache_path,cache.serialize())
+        cache.has_state_changed=False
+    except Exception as e:
+        print(f"[WARN] No se pudo guardar cache de tokens en {token_cache_path}: {e}")
+
+GRAPH_RESOURCE="https://graph.microsoft.com/"
+
+def scope_names(scopes):
+    """
+    Scopes normalizados para el target del cache: sin el prefijo del recurso Graph (el token endpoint
+    responde "https://graph.microsoft.com/Files.ReadWrite") ni los reservados de OIDC.
+    """
+    names=[sc[len(GRAPH_RESOURCE):] if sc.lower().startswith(GRAPH_RESOURCE) else sc for sc in scopes.split()]
+    return [sc for sc in names if sc not in {"offline_access","openid","profile"}]
+
+def token_scopes():
+    """Scopes del access token (sin los reservados de OIDC, que no forman parte del target)."""
+    return scope_names(graph_scope)
+
+def cached_access_token(cache, tenant):
+    """Retorna (access_token, segundos_restantes) si el cache tiene uno vigente, o (None, 0)."""
+    import msal
+    now=int(time.time())
+    best=None
+    for at in cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN,target=token_scopes(),query={"client_id":client_id,"realm":tenant}):
+        remaining=int(at.get("expires_on") or 0)-now
+        if remaining>60 and (best is None or remaining>best[1]):
+            best=(at["secret"],remaining)
+    return best or (None,0)
+
+def remember_token(cache, token_url, payload, grant_type):
+    """Registra la respuesta del token endpoint en el cache MSAL y lo persiste."""
+    try:
+        # Mismo formato que busca cached_access_token: sin prefijo de recurso
+        granted=scope_names(payload.get("scope") or "") or token_scopes()
+        # msal solo acepta endpoints https (de ahí saca environment/realm de la entrada); AZURE_LOGIN_URL
+        # puede ser http (proxy o emulador local) y sin esto el token nunca quedaría en cache
+        endpoint="https://"+token_url.split("://",1)[-1]
+        cache.add({
+            "client_id":client_id,
+            "scope":granted,
+            "token_endpoint":endpoint,
+            "response":payload,
+            "grant_type":grant_type,
+        })
+        save_token_cache(cache)
+    except Exception as e:
+        print(f"[WARN] No se pudo registrar token en cache: {e}")
+
+@metrics.timed("acquire_token")
+def acquire_token(force_refresh=False, allow_device_flow=True):
     tenant = os.environ.get("AZURE_TENANT", "consumers").strip() or "consumers"
-    token_url = f"https://login.microsoftonline.com/{tenant}/oauth2/v2.0/token"
+    token_url = f"{login_base_url}/{tenant}/oauth2/v2.0/token"
 
     if not client_id:
         raise RuntimeError("token: falta variable de entorno AZURE_CLIENT_ID")
 
+    # Access token vigente en el cache persistente: sin round trip al token endpoint
+    cache=load_token_cache()
+    if not force_refresh:
+        at,remaining=cached_access_token(cache,tenant)
+        if at and remaining<token_min_run_seconds:
+            # No alcanza para un run completo: un 401 a mitad de una subida obligaría a repetirla
+            print(f"[INFO] Access token en cache vence en {remaining}s (< TOKEN_MIN_RUN_SECONDS); refrescando antes del run")
+            try:
+                return acquire_token(force_refresh=True, allow_device_flow=False)
+            except Exception as e:
+                print(f"[WARN] token: refresco síncrono falló ({e}); se usa el token en cache")
+                return at
+        if at:
+            print(f"[INFO] Access token desde cache (vence en {remaining}s)")
+            if remaining<token_refresh_margin_seconds:
+                # Vence pronto: refrescar en segundo plano para que el próximo run lo encuentre vigente
+                t=threading.Thread(target=background_token_refresh,name="token-refresh",daemon=True)
+                t.start()
+                _background_tasks.append(t)
+            return at
+
     rt=load_refresh_token() or refresh_token
 
     def device_flow_token():
-        device_url=f"https://login.microsoftonline.com/{tenant}/oauth2/v2.0/devicecode"
-        dc=requests.post(device_url,data={"client_id":client_id,"scope":graph_scope},timeout=30)
+        if not allow_device_flow:
+            raise RuntimeError("token: se requiere device flow (no permitido en este contexto)")
+        device_url=f"{login_base_url}/{tenant}/oauth2/v2.0/devicecode"
+        dc=http_request("POST",device_url,data={"client_id":client_id,"scope":graph_scope},timeout=30)
         if dc.status_code>=400:
             raise RuntimeError(f"token: devicecode falló (status={dc.status_code}): {dc.text[:1000]}")
         flow=dc.json()
@@ -84,7 +613,8 @@ def acquire_token():
         deadline=time.time()+min(int(flow.get("expires_in",900)),device_flow_wait_seconds)
         while time.time()<deadline:
             time.sleep(interval)
-            tr=requests.post(
+            tr=http_request(
+                "POST",
                 token_url,
                 data={
                     "grant_type":"urn:ietf:params:oauth:grant-type:device_code",
@@ -101,6 +631,7 @@ def acquire_token():
                 at=tok.get("access_token")
                 if not at:
                     raise RuntimeError(f"token: device flow sin access_token: {str(tok)[:800]}")
+                remember_token(cache,token_url,tok,"urn:ietf:params:oauth:grant-type:device_code")
                 return at
 
             # Respuestas esperables mientras se autoriza
@@ -136,7 +667,7 @@ def acquire_token():
     last_err = None
     for data in attempts:
         try:
-            r = requests.post(token_url, data=data, timeout=30)
+            r = http_request("POST", token_url, data=data, timeout=30)
         except requests.RequestException as e:
             last_err = f"token: error de red llamando a {token_url}: {e}"
             continue
@@ -150,6 +681,11 @@ def acquire_token():
             access_token = payload.get("access_token")
             if not access_token:
                 raise RuntimeError(f"token: respuesta sin access_token desde {token_url}: {str(payload)[:800]}")
+            # Persistir rotación del refresh token solo si cambió
+            new_rt = payload.get("refresh_token")
+            if new_rt and new_rt != rt:
+                save_refresh_token(new_rt)
+            remember_token(cache, token_url, payload, "refresh_token")
             return access_token
 
         # Error HTTP: extraer detalles (sin imprimir secretos)
@@ -185,144 +721,689 @@ def acquire_token():
     raise RuntimeError(last_err or "token: fallo desconocido al refrescar access token")
 
 def gget(url,token):
-    r=requests.get(url,headers={"Authorization":f"Bearer {token}"})
+    r=http_request("GET",url,headers={"Authorization":f"Bearer {token}"})
     if r.status_code>=400:
-        raise RuntimeError("get")
+        raise RuntimeError(f"get: status {r.status_code}")
     return r
 
-def gput(url,token,data,content_type):
-    r=requests.put(url,headers={"Authorization":f"Bearer {token}","Content-Type":content_type},data=data)
+CONFLICT_STATUSES={409,412,423}
+
+class UploadConflict(RuntimeError):
+    """El archivo remoto cambió (412), está en conflicto (409) o bloqueado (423)."""
+
+    def __init__(self, status):
+        super().__init__(f"put {status}")
+        self.status = status
+
+def gput(url,token,data,content_type,etag=None):
+    headers={"Authorization":f"Bearer {token}","Content-Type":content_type}
+    if etag:
+        headers["If-Match"]=etag
+    r=http_request("PUT",url,headers=headers,data=data)
     if r.status_code>=400:
-        print(f"[ERROR] Error en PUT: {r.status_code} - {r.text}")
-        # No lanzar excepción para errores 423 (archivo bloqueado) o 409 (conflicto)
-        if r.status_code in [423, 409]:
-            print(f"[WARN] Archivo bloqueado o en conflicto, continuando...")
-            return r
+        print(f"[ERROR] Error en PUT: {r.status_code} - {r.text[:500]}")
+        if r.status_code in CONFLICT_STATUSES:
+            raise UploadConflict(r.status_code)
         raise RuntimeError("put")
     return r
 
+XLSX_CONTENT_TYPE="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+@metrics.timed("ensure_file")
 def ensure_file(token):
-    meta=f"https://graph.microsoft.com/v1.0/users/{onedrive_upn}/drive/root:{onedrive_file_path}"
-    r=requests.get(meta,headers={"Authorization":f"Bearer {token}"})
+    """Asegura que el workbook exista y retorna la metadata del driveItem (eTag/cTag/size)."""
+    meta=drive_item_url(onedrive_file_path)
+    r=http_request("GET",meta,headers={"Authorization":f"Bearer {token}"})
     if r.status_code==404:
+        from openpyxl.workbook import Workbook
         buf=io.BytesIO()
         wb=Workbook()
         ws=wb.active
         ws.title="TMP"
         wb.save(buf)
         buf.seek(0)
-        upload=f"https://graph.microsoft.com/v1.0/users/{onedrive_upn}/drive/root:{onedrive_file_path}:/content"
-        gput(upload,token,buf.getvalue(),"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        upload=drive_item_url(onedrive_file_path,":/content")
+        r=gput(upload,token,buf.getvalue(),XLSX_CONTENT_TYPE)
         print(f"[WARN] Archivo no existía, creado nuevo en {onedrive_file_path}")
+        return item_meta(r)
     elif r.status_code>=400:
         raise RuntimeError("meta")
+    return item_meta(r)
+
+def item_meta(r):
+    try:
+        return r.json() if r.status_code<300 else {}
+    except ValueError:
+        return {}
+
+def cache_tag(meta):
+    """Tag de contenido del item: cTag cambia solo con el contenido; eTag como respaldo."""
+    return (meta or {}).get("cTag") or (meta or {}).get("eTag")
+
+def open_workbook_cache(meta):
+    """Abre (rb) el workbook cacheado si su tag coincide con la metadata remota; si no, None."""
+    tag=cache_tag(meta)
+    if not tag or not workbook_cache_path:
+        return None
+    try:
+        with open(workbook_cache_path+".json","r",encoding="utf-8") as f:
+            cached=json.load(f)
+        if cached.get("tag")!=tag:
+            return None
+        f=open(workbook_cache_path,"rb")
+        if cached.get("size") is not None and payload_size(f)!=cached["size"]:
+            f.close()
+            return None
+        f.seek(0)
+        return f
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[WARN] No se pudo leer cache de workbook {workbook_cache_path}: {e}")
+        return None
+
+def load_workbook_cache(meta):
+    """Retorna los bytes del workbook cacheado si su tag coincide con la metadata remota."""
+    f=open_workbook_cache(meta)
+    if f is None:
+        return None
+    with f:
+        return f.read()
+
+def save_workbook_cache(data, meta):
+    """Guarda el workbook (bytes o archivo) como cache local, asociado al tag de meta."""
+    tag=cache_tag(meta)
+    if not tag or not workbook_cache_path:
+        return
+    try:
+        atomic_write(workbook_cache_path,data)
+        atomic_write(workbook_cache_path+".json",json.dumps({"tag":tag,"eTag":meta.get("eTag"),"size":payload_size(data)}))
+    except Exception as e:
+        print(f"[WARN] No se pudo guardar cache de workbook en {workbook_cache_path}: {e}")
+
+@metrics.timed("dl_excel")
+def dl_excel(token, meta=None):
+    """Descarga el workbook, o lo toma del cache local si el cTag/eTag remoto no cambió."""
+    data=load_workbook_cache(meta)
+    if data is not None:
+        print(f"[INFO] Workbook sin cambios remotos (tag {cache_tag(meta)}), usando cache local ({len(data)} bytes)")
+        metrics.inc("workbook_cache_hits")
+        return io.BytesIO(data)
+    url=drive_item_url(onedrive_file_path,":/content")
+    data=gget(url,token).content
+    metrics.inc("download_bytes",len(data))
+    save_workbook_cache(data,meta)
+    return io.BytesIO(data)
+
+def spooled_file():
+    """Temporal en memoria hasta SPOOL_MAX_BYTES; más grande pasa a disco."""
+    import tempfile
+    return tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+
+@metrics.timed("dl_excel")
+def dl_excel_file(token, meta=None):
+    """
+    Como dl_excel, sin pasar el workbook completo por memoria: el archivo del cache local
+    si el tag no cambió, o la descarga por bloques a un temporal. Retorna un archivo binario.
+    """
+    f=open_workbook_cache(meta)
+    if f is not None:
+        print(f"[INFO] Workbook sin cambios remotos (tag {cache_tag(meta)}), usando cache local en disco")
+        metrics.inc("workbook_cache_hits")
+        return f
+    r=http_request("GET",drive_item_url(onedrive_file_path,":/content"),headers={"Authorization":f"Bearer {token}"},stream=True)
+    if r.status_code>=400:
+        raise RuntimeError(f"get: status {r.status_code}")
+    f=spooled_file()
+    for chunk in r.iter_content(STREAM_CHUNK):
+        f.write(chunk)
+    metrics.inc("download_bytes",f.tell())
+    save_workbook_cache(f,meta)
+    f.seek(0)
+    return f
+
+def next_expected_offset(payload, default):
+    """Primer byte pendiente según nextExpectedRanges (p.ej. ["26-"]) de la sesión de upload."""
+    ranges=(payload or {}).get("nextExpectedRanges") or []
+    try:
+        return int(str(ranges[0]).split("-")[0])
+    except (IndexError, ValueError):
+        return default
+
+def upload_session(token, path, data, etag=None):
+    """
+    Sube data vía createUploadSession en chunks fijos (UPLOAD_CHUNK_BYTES). Ante un fallo
+    consulta el estado de la sesión y retoma desde el último rango confirmado, sin
+    retransmitir lo ya aceptado. Retorna la respuesta final (driveItem).
+    """
+    headers={"Authorization":f"Bearer {token}"}
+    if etag:
+        headers["If-Match"]=etag
+    r=http_request(
+        "POST",
+        drive_item_url(path,":/createUploadSession"),
+        headers=headers,
+        json={"item":{"@microsoft.graph.conflictBehavior":"replace"}},
+    )
+    if r.status_code>=400:
+        print(f"[ERROR] Error creando sesión de upload: {r.status_code} - {r.text[:500]}")
+        if r.status_code in CONFLICT_STATUSES:
+            raise UploadConflict(r.status_code)
+        raise RuntimeError(f"put {r.status_code}")
+    upload_url=r.json()["uploadUrl"]
+    total=payload_size(data)
+    offset=0
+    resumes=0
+    stalled=0  # reanudaciones consecutivas sin avance
+    sent=0
+    started=time.time()
+    while True:
+        end=min(offset+upload_chunk_bytes,total)-1
+        r=None
+        try:
+            # uploadUrl es pre-autenticada: no lleva Authorization
+            r=http_request("PUT",upload_url,headers={"Content-Range":f"bytes {offset}-{end}/{total}"},data=payload_chunk(data,offset,end))
+        except (requests.ConnectionError,requests.Timeout) as e:
+            print(f"[WARN] Upload: error de red en bytes {offset}-{end}: {e}")
+        if r is not None and r.status_code in (200,201):
+            sent+=end+1-offset
+            elapsed=max(time.time()-started,1e-6)
+            print(f"[INFO] Upload completo: {total} bytes en {elapsed:.1f}s ({sent/elapsed/1024:.0f} KiB/s, {resumes} reanudaciones)")
+            return r
+        if r is not None and r.status_code==202:
+            sent+=end+1-offset
+            offset=next_expected_offset(r.json(),end+1)
+            stalled=0
+            elapsed=max(time.time()-started,1e-6)
+            print(f"[INFO] Upload {offset}/{total} bytes ({sent/elapsed/1024:.0f} KiB/s)")
+            continue
+        if r is not None and r.status_code in CONFLICT_STATUSES:
+            raise UploadConflict(r.status_code)
+        resumes+=1
+        metrics.inc("upload_resumes")
+        stalled+=1
+        if stalled>upload_resume_attempts:
+            raise RuntimeError(f"put {r.status_code if r is not None else 'red'}: sin progreso tras {upload_resume_attempts} reanudaciones")
+        st=http_request("GET",upload_url)
+        if st.status_code>=400:
+            raise RuntimeError(f"put: sesión de upload no disponible (status {st.status_code})")
+        offset=next_expected_offset(st.json(),offset)
+        print(f"[WARN] Upload reanudado desde byte {offset}/{total} (intento {stalled}/{upload_resume_attempts})")
 
-def dl_excel(token):
-    url=f"https://graph.microsoft.com/v1.0/users/{onedrive_upn}/drive/root:{onedrive_file_path}:/content"
-    return io.BytesIO(gget(url,token).content)
+def put_workbook(token, path, data, etag=None):
+    """PUT simple para archivos chicos; sesión de upload por chunks sobre el umbral. data: bytes o archivo."""
+    size=payload_size(data)
+    if size>upload_session_threshold_bytes:
+        return upload_session(token,path,data,etag)
+    return gput(drive_item_url(path,":/content"),token,payload_chunk(data,0,size-1),XLSX_CONTENT_TYPE,etag)
 
-def up_excel(token,bio):
-    url=f"https://graph.microsoft.com/v1.0/users/{onedrive_upn}/drive/root:{onedrive_file_path}:/content"
+def save_local_backup(bio):
+    """Con LOCAL_BACKUP_PATH, copia local del workbook que no se pudo subir (reemplaza la anterior)."""
+    if not local_backup_path:
+        return
+    try:
+        atomic_write(local_backup_path, bio.getvalue() if isinstance(bio, io.BytesIO) else bio)
+        print(f"[INFO] Archivo guardado localmente como respaldo: {local_backup_path}")
+    except Exception as backup_error:
+        print(f"[WARN] No se pudo guardar respaldo local: {backup_error}")
+
+last_uploaded_item={}  # driveItem de la última subida exitosa (eTag/cTag), para el workbook en memoria del daemon
+
+@metrics.timed("up_excel")
+def up_excel(token,bio,etag=None):
+    """
+    Sube el workbook condicionado a etag (If-Match). Retorna True/False;
+    lanza UploadConflict si el remoto cambió o está bloqueado, para re-aplicar las filas.
+    bio: BytesIO, o un archivo temporal en modo streaming (se sube leyendo por rangos).
+    """
+    data=bio.getvalue() if isinstance(bio,io.BytesIO) else bio
     try:
-        gput(url,token,bio.getvalue(),"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        metrics.inc("upload_bytes",payload_size(data))
+        r=put_workbook(token,onedrive_file_path,data,etag)
         print(f"[INFO] Archivo subido exitosamente a OneDrive")
+        # La respuesta trae el driveItem actualizado: el próximo run evita la descarga
+        last_uploaded_item.clear()
+        last_uploaded_item.update(item_meta(r))
+        save_workbook_cache(data,last_uploaded_item)
         return True
+    except UploadConflict:
+        raise
     except Exception as e:
         print(f"[ERROR] Error al subir archivo: {e}")
-        
-        # Si el archivo está bloqueado (423) o en conflicto (409), crear una copia con timestamp
-        if "423" in str(e) or "409" in str(e):
-            try:
-                # Crear nombre de archivo con timestamp
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                # Obtener el directorio y nombre base del archivo original
-                base_path = onedrive_file_path.rsplit('/', 1)[0] if '/' in onedrive_file_path else ""
-                base_name = onedrive_file_path.rsplit('/', 1)[-1].rsplit('.', 1)[0] if '.' in onedrive_file_path else onedrive_file_path
-                extension = onedrive_file_path.rsplit('.', 1)[-1] if '.' in onedrive_file_path else "xlsx"
-                
-                # Crear nueva ruta con timestamp
-                backup_path = f"{base_path}/{base_name}_backup_{timestamp}.{extension}" if base_path else f"{base_name}_backup_{timestamp}.{extension}"
-                backup_url = f"https://graph.microsoft.com/v1.0/users/{onedrive_upn}/drive/root:{backup_path}:/content"
-                
-                # Subir la copia
-                gput(backup_url, token, bio.getvalue(), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                print(f"[INFO] Archivo bloqueado - copia creada en OneDrive: {backup_path}")
-                return True
-                
-            except Exception as backup_error:
-                print(f"[ERROR] Error al crear copia en OneDrive: {backup_error}")
-        
-        # Guardar archivo localmente como respaldo adicional
-        backup_filename = f"backup_blackbox_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        try:
-            with open(backup_filename, 'wb') as f:
-                f.write(bio.getvalue())
-            print(f"[INFO] Archivo guardado localmente como respaldo: {backup_filename}")
-        except Exception as backup_error:
-            print(f"[WARN] No se pudo guardar respaldo local: {backup_error}")
-        
+        save_local_backup(bio)
         # No lanzar excepción, solo reportar el error
         print(f"[WARN] Continuando sin subir a OneDrive debido al error")
         return False
 
-def fetch_messages(oldest=None, latest=None):
-    c=WebClient(token=slack_bot_token)
-    out=[]
+def conflict_delay(attempt):
+    """Backoff exponencial con jitter completo entre re-intentos por conflicto."""
+    return random.uniform(0,upload_conflict_backoff_seconds*(2**attempt))
+
+class RateLimiter:
+    """
+    Token bucket compartido entre hilos: rate_per_minute llamadas sostenidas con ráfaga
+    de hasta burst. pause() bloquea a todos (Retry-After de un 429).
+    """
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst or max(1.0, min(rate_per_minute / 10.0, 5.0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+_slack_client=None
+_slack_limiter=None
+_slack_users_limiter=None
+
+def slack_client():
+    """WebClient compartido (thread-safe) y sus limitadores de tasa."""
+    global _slack_client, _slack_limiter, _slack_users_limiter
+    with _http_lock:
+        if _slack_client is None:
+            from slack_sdk import WebClient
+            _slack_client=WebClient(token=slack_bot_token)
+            _slack_limiter=RateLimiter(slack_rate_per_minute)
+        if _slack_users_limiter is None:
+            _slack_users_limiter=RateLimiter(slack_users_rate_per_minute)
+        return _slack_client
+
+def slack_limiter(method):
+    """Slack limita por método: users.info tiene su bucket; el resto comparte el de conversations.history."""
+    return _slack_users_limiter if method=="users_info" else _slack_limiter
+
+def slack_call(method, **kwargs):
+    """Llama un método del WebClient respetando el limitador y el Retry-After de los 429."""
+    from slack_sdk.errors import SlackApiError
+    c=slack_client()
+    limiter=slack_limiter(method)
+    for attempt in range(slack_max_429_retries+1):
+        limiter.acquire()
+        try:
+            metrics.inc("slack_calls")
+            metrics.inc(f"slack_calls_{method}")
+            return getattr(c,method)(**kwargs)
+        except SlackApiError as e:
+            if e.response is None or e.response.status_code!=429 or attempt>=slack_max_429_retries:
+                raise
+            headers={k.lower():v for k,v in (e.response.headers or {}).items()}
+            retry_after=float(headers.get("retry-after") or 30)
+            metrics.inc("slack_throttled")
+            print(f"[WARN] Slack {method}: 429, pausando {retry_after:.0f}s (intento {attempt+1}/{slack_max_429_retries})")
+            limiter.pause(retry_after)
+
+# Escapar comillas y aplanar saltos de línea en una sola pasada (texto dentro de HYPERLINK)
+EXCEL_TEXT_TRANSLATION=str.maketrans({'"':'""',"\n":" ","\r":" "})
+
+def clean_excel_text(text):
+    """Texto listo para el HYPERLINK: comillas escapadas, sin saltos de línea, máx. 200 caracteres."""
+    if not text:
+        return ""
+    clean=text.translate(EXCEL_TEXT_TRANSLATION)
+    # Limitar longitud del texto para evitar problemas
+    return clean if len(clean)<=200 else clean[:197]+"..."
+
+def origin_for(uid):
+    return "Producto" if uid in dev_team_member_set else "Otras áreas"
+
+_origin_cache=None
+
+def load_origin_cache():
+    """
+    Cache de clasificación de origen (en memoria durante el proceso, persistido entre runs):
+    {"groups": {usergroup: [uids]}, "groups_at": epoch, "users": {uid: {"is_bot": bool, "at": epoch}}}.
+    """
+    global _origin_cache
+    if _origin_cache is None:
+        _origin_cache={}
+        try:
+            if origin_cache_path and os.path.exists(origin_cache_path):
+                with open(origin_cache_path,"r",encoding="utf-8") as f:
+                    c=json.load(f)
+                    if isinstance(c,dict):
+                        _origin_cache=c
+        except Exception as e:
+            print(f"[WARN] No se pudo leer ORIGIN_CACHE_PATH={origin_cache_path}: {e}")
+    return _origin_cache
+
+def save_origin_cache(cache):
+    if not origin_cache_path:
+        return
+    try:
+        atomic_write(origin_cache_path,json.dumps(cache,sort_keys=True))
+    except Exception as e:
+        print(f"[WARN] No se pudo guardar cache de origen en {origin_cache_path}: {e}")
+
+@metrics.timed("slack_origins")
+def refresh_origin_members():
+    """
+    Actualiza dev_team_member_set (DEV_TEAM_MEMBER_IDS + miembros de ORIGIN_USERGROUP_IDS) antes del fetch:
+    origin_for queda como una búsqueda en un set. Los grupos se re-consultan solo si el cache venció;
+    si Slack falla se sigue con el cache anterior.
+    """
+    global dev_team_member_set
+    members=set(dev_team_member_ids)
+    if origin_usergroup_ids:
+        cache=load_origin_cache()
+        groups=cache.get("groups") or {}
+        age=time.time()-float(cache.get("groups_at") or 0)
+        if age>=origin_cache_ttl_seconds or not set(origin_usergroup_ids)<=set(groups):
+            try:
+                groups={g:list(slack_call("usergroups_users_list",usergroup=g).get("users") or []) for g in origin_usergroup_ids}
+                cache["groups"]=groups
+                cache["groups_at"]=time.time()
+                save_origin_cache(cache)
+                print(f"[INFO] User groups de origen actualizados: {', '.join(f'{g} ({len(u)})' for g,u in groups.items())}")
+            except Exception as e:
+                if groups:
+                    print(f"[WARN] No se pudieron consultar los user groups ({e}); usando cache de hace {age/60:.0f} min")
+                else:
+                    print(f"[WARN] No se pudieron consultar los user groups ({e}); solo DEV_TEAM_MEMBER_IDS")
+        for g in origin_usergroup_ids:
+            members.update(groups.get(g) or [])
+    dev_team_member_set=members
+
+def apply_bot_origins(recs):
+    """
+    Con ORIGIN_BOT_LABEL: los mensajes de usuarios bot pasan a ese origen. users.info se consulta
+    una vez por usuario distinto (fuera del equipo) y vencimiento del cache, nunca por mensaje,
+    en paralelo bajo su propio limitador (SLACK_USERS_RATE_PER_MINUTE).
+    """
+    if not origin_bot_label:
+        return
+    cache=load_origin_cache()
+    users=cache.setdefault("users",{})
+    now=time.time()
+    uids={r.user for r in recs if r.user and r.user not in dev_team_member_set}
+    stale=[u for u in uids if now-float((users.get(u) or {}).get("at") or 0)>=origin_cache_ttl_seconds]
+    if stale:
+        with ThreadPoolExecutor(max_workers=max(1,min(slack_fetch_workers,len(stale)))) as ex:
+            futures={ex.submit(slack_call,"users_info",user=u):u for u in stale}
+            for f in as_completed(futures):
+                u=futures[f]
+                try:
+                    info=f.result().get("user") or {}
+                    users[u]={"is_bot":bool(info.get("is_bot")),"at":now}
+                except Exception as e:
+                    print(f"[WARN] users.info {u}: {e}")
+        save_origin_cache(cache)
+    bots={u for u in uids if (users.get(u) or {}).get("is_bot")}
+    for r in recs:
+        if r.user in bots:
+            r.origin=origin_bot_label
+
+class MessageRecord:
+    """
+    Mensaje Slack reducido a lo que termina en la hoja: el dict crudo (blocks, attachments,
+    reactions, ...) se descarta al recibir cada página.
+    """
+    __slots__=("ts","user","origin","text","channel","reply_count","latest_reply","first_response_ts")
+
+    def __init__(self, ts, user, origin, text, channel, reply_count=0, latest_reply=None, first_response_ts=None):
+        self.ts=ts
+        self.user=user
+        self.origin=origin
+        self.text=text
+        self.channel=channel
+        self.reply_count=reply_count
+        self.latest_reply=latest_reply
+        self.first_response_ts=first_response_ts
+
+    @classmethod
+    def from_message(cls, m, channel):
+        uid=m.get("user")
+        return cls(
+            m.get("ts",""),
+            uid,
+            origin_for(uid) if uid else None,
+            clean_excel_text(m.get("text")),
+            channel,
+            int(m.get("reply_count") or 0),
+            m.get("latest_reply"),
+        )
+
+def iter_messages(oldest=None, latest=None, channel=None, on_page=None):
+    """
+    Pagina conversations.history de un canal y entrega MessageRecord página a página
+    (del más nuevo al más viejo, orden de Slack): en memoria queda solo la página actual.
+    on_page(registros) se llama con cada página antes de entregarla (desde el hilo del fetch).
+    """
+    channel=channel or channel_id
     cur=None
     while True:
-        res=c.conversations_history(
-            channel=channel_id,
+        res=slack_call(
+            "conversations_history",
+            channel=channel,
             limit=1000,
             cursor=cur,
             oldest=oldest,
             latest=latest
         )
-        out.extend(res.get("messages",[]))
+        metrics.inc("slack_pages")
+        metrics.inc("slack_messages",len(res.get("messages",[])))
+        page=[MessageRecord.from_message(m,channel) for m in res.get("messages",[])]
+        if on_page is not None:
+            on_page(page)
+        yield from page
         cur=res.get("response_metadata",{}).get("next_cursor")
         if not cur:
             break
+
+def fetch_messages(oldest=None, latest=None, channel=None, on_page=None):
+    """Registros de un canal en la ventana, del más viejo al más nuevo."""
+    out=list(iter_messages(oldest,latest,channel,on_page))
+    out.reverse()
     return out
 
-def tz_dt(ts):
-    return datetime.fromtimestamp(float(ts),tz=timezone.utc).astimezone(ZoneInfo("America/Santiago"))
+@metrics.timed("slack_fetch")
+def fetch_channels(windows, on_page=None):
+    """
+    Fetch concurrente de varios canales: windows={channel: (oldest, latest)}.
+    Cada canal pagina con su propio cursor. Retorna todos los registros, del más viejo al más nuevo.
+    on_page: ver iter_messages; con varios canales se llama desde hilos distintos.
+    """
+    if len(windows)==1:
+        (ch,(oldest,latest)),=windows.items()
+        return fetch_messages(oldest=oldest,latest=latest,channel=ch,on_page=on_page)
+    with ThreadPoolExecutor(max_workers=max(1,min(slack_fetch_workers,len(windows)))) as ex:
+        futures={ch:ex.submit(fetch_messages,oldest,latest,ch,on_page) for ch,(oldest,latest) in windows.items()}
+        recs=[]
+        for ch,f in futures.items():
+            got=f.result()
+            print(f"[INFO] Canal {ch}: {len(got)} mensajes")
+            recs.extend(got)
+    recs.sort(key=lambda r: float(r.ts or 0))
+    return recs
+
+def load_replies_cache() -> dict:
+    """Cache de hilos: {"<channel>:<thread_ts>": {"latest_reply": ts, "first_response_ts": ts|None}}."""
+    try:
+        if replies_cache_path and os.path.exists(replies_cache_path):
+            with open(replies_cache_path,"r",encoding="utf-8") as f:
+                c=json.load(f)
+                if isinstance(c,dict):
+                    return c
+    except Exception as e:
+        print(f"[WARN] No se pudo leer REPLIES_CACHE_PATH={replies_cache_path}: {e}")
+    return {}
 
-def build_df(msgs):
-    datos=[]
-    for m in reversed(msgs):
-        uid=m.get("user")
-        if not uid:
-            continue
-        dt=tz_dt(m.get("ts"))
-        origen="Producto" if uid in dev_team_member_ids else "Otras áreas"
-        
-        # Crear enlace clickeable al mensaje de Slack
-        ts = m.get("ts", "")
-        # Formatear timestamp correctamente para Slack (formato: p1234567890123456)
-        ts_formatted = ts.replace('.', '')
-        slack_link = f"https://mq-sede.slack.com/archives/{channel_id}/p{ts_formatted}"
-        slack_text = m.get("text", "")
-        
-        # Limpiar texto para evitar caracteres problemáticos en Excel
-        if slack_text:
-            # Escapar comillas y caracteres especiales
-            clean_text = slack_text.replace('"', '""').replace('\n', ' ').replace('\r', ' ')
-            # Limitar longitud del texto para evitar problemas
-            if len(clean_text) > 200:
-                clean_text = clean_text[:197] + "..."
-            slack_content = f'=HYPERLINK("{slack_link}","{clean_text}")'
+def save_replies_cache(cache):
+    if not replies_cache_path:
+        return
+    try:
+        atomic_write(replies_cache_path,json.dumps(cache,sort_keys=True))
+    except Exception as e:
+        print(f"[WARN] No se pudo guardar cache de hilos en {replies_cache_path}: {e}")
+
+def first_response_ts(parent):
+    """ts de la primera respuesta del hilo escrita por alguien distinto al autor, o None."""
+    cur=None
+    while True:
+        res=slack_call("conversations_replies",channel=parent.channel,ts=parent.ts,limit=200,cursor=cur)
+        for r in res.get("messages",[]):
+            # El primer elemento es el mensaje padre; las respuestas vienen en orden cronológico
+            if r.get("ts")!=parent.ts and r.get("user") and r.get("user")!=parent.user:
+                return r["ts"]
+        cur=res.get("response_metadata",{}).get("next_cursor")
+        if not cur:
+            return None
+
+@metrics.timed("slack_replies")
+def enrich_with_replies(recs):
+    """
+    Completa first_response_ts de cada registro con hilo (tiempo a la primera respuesta).
+    Solo consulta conversations.replies (en paralelo, con tope SLACK_REPLIES_CONCURRENCY)
+    para hilos nuevos o cuyo latest_reply cambió y aún no tienen primera respuesta.
+    """
+    threads=[r for r in recs if r.reply_count>0 and r.ts]
+    if not threads:
+        return
+    cache=load_replies_cache()
+    pending=[]
+    for r in threads:
+        key=f"{r.channel}:{r.ts}"
+        hit=cache.get(key)
+        # La primera respuesta no cambia una vez encontrada; sin ella, solo re-consultar si el hilo cambió
+        if hit and (hit.get("first_response_ts") or hit.get("latest_reply")==r.latest_reply):
+            r.first_response_ts=hit.get("first_response_ts")
         else:
-            slack_content = ""
-        
-        datos.append({
-            "Fecha aproximada":dt.strftime("%Y-%m-%d %H:%M:%S"),
-            "Origen":origen,
-            "SLACK":slack_content,
-            "Diagnóstico causa raíz":"",
-            "Propuesta (Tarea en ClickUp cuando sea desarrollable /Cambio sistema)":"",
-            "ESTADO FINAL":""
-        })
-    cols=["Fecha aproximada","Origen","SLACK","Diagnóstico causa raíz","Propuesta (Tarea en ClickUp cuando sea desarrollable /Cambio sistema)","ESTADO FINAL"]
-    return pd.DataFrame(datos,columns=cols) if datos else pd.DataFrame(columns=cols)
+            pending.append((key,r))
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1,slack_replies_concurrency)) as ex:
+            results=list(ex.map(lambda kr: first_response_ts(kr[1]),pending))
+        for (key,r),first in zip(pending,results):
+            r.first_response_ts=first
+            cache[key]={"latest_reply":r.latest_reply,"first_response_ts":first}
+        save_replies_cache(cache)
+    print(f"[INFO] Hilos: {len(threads)} ({len(pending)} consultados, {len(threads)-len(pending)} desde cache)")
+
+SCL_TZ=ZoneInfo("America/Santiago")
+
+def sheet_columns():
+    """Columnas de las filas generadas: las visibles, la clave oculta y (opcional) las de hilos."""
+    return SHEET_COLUMNS+[KEY_COLUMN]+(REPLY_COLUMNS if fetch_replies else [])
+
+def slack_url(channel, ts):
+    """Enlace al mensaje (formato p1234567890123456)."""
+    return f"https://mq-sede.slack.com/archives/{channel}/p{ts.replace('.','')}"
+
+def slack_cell(rec):
+    """Fórmula HYPERLINK al mensaje, o "" si no tiene texto."""
+    if not rec.text:
+        return ""
+    return f'=HYPERLINK("{slack_url(rec.channel,rec.ts)}","{rec.text}")'
+
+DELETED_TEXT="[eliminado en Slack]"
+
+def deleted_cell(key):
+    """Celda SLACK de un mensaje borrado: mantiene el enlace, reemplaza el texto."""
+    channel,ts=key.split(":",1)
+    return f'=HYPERLINK("{slack_url(channel,ts)}","{DELETED_TEXT}")'
+
+def text_hash(value):
+    """Hash corto del contenido de la celda SLACK, para detectar ediciones sin comparar texto."""
+    return hashlib.blake2b(str(value or "").encode("utf-8"),digest_size=8).hexdigest()
+
+def reply_hash(values):
+    """
+    Hash del resumen de hilo (columnas de REPLY_COLUMNS), normalizado para que coincida igual
+    recién armado, leído con openpyxl o desde la workbook API ("" / None / 3.0).
+    """
+    count,minutes=(list(values)+[None,None])[:2]
+    count=int(float(count)) if count not in (None,"") else 0
+    minutes=round(float(minutes),1) if minutes not in (None,"") else ""
+    return text_hash(f"{count}|{minutes}")
+
+def index_entry(row, n):
+    """(key, fila, hash del texto, hash del hilo o None, día, origen) de una fila para DedupIndex.add."""
+    rh=reply_hash(row[KEY_INDEX+1:]) if fetch_replies and len(row)>KEY_INDEX+1 else None
+    day=str(row[0])[:10] if row[0] else None
+    return (row[KEY_INDEX],n,text_hash(row[2] if len(row)>2 else None),rh,day,row[1] if len(row)>1 else None)
+
+def first_response_minutes(rec):
+    if not rec.first_response_ts:
+        return ""
+    return round((float(rec.first_response_ts)-float(rec.ts))/60,1)
+
+def record_rows(recs):
+    """Filas de hoja para registros con usuario, en Python puro (lotes chicos, sin pandas)."""
+    rows=[]
+    for r in recs:
+        if not r.user:
+            continue
+        # Segundos enteros (ts Slack tiene 6 decimales)
+        dt=datetime.fromtimestamp(int(r.ts.split(".",1)[0]),tz=SCL_TZ)
+        row=[dt.strftime("%Y-%m-%d %H:%M:%S"),r.origin,slack_cell(r),"","","",f"{r.channel}:{r.ts}"]
+        if fetch_replies:
+            row+=[r.reply_count,first_response_minutes(r)]
+        rows.append(row)
+    return rows
+
+def build_df(recs):
+    """
+    Arma el DataFrame de filas a partir de los registros (del más viejo al más nuevo),
+    con operaciones por columna: una conversión de zona horaria para todo el lote
+    (lo caro por fila en backfills grandes) y fórmulas HYPERLINK vectorizadas.
+    """
+    import numpy as np
+    import pandas as pd
+    cols=sheet_columns()
+    recs=[r for r in recs if r.user]
+    if not recs:
+        return pd.DataFrame(columns=cols)
+
+    ts=pd.Series([r.ts for r in recs],dtype=object)
+    channel=pd.Series([r.channel for r in recs],dtype=object)
+    text=pd.Series([r.text for r in recs],dtype=object)
+    # Segundos enteros (ts Slack tiene 6 decimales: el truncado no cruza de segundo)
+    secs=np.floor(pd.to_numeric(ts).to_numpy()).astype("int64")
+    local=pd.to_datetime(secs,unit="s",utc=True).tz_convert("America/Santiago").tz_localize(None)
+    # Formato "%Y-%m-%d %H:%M:%S" en C (strftime con zona horaria es lento por fila)
+    fecha=np.char.replace(np.datetime_as_string(local.to_numpy().astype("datetime64[s]")),"T"," ")
+
+    # Enlace clickeable al mensaje y texto (ya limpio en el registro)
+    slack_link="https://mq-sede.slack.com/archives/"+channel+"/p"+ts.str.replace(".","",regex=False)
+    slack=('=HYPERLINK("'+slack_link+'","'+text+'")').where(text!="","")
+
+    df=pd.DataFrame({
+        "Fecha aproximada":fecha.astype(object),
+        "Origen":[r.origin for r in recs],
+        "SLACK":slack.values,
+        KEY_COLUMN:(channel+":"+ts).values,
+    })
+    for c in SHEET_COLUMNS[3:]:
+        df[c]=""
+    if fetch_replies:
+        df["Respuestas"]=[r.reply_count for r in recs]
+        df["Primera respuesta (min)"]=[first_response_minutes(r) for r in recs]
+    return df[cols]
+
+@metrics.timed("build_rows")
+def build_rows(recs):
+    """Filas de hoja: pandas solo para lotes grandes (backfill), Python puro para el caso normal."""
+    if len(recs)>rows_vectorize_threshold:
+        return build_df(recs).values.tolist()
+    return record_rows(recs)
 
 def extract_hyperlink_url(cell_value):
     """
@@ -339,185 +1420,2160 @@ def extract_hyperlink_url(cell_value):
     m = re.match(r'^=HYPERLINK\("([^"]+)"\s*,', s)
     return m.group(1) if m else None
 
-def get_month_name_from_period(df):
-    """Obtiene el nombre del mes del primer día del período"""
-    if df.empty:
-        return "Datos"
-    first_date = df.iloc[0]["Fecha aproximada"]
-    dt = datetime.strptime(first_date, "%Y-%m-%d %H:%M:%S")
-    month_names = ["enero", "febrero", "marzo", "abril", "mayo", "junio",
-                   "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
-    return month_names[dt.month - 1]
+def slack_key_from_url(url):
+    """
+    Deriva la clave "<channel>:<ts>" desde un permalink de Slack
+    (https://<ws>.slack.com/archives/<channel>/p1234567890123456). Si no aplica, retorna None.
+    """
+    if not url:
+        return None
+    m = re.search(r'/archives/([^/]+)/p(\d{7,})$', url)
+    if not m:
+        return None
+    digits = m.group(2)
+    return f"{m.group(1)}:{digits[:-6]}.{digits[-6:]}"
 
-def apply_table_style(ws, num_rows):
-    """Aplica estilo profesional a la tabla"""
-    if num_rows <= 1:  # Solo header o sin datos
-        return
-    
-    try:
-        # Definir estilos
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-        
-        data_font = Font(size=11)
-        data_alignment = Alignment(vertical="top", wrap_text=True)
-        
-        # Borde para todas las celdas
-        thin_border = Border(
-            left=Side(style='thin', color='000000'),
-            right=Side(style='thin', color='000000'),
-            top=Side(style='thin', color='000000'),
-            bottom=Side(style='thin', color='000000')
-        )
-        
-        # Aplicar estilo al header (fila 1)
-        for col in range(1, min(ws.max_column + 1, 7)):  # Limitar a 6 columnas
-            cell = ws.cell(row=1, column=col)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
-            cell.border = thin_border
-        
-        # Aplicar estilo a las filas de datos
-        for row in range(2, min(num_rows + 1, ws.max_row + 1)):
-            for col in range(1, min(ws.max_column + 1, 7)):  # Limitar a 6 columnas
-                cell = ws.cell(row=row, column=col)
-                cell.font = data_font
-                cell.alignment = data_alignment
-                cell.border = thin_border
-        
-        # Ajustar ancho de columnas (valores más grandes para evitar tablas pequeñas)
-        column_widths = {
-            'A': 25,  # Fecha aproximada
-            'B': 18,  # Origen
-            'C': 60,  # SLACK
-            'D': 35,  # Diagnóstico causa raíz
-            'E': 45,  # Propuesta
-            'F': 25   # ESTADO FINAL
-        }
-        
-        for col_letter, width in column_widths.items():
-            ws.column_dimensions[col_letter].width = width
-        
-        # Ajustar altura de filas (altura más grande para mejor legibilidad)
-        max_rows = min(num_rows, 200)  # Aumentar límite
-        for row in range(1, max_rows + 1):
-            ws.row_dimensions[row].height = 40  # Aumentar altura de filas
-        
-        # Asegurar que el zoom esté al 100%
-        ws.sheet_view.zoomScale = 100
-        
-        print(f"[INFO] Estilo aplicado: {max_rows} filas, columnas ajustadas")
-            
-    except Exception as e:
-        print(f"[WARN] Error aplicando estilo: {e}")
-        # Continuar sin estilo si hay problemas
+def row_dedup_key(row):
+    """Clave de duplicado de una fila existente: columna oculta, URL del mensaje o contenido crudo."""
+    if len(row) > 6 and row[6]:
+        return str(row[6]).strip()
+    if len(row) >= 3 and row[2]:
+        slack_content = str(row[2]).strip()
+        url = extract_hyperlink_url(slack_content)
+        return slack_key_from_url(url) or url or slack_content
+    return None
 
-def append_rows(wb,df):
-    if df.empty:
-        return
-    
-    hoja = get_month_name_from_period(df)
-    
-    # Verificar si la hoja ya existe
-    if hoja not in wb.sheetnames:
-        ws=wb.create_sheet(title=hoja)
-        ws.append(list(df.columns))
-        # Aplicar estilo inmediatamente al crear nueva hoja
-        apply_table_style(ws, 1)
-        print(f"[INFO] Nueva hoja '{hoja}' creada con estilo")
-    else:
+class DedupIndex:
+    """
+    Índice persistente de claves ya escritas: key "<channel>:<ts>" -> (sheet, row, hash del texto,
+    hash del resumen de hilo). Se valida contra ws.max_row de cada hoja; si no coincide (índice
+    perdido o edición manual del workbook) se reconstruye escaneando esa hoja una sola vez.
+    Fila y hashes permiten actualizar ediciones/borrados y respuestas nuevas sin escanear la hoja.
+    Los cambios quedan pendientes hasta commit(), que se llama tras subir el archivo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, sheet TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sheets (sheet TEXT PRIMARY KEY, max_row INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        # Agregados KPI: filas por (día, origen) y ESTADO FINAL de las filas ya archivadas
+        self.db.execute("CREATE TABLE IF NOT EXISTS kpi_daily (day TEXT, origin TEXT, n INTEGER NOT NULL, PRIMARY KEY (day, origin))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS kpi_estado (estado TEXT PRIMARY KEY, n INTEGER NOT NULL)")
+        # ESTADO FINAL de las hojas de meses cerrados que siguen en el workbook (leídas una vez al cerrar)
+        self.db.execute("CREATE TABLE IF NOT EXISTS kpi_folded (sheet TEXT, estado TEXT, n INTEGER NOT NULL, PRIMARY KEY (sheet, estado))")
+        cols = {r[1] for r in self.db.execute("PRAGMA table_info(keys)")}
+        if "row" not in cols:
+            # Índice anterior sin fila/hash: se agregan las columnas y cada hoja se reconstruye a demanda
+            self.db.execute("ALTER TABLE keys ADD COLUMN row INTEGER")
+            self.db.execute("ALTER TABLE keys ADD COLUMN hash TEXT")
+            self.db.execute("DELETE FROM sheets")
+        if "rhash" not in cols:
+            # Sin hash de hilo: las filas con respuestas se re-escriben una vez al re-leerlas
+            self.db.execute("ALTER TABLE keys ADD COLUMN rhash TEXT")
+        if "origin" not in cols:
+            # Día/origen de cada fila (para descontar del KPI las borradas en Slack): se reconstruye a demanda
+            self.db.execute("ALTER TABLE keys ADD COLUMN day TEXT")
+            self.db.execute("ALTER TABLE keys ADD COLUMN origin TEXT")
+            self.db.execute("DELETE FROM sheets")
+        row = self.db.execute("SELECT v FROM meta WHERE k='workbook'").fetchone()
+        if row is None or row[0] != onedrive_file_path:
+            # Índice de otro workbook: se descarta y se reconstruye a demanda
+            self.db.execute("DELETE FROM keys")
+            self.db.execute("DELETE FROM sheets")
+            self.reset_kpi()
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('workbook', ?)", (onedrive_file_path,))
+        self.db.commit()
+
+    def sync_sheet(self, ws, sheet):
+        """Asegura que el índice refleja la hoja; reconstruye si el conteo de filas no coincide."""
+        self.sync_rows(sheet, ws.max_row, lambda: ws.iter_rows(min_row=2, max_row=ws.max_row, values_only=True))
+
+    def sync_rows(self, sheet, max_row, load_rows, force=False):
+        """Como sync_sheet, para cualquier origen: load_rows() entrega las filas de datos (desde la 2)."""
+        row = self.db.execute("SELECT max_row FROM sheets WHERE sheet=?", (sheet,)).fetchone()
+        if not force and row is not None and row[0] == max_row:
+            return
+        self.db.execute("DELETE FROM keys WHERE sheet=?", (sheet,))
+        keys = []
+        if max_row > 1:
+            for n, r in enumerate(load_rows(), start=2):
+                k = row_dedup_key(r)
+                if k:
+                    keys.append((k, sheet, *index_entry(r, n)[1:]))
+        self.db.executemany("INSERT OR REPLACE INTO keys (key, sheet, row, hash, rhash, day, origin) VALUES (?, ?, ?, ?, ?, ?, ?)", keys)
+        self.db.execute("INSERT OR REPLACE INTO sheets VALUES (?, ?)", (sheet, max_row))
+        print(f"[INFO] Índice de duplicados reconstruido para hoja '{sheet}': {len(keys)} claves")
+
+    def existing(self, keys):
+        """Subconjunto de keys ya presentes en el índice (consulta O(claves nuevas))."""
+        found = set()
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            q = f"SELECT key FROM keys WHERE key IN ({','.join('?' * len(chunk))})"
+            found.update(k for (k,) in self.db.execute(q, chunk))
+        return found
+
+    def lookup(self, keys):
+        """{key: (sheet, row, hash, rhash)} de las keys presentes."""
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            q = f"SELECT key, sheet, row, hash, rhash FROM keys WHERE key IN ({','.join('?' * len(chunk))})"
+            found.update((k, (sh, r, h, rh)) for k, sh, r, h, rh in self.db.execute(q, chunk))
+        return found
+
+    def keys_between(self, channel, oldest, latest):
+        """
+        {key: (sheet, row, hash, rhash)} de los mensajes del canal con oldest < ts < latest.
+        Las claves "<channel>:<ts>" ordenan como los ts (10 dígitos enteros + 6 decimales).
+        """
+        q = "SELECT key, sheet, row, hash, rhash FROM keys WHERE key > ? AND key < ?"
+        lo, hi = f"{channel}:{float(oldest):017.6f}", f"{channel}:{float(latest):017.6f}"
+        return {k: (sh, r, h, rh) for k, sh, r, h, rh in self.db.execute(q, (lo, hi))}
+
+    def add(self, entries, sheet, max_row):
+        """entries: [(key, row, hash, rhash, day, origin)] recién escritas en la hoja (ver index_entry)."""
+        self.db.executemany("INSERT OR REPLACE INTO keys (key, sheet, row, hash, rhash, day, origin) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [(k, sheet, *rest) for k, *rest in entries])
+        self.db.execute("INSERT OR REPLACE INTO sheets VALUES (?, ?)", (sheet, max_row))
+
+    def record_update(self, update):
+        """
+        Hashes de una actualización de fila ya escrita (ver plan_row_updates); un mensaje
+        borrado en Slack deja de contar en los agregados KPI por día.
+        """
+        key, _, _, value, deleted, replies = update
+        if deleted:
+            row = self.db.execute("SELECT day, origin FROM keys WHERE key=?", (key,)).fetchone()
+            if row and row[0]:
+                self.add_kpi({(row[0], row[1] or ""): -1})
+        if value is not None:
+            self.db.execute("UPDATE keys SET hash=? WHERE key=?", (text_hash(value), key))
+        if replies is not None:
+            self.db.execute("UPDATE keys SET rhash=? WHERE key=?", (reply_hash(replies), key))
+
+    def archive_sheet(self, sheet, label):
+        """
+        La hoja se movió a un workbook de archivo: sus claves quedan (siguen evitando duplicados)
+        bajo otra etiqueta, y una hoja nueva con el mismo nombre se indexa desde cero.
+        """
+        self.db.execute("UPDATE OR REPLACE keys SET sheet=? WHERE sheet=?", (label, sheet))
+        self.db.execute("DELETE FROM sheets WHERE sheet=?", (sheet,))
+        # Su ESTADO FINAL pasa a kpi_estado (rotate_closed_months)
+        self.db.execute("DELETE FROM kpi_folded WHERE sheet=?", (sheet,))
+
+    def other_month_rows(self, sheet, month):
+        """Filas indexadas en la hoja cuyo día no es del mes "YYYY-MM" (p.ej. el mismo mes de otro año)."""
+        return self.db.execute("SELECT COUNT(*) FROM keys WHERE sheet=? AND day IS NOT NULL AND substr(day, 1, 7)!=?", (sheet, month)).fetchone()[0]
+
+    def kpi_seeded(self):
+        return self.db.execute("SELECT 1 FROM meta WHERE k='kpi'").fetchone() is not None
+
+    def reset_kpi(self, daily=None, estado=None):
+        """Reemplaza los agregados KPI (None: los borra y quedan pendientes de reconstruir)."""
+        self.db.execute("DELETE FROM kpi_daily")
+        self.db.execute("DELETE FROM kpi_estado")
+        self.db.execute("DELETE FROM kpi_folded")
+        self.db.execute("DELETE FROM meta WHERE k='kpi'")
+        if daily is not None:
+            self.add_kpi(daily, estado or {})
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('kpi', ?)", (now_scl().isoformat(),))
+
+    def add_kpi(self, daily, estado=None):
+        """Suma a los agregados: daily {(día, origen): n}, estado {ESTADO FINAL: n} (filas archivadas)."""
+        self.db.executemany("INSERT INTO kpi_daily VALUES (?, ?, ?) ON CONFLICT(day, origin) DO UPDATE SET n = n + excluded.n",
+                            [(d, o, n) for (d, o), n in daily.items()])
+        self.db.executemany("INSERT INTO kpi_estado VALUES (?, ?) ON CONFLICT(estado) DO UPDATE SET n = n + excluded.n",
+                            list((estado or {}).items()))
+
+    def kpi_daily(self):
+        return {(d, o): n for d, o, n in self.db.execute("SELECT day, origin, n FROM kpi_daily WHERE n != 0")}
+
+    def kpi_estado(self):
+        return dict(self.db.execute("SELECT estado, n FROM kpi_estado"))
+
+    def folded_sheets(self):
+        return {s for (s,) in self.db.execute("SELECT DISTINCT sheet FROM kpi_folded")}
+
+    def fold_estado(self, sheet, estado):
+        """Guarda el ESTADO FINAL de una hoja de mes cerrado (ya no se lee en cada run)."""
+        self.db.execute("DELETE FROM kpi_folded WHERE sheet=?", (sheet,))
+        # Marcador con n=0 para que una hoja vacía también quede registrada
+        self.db.executemany("INSERT INTO kpi_folded VALUES (?, ?, ?)", [(sheet, e, n) for e, n in estado.items()] or [(sheet, NO_ESTADO, 0)])
+
+    def unfold_estado(self, sheet):
+        self.db.execute("DELETE FROM kpi_folded WHERE sheet=?", (sheet,))
+
+    def folded_estado(self):
+        return Counter(dict(self.db.execute("SELECT estado, SUM(n) FROM kpi_folded GROUP BY estado")))
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+def open_dedup_index():
+    """Abre el índice local; si falla, se usa el escaneo completo de la hoja."""
+    if not dedup_index_path:
+        return None
+    try:
+        return DedupIndex(dedup_index_path)
+    except Exception as e:
+        print(f"[WARN] No se pudo abrir DEDUP_INDEX_PATH={dedup_index_path}: {e}")
+        return None
+
+MONTH_NAMES = ["enero", "febrero", "marzo", "abril", "mayo", "junio",
+               "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
+
+def group_by_month(rows):
+    """
+    Divide las filas por mes calendario de "Fecha aproximada" (hora Chile) en [(hoja, filas)],
+    en orden de aparición: una ventana que cruza fin de mes escribe cada fila en su hoja.
+    """
+    groups = {}
+    for r in rows:
+        groups.setdefault(MONTH_NAMES[int(r[0][5:7]) - 1], []).append(r)
+    return list(groups.items())
+
+HEADER_STYLE="kpi_header"
+DATA_STYLE="kpi_data"
+COLUMN_WIDTHS={
+    'A': 25,  # Fecha aproximada
+    'B': 18,  # Origen
+    'C': 60,  # SLACK
+    'D': 35,  # Diagnóstico causa raíz
+    'E': 45,  # Propuesta
+    'F': 25,  # ESTADO FINAL
+    'H': 14,  # Respuestas
+    'I': 22   # Primera respuesta (min)
+}
+
+def ensure_table_styles(wb):
+    """Registra (una vez por workbook) los estilos con nombre del header y de las filas de datos."""
+    existing = set(wb.named_styles)
+    if HEADER_STYLE in existing and DATA_STYLE in existing:
+        return
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+    # Borde para todas las celdas
+    thin = Side(style='thin', color='000000')
+    thin_border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    if HEADER_STYLE not in existing:
+        wb.add_named_style(NamedStyle(
+            name=HEADER_STYLE,
+            font=Font(bold=True, color="FFFFFF", size=12),
+            fill=PatternFill(start_color="366092", end_color="366092", fill_type="solid"),
+            alignment=Alignment(horizontal="center", vertical="center", wrap_text=True),
+            border=thin_border,
+        ))
+    if DATA_STYLE not in existing:
+        wb.add_named_style(NamedStyle(
+            name=DATA_STYLE,
+            font=Font(size=11),
+            alignment=Alignment(vertical="top", wrap_text=True),
+            border=thin_border,
+        ))
+
+def styled_columns(ws):
+    """Columnas visibles de la tabla: A-F y las de hilos (H en adelante); la G es la clave oculta."""
+    return list(range(1, KEY_INDEX + 1)) + list(range(KEY_INDEX + 2, ws.max_column + 1))
+
+def style_header(ws):
+    """Estilo del header (fila 1), anchos de columna y zoom; se aplica al crear/recrear la hoja."""
+    try:
+        ensure_table_styles(ws.parent)
+        for col in styled_columns(ws):
+            ws.cell(row=1, column=col).style = HEADER_STYLE
+        ws.row_dimensions[1].height = 40
+        for col_letter, width in COLUMN_WIDTHS.items():
+            ws.column_dimensions[col_letter].width = width
+        # Asegurar que el zoom esté al 100%
+        ws.sheet_view.zoomScale = 100
+    except Exception as e:
+        print(f"[WARN] Error aplicando estilo al header: {e}")
+
+@metrics.timed("style_rows")
+def style_rows(ws, first_row, last_row):
+    """Estilo de filas de datos [first_row, last_row]: solo las agregadas en este run."""
+    if last_row < first_row:
+        return
+    try:
+        ensure_table_styles(ws.parent)
+        cols = styled_columns(ws)
+        for row in range(first_row, last_row + 1):
+            for col in cols:
+                ws.cell(row=row, column=col).style = DATA_STYLE
+            ws.row_dimensions[row].height = 40
+    except Exception as e:
+        print(f"[WARN] Error aplicando estilo a filas {first_row}-{last_row}: {e}")
+
+@metrics.timed("apply_table_style")
+def apply_table_style(ws, num_rows):
+    """Aplica estilo profesional a toda la tabla (restyle completo; el flujo normal usa style_rows)."""
+    style_header(ws)
+    style_rows(ws, 2, min(num_rows, ws.max_row))
+
+def prepare_month_sheet(wb, hoja, columns):
+    """Obtiene (o crea) la hoja del mes con su header vigente y la columna oculta de claves."""
+    if hoja not in wb.sheetnames:
+        ws=wb.create_sheet(title=hoja)
+        ws.append(columns)
+        # Aplicar estilo inmediatamente al crear nueva hoja
+        style_header(ws)
+        print(f"[INFO] Nueva hoja '{hoja}' creada con estilo")
+    else:
         ws=wb[hoja]
-        if ws.max_row==1 and [c.value for c in ws[1]]!=list(df.columns):
+        if ws.max_row==1 and [c.value for c in ws[1]]!=columns:
             ws.delete_rows(1,ws.max_row)
-            ws.append(list(df.columns))
+            ws.append(columns)
             # Aplicar estilo cuando se recrea el header
-            apply_table_style(ws, 1)
+            style_header(ws)
             print(f"[INFO] Header de hoja '{hoja}' recreado con estilo")
+    # Hojas previas a la columna de claves (o a las columnas de hilos): completar su header
+    for col, name in enumerate(columns[KEY_INDEX:], start=KEY_INDEX + 1):
+        if ws.cell(row=1, column=col).value != name:
+            ws.cell(row=1, column=col, value=name)
+            if name != KEY_COLUMN:
+                style_header(ws)
+    ws.column_dimensions[KEY_COLUMN_LETTER].hidden = True
+    return ws
+
+@metrics.timed("append_rows")
+def append_rows(wb,rows,index=None):
+    """
+    Agrega las filas (ver build_rows) que no existan, cada una en la hoja de su mes.
+    Una sola pasada por los datos: por hoja, un chequeo de header y un conjunto de claves.
+    Retorna las claves agregadas.
+    """
+    if not rows:
+        return []
     
-    # Obtener claves existentes para verificar duplicados (preferimos URL del mensaje de Slack)
-    existing_keys = set()
-    if ws.max_row > 1:  # Si hay datos además del header
-        for row in ws.iter_rows(min_row=2, max_row=ws.max_row, values_only=True):
-            if len(row) >= 3 and row[2]:  # SLACK column (índice 2)
-                slack_content = str(row[2]).strip()
-                url = extract_hyperlink_url(slack_content)
-                existing_keys.add(url or slack_content)
-    
-    # Agregar solo mensajes nuevos
-    new_rows_added = 0
-    for _,r in df.iterrows():
-        slack_content = str(r["SLACK"]).strip()
-        if slack_content:
-            key = extract_hyperlink_url(slack_content) or slack_content
+    columns = sheet_columns()
+    new_keys = []
+    for hoja, group in group_by_month(rows):
+        ws = prepare_month_sheet(wb, hoja, columns)
+        group = [r for r in group if str(r[2]).strip()]
+        
+        # Claves existentes para verificar duplicados: índice persistente si está disponible,
+        # si no, escaneo completo de la hoja (preferimos la clave oculta / URL del mensaje de Slack)
+        if index is not None:
+            index.sync_sheet(ws, hoja)
+            existing_keys = index.existing(r[KEY_INDEX] for r in group)
+        else:
+            existing_keys = set()
+            if ws.max_row > 1:  # Si hay datos además del header
+                for row in ws.iter_rows(min_row=2, max_row=ws.max_row, values_only=True):
+                    k = row_dedup_key(row)
+                    if k:
+                        existing_keys.add(k)
+        
+        # Agregar solo mensajes nuevos, en bloque
+        fresh = []
+        for r in group:
+            key = r[KEY_INDEX]
             if key and key not in existing_keys:
-                ws.append(list(r.values))
                 existing_keys.add(key)
-                new_rows_added += 1
-    
-    print(f"[INFO] Filas nuevas agregadas: {new_rows_added} (duplicados ignorados: {len(df) - new_rows_added})")
-    
-    # Aplicar estilo a la tabla siempre (incluso si no hay filas nuevas)
-    if ws.max_row > 1:  # Si hay datos además del header
-        apply_table_style(ws, ws.max_row)
-        print(f"[INFO] Estilo aplicado a la tabla")
+                fresh.append(r)
+        first_new_row = ws.max_row + 1
+        for r in fresh:
+            ws.append(r)
+        sheet_keys = [r[KEY_INDEX] for r in fresh]
+        if index is not None:
+            index.add([index_entry(r, n) for n, r in enumerate(fresh, start=first_new_row)], hoja, ws.max_row)
+            index.add_kpi(kpi_counts(fresh))
+        new_keys.extend(sheet_keys)
+        
+        metrics.inc("duplicates_skipped",len(group)-len(fresh))
+        print(f"[INFO] Hoja '{hoja}': filas nuevas agregadas: {len(fresh)} (duplicados ignorados: {len(group) - len(fresh)})")
+        
+        # Estilo solo para las filas agregadas en este run
+        if fresh:
+            style_rows(ws, first_new_row, ws.max_row)
     
     if "Sheet" in wb.sheetnames and wb["Sheet"].max_row==1 and wb["Sheet"].max_column==1 and wb["Sheet"]["A1"].value is None:
         wb.remove(wb["Sheet"])
+    return new_keys
 
-def main():
-    print(f"[INFO] Inicio ejecución: {now_scl()}")
-    token=acquire_token()
-    print("[INFO] Access token obtenido")
+class EditWindow:
+    """
+    Lo necesario para reflejar ediciones/borrados de Slack en filas ya escritas:
+    la celda SLACK actual de cada mensaje re-leído, su resumen de hilo, las claves
+    vistas y el rango (oldest, latest) efectivamente consultado por canal.
+    """
 
-    ensure_file(token)
+    def __init__(self, cells, seen, windows, sheets, replies=None):
+        self.cells=cells      # key -> celda SLACK actual
+        self.seen=seen        # keys devueltas por Slack (con o sin texto)
+        self.windows=windows  # canal -> (oldest, latest) en epoch
+        self.sheets=sheets    # hojas de mes que cubre la ventana
+        self.replies=replies or {}  # key -> valores actuales de REPLY_COLUMNS (SLACK_FETCH_REPLIES=1)
 
-    # Ejecutar siempre, sin restricción de hora
-    print(f"[INFO] Ejecutando sin restricción de hora (debug_mode: {debug_mode})")
+def edit_window(recs, rows, since, latest):
+    """EditWindow de los mensajes desde since (epoch) hasta latest, o None si el seguimiento está desactivado."""
+    if since is None:
+        return None
+    window=[r for r in rows if float(r[KEY_INDEX].split(":",1)[1])>since]
+    cells={r[KEY_INDEX]:r[2] for r in window if str(r[2]).strip()}
+    replies={r[KEY_INDEX]:r[KEY_INDEX+1:] for r in window} if fetch_replies else {}
+    seen={f"{r.channel}:{r.ts}" for r in recs}
+    sheets=[]
+    day=datetime.fromtimestamp(since,tz=SCL_TZ).replace(day=1)
+    end=datetime.fromtimestamp(float(latest),tz=SCL_TZ)
+    while (day.year,day.month)<=(end.year,end.month):
+        sheets.append(MONTH_NAMES[day.month-1])
+        day=(day+timedelta(days=32)).replace(day=1)
+    return EditWindow(cells,seen,{ch:(since,float(latest)) for ch in channel_ids},sheets,replies)
 
-    # Últimos 4 días (en horario Chile): desde 00:00 del día (hoy - 3) hasta ahora
-    now_local = now_scl()
-    start_local = now_local.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=3)
-    oldest = str(start_local.astimezone(timezone.utc).timestamp())
-    latest = str(datetime.now(tz=timezone.utc).timestamp())
-    print(f"[INFO] Ventana Slack últimos 4 días (hora Chile): {start_local} hasta {now_local}")
-    msgs = fetch_messages(oldest=oldest, latest=latest)
-
-    print(f"[INFO] Mensajes obtenidos: {len(msgs)}")
-    df=build_df(msgs)
-    if df.empty:
-        print("[INFO] No hay mensajes nuevos")
+def plan_row_updates(index, edits, present):
+    """
+    Compara la ventana re-leída contra el índice: [(key, hoja, fila, celda SLACK nueva o None,
+    borrado, resumen de hilo nuevo o None)] para los mensajes editados (hash distinto), los
+    borrados (en el índice pero ya no en Slack) y los hilos con respuestas nuevas.
+    Solo hojas presentes en el workbook activo (las archivadas no se tocan).
+    """
+    updates=[]
+    for key,(sheet,row,h,rh) in index.lookup(set(edits.cells)|set(edits.replies)).items():
+        if sheet not in present or not row:
+            continue
+        value=edits.cells.get(key)
+        if value is not None and h==text_hash(value):
+            value=None
+        replies=edits.replies.get(key)
+        if replies is not None and rh==reply_hash(replies):
+            replies=None
+        if value is not None or replies is not None:
+            updates.append((key,sheet,row,value,False,replies))
+    for ch,(oldest,latest) in edits.windows.items():
+        for key,(sheet,row,h,_) in index.keys_between(ch,oldest,latest).items():
+            if key in edits.seen or sheet not in present or not row:
+                continue
+            value=deleted_cell(key)
+            if h!=text_hash(value):
+                updates.append((key,sheet,row,value,True,None))
+    return updates
+
+def update_cells(update):
+    """{columna: valor} que escribe una actualización: C si cambió el texto, las de hilo si cambió el hilo."""
+    _,_,_,value,_,replies=update
+    cells={} if value is None else {"C":value}
+    for j,v in enumerate(replies or ()):
+        cells[chr(ord(KEY_COLUMN_LETTER)+1+j)]=v
+    return cells
+
+def count_row_updates(updates):
+    deleted=sum(1 for u in updates if u[4])
+    metrics.inc("rows_updated",sum(1 for u in updates if u[3] is not None and not u[4]))
+    metrics.inc("rows_deleted",deleted)
+    metrics.inc("threads_updated",sum(1 for u in updates if u[5] is not None))
+
+def row_updates_summary(updates):
+    """Línea de log de las actualizaciones aplicadas."""
+    deleted=sum(1 for u in updates if u[4])
+    edited=sum(1 for u in updates if u[3] is not None and not u[4])
+    threads=sum(1 for u in updates if u[5] is not None)
+    return f"ediciones en Slack: {edited}, marcadas como eliminadas: {deleted}, hilos con respuestas nuevas: {threads}"
+
+def verified_row_updates(index, edits, present, keys_at, resync):
+    """
+    plan_row_updates con la clave oculta verificada: keys_at(hoja, filas) -> {fila: clave} lee la
+    columna G. Si alguna no coincide (filas movidas a mano) resync(hoja) reconstruye el índice de
+    esa hoja y se planifica una vez más; lo que siga desalineado se omite en este run.
+    """
+    for attempt in range(2):
+        by_sheet={}
+        for u in plan_row_updates(index,edits,present):
+            by_sheet.setdefault(u[1],[]).append(u)
+        stale=set()
+        valid=[]
+        for hoja,group in by_sheet.items():
+            keys=keys_at(hoja,[u[2] for u in group])
+            for u in group:
+                if keys.get(u[2])==u[0]:
+                    valid.append(u)
+                else:
+                    stale.add(hoja)
+        if not stale:
+            return valid
+        if attempt:
+            print(f"[WARN] Filas desalineadas con el índice en {', '.join(sorted(stale))}; se omiten sus ediciones en este run")
+            return valid
+        for hoja in stale:
+            resync(hoja)
+
+@metrics.timed("update_rows")
+def apply_row_updates(wb, edits, index):
+    """
+    Actualiza in situ la celda SLACK de los mensajes editados o borrados dentro de la ventana y
+    el resumen de los hilos con respuestas nuevas, ubicándolos por el índice (sin escanear la
+    hoja). Las columnas del analista (D-F) no se tocan.
+    Antes de escribir se verifica la clave oculta de la fila; si no coincide (filas movidas a mano)
+    se reconstruye el índice de esa hoja. Retorna las actualizaciones aplicadas.
+    """
+    if edits is None or index is None:
+        return []
+    present=[h for h in edits.sheets if h in wb.sheetnames]
+    for hoja in present:
+        index.sync_sheet(wb[hoja],hoja)
+
+    def keys_at(hoja, rows):
+        ws=wb[hoja]
+        return {r: ws.cell(row=r,column=KEY_INDEX+1).value for r in rows}
+
+    def resync(hoja):
+        ws=wb[hoja]
+        index.sync_rows(hoja,ws.max_row,lambda: ws.iter_rows(min_row=2,max_row=ws.max_row,values_only=True),force=True)
+
+    applied=verified_row_updates(index,edits,present,keys_at,resync)
+    for u in applied:
+        for col,value in update_cells(u).items():
+            wb[u[1]][f"{col}{u[2]}"].value=value
+        index.record_update(u)
+    if applied:
+        print(f"[INFO] Filas actualizadas por {row_updates_summary(applied)}")
+    return applied
+
+INDEX_SHEET="Índice"
+INDEX_COLUMNS=["Año","Mes","Filas","Archivo","Actualizado"]
+
+def month_closed(year, month, now_local):
+    """El mes terminó hace al menos ARCHIVE_GRACE_DAYS días (margen para mensajes tardíos/solape)."""
+    month_end=datetime(year+(month==12),month%12+1,1,tzinfo=SCL_TZ)
+    return now_local>=month_end+timedelta(days=archive_grace_days)
+
+def closed_row_date(value, now_local):
+    """La fecha de la fila ("YYYY-MM-DD ...") es de un mes cerrado; False si no se reconoce."""
+    fecha=str(value or "")
+    return fecha[:4].isdigit() and fecha[5:7].isdigit() and month_closed(int(fecha[:4]),int(fecha[5:7]),now_local)
+
+def archive_path(year):
+    return archive_file_path.format(year=year)
+
+def open_archive(token, path):
+    """Workbook de archivo del año (o uno nuevo si no existe) y su metadata (None si es nuevo)."""
+    from openpyxl import load_workbook
+    from openpyxl.workbook import Workbook
+    r=http_request("GET",drive_item_url(path),headers={"Authorization":f"Bearer {token}"})
+    if r.status_code==404:
+        return Workbook(), None
+    if r.status_code>=400:
+        raise RuntimeError(f"archivo: metadata de {path} (status {r.status_code})")
+    data=gget(drive_item_url(path,":/content"),token).content
+    metrics.inc("download_bytes",len(data))
+    return load_workbook(io.BytesIO(data)), item_meta(r)
+
+def copy_rows_to_archive(awb, hoja, header, rows):
+    """Agrega a la hoja del archivo las filas que aún no tiene (por clave) y les da estilo. Retorna cuántas."""
+    ws=prepare_month_sheet(awb,hoja,header)
+    existing={row_dedup_key(r) for r in ws.iter_rows(min_row=2,values_only=True)} if ws.max_row>1 else set()
+    first=ws.max_row+1
+    added=0
+    for r in rows:
+        k=row_dedup_key(r)
+        if k and k in existing:
+            continue
+        existing.add(k)
+        ws.append(list(r))
+        added+=1
+    style_rows(ws,first,ws.max_row)
+    return added
+
+def update_archive_index(wb, entries):
+    """Hoja índice del workbook activo: una fila por (año, mes) archivado con el link al workbook del año."""
+    if INDEX_SHEET in wb.sheetnames:
+        ws=wb[INDEX_SHEET]
+    else:
+        ws=wb.create_sheet(title=INDEX_SHEET)
+        ws.append(INDEX_COLUMNS)
+        ensure_table_styles(wb)
+        for col in range(1,len(INDEX_COLUMNS)+1):
+            ws.cell(row=1,column=col).style=HEADER_STYLE
+        for col_letter,width in zip("ABCDE",(8,14,10,45,22)):
+            ws.column_dimensions[col_letter].width=width
+    rows={(r[0].value,r[1].value):r for r in ws.iter_rows(min_row=2)}
+    stamp=now_scl().strftime("%Y-%m-%d %H:%M")
+    for year,hoja,count,path,web_url in entries:
+        name=path.rsplit("/",1)[-1]
+        link=f'=HYPERLINK("{web_url}","{name}")' if web_url else path
+        cells=rows.get((year,hoja))
+        if cells is None:
+            ws.append([year,hoja,count,link,stamp])
+            for col in range(1,len(INDEX_COLUMNS)+1):
+                ws.cell(row=ws.max_row,column=col).style=DATA_STYLE
+        else:
+            cells[2].value=(cells[2].value or 0)+count
+            cells[3].value=link
+            cells[4].value=stamp
+
+@metrics.timed("rotate_archive")
+def rotate_closed_months(token, wb, index=None):
+    """
+    Mueve las hojas de meses cerrados al workbook de archivo de su año (ARCHIVE_FILE_PATH),
+    subido una vez por año afectado, y las quita del workbook activo dejando una fila en la
+    hoja índice. Una hoja solo se quita si todos sus archivos se subieron bien; re-ejecutar
+    es seguro (las filas ya archivadas se reconocen por clave).
+    """
+    if not archive_rotation:
         return
-    print(f"[INFO] Filas a agregar: {len(df)}")
-    print("[DEBUG] Preview:\n", df.head(5).to_string())
+    now_local=now_scl()
+    by_year={}  # año -> [(hoja, header, filas)]
+    pending={}  # hoja -> años que faltan subir
+    estados={}  # hoja -> {ESTADO FINAL: n}, pasan a los agregados KPI al salir del workbook activo
+    for hoja in [h for h in wb.sheetnames if h in MONTH_NAMES]:
+        ws=wb[hoja]
+        if ws.max_row<2 or open_month(hoja,now_local):
+            continue
+        # Primera y última fila antes de leer la hoja completa: solo se recorre la que se va a archivar
+        if not all(closed_row_date(ws.cell(row=n,column=1).value,now_local) for n in (2,ws.max_row)):
+            continue
+        header=[c.value for c in ws[1]]
+        rows=list(ws.iter_rows(min_row=2,values_only=True))
+        years={}
+        try:
+            for r in rows:
+                fecha=str(r[0] or "")
+                y,m=int(fecha[0:4]),int(fecha[5:7])
+                if not month_closed(y,m,now_local):
+                    raise ValueError("mes abierto")
+                years.setdefault(y,[]).append(r)
+        except ValueError:
+            continue  # mes en curso (o fecha no reconocible): la hoja se queda
+        for y,yrows in years.items():
+            by_year.setdefault(y,[]).append((hoja,header,yrows))
+        pending[hoja]=set(years)
+        estados[hoja]=estado_counts(r[5] if len(r)>5 else None for r in rows)
+    if not by_year:
+        return
+
+    entries=[]
+    for year,sheets in sorted(by_year.items()):
+        path=archive_path(year)
+        try:
+            awb,ameta=open_archive(token,path)
+            moved=[(hoja,copy_rows_to_archive(awb,hoja,header,rows)) for hoja,header,rows in sheets]
+            for name in ("Sheet","TMP"):
+                if name in awb.sheetnames and len(awb.sheetnames)>1 and awb[name].max_row==1 and awb[name]["A1"].value is None:
+                    awb.remove(awb[name])
+            out=io.BytesIO()
+            awb.save(out)
+            metrics.inc("upload_bytes",len(out.getvalue()))
+            r=put_workbook(token,path,out.getvalue(),(ameta or {}).get("eTag"))
+        except Exception as e:
+            print(f"[WARN] No se pudo archivar {year} en {path}: {e}; las hojas quedan en el workbook activo")
+            continue
+        web_url=item_meta(r).get("webUrl")
+        for hoja,count in moved:
+            pending[hoja].discard(year)
+            entries.append((year,hoja,count,path,web_url))
+            metrics.inc("archived_rows",count)
+        print(f"[INFO] Archivo {path}: {', '.join(f'{h} ({n} filas)' for h,n in moved)}")
+
+    if entries:
+        # Antes de quitar hojas: el workbook nunca queda sin hojas
+        update_archive_index(wb,entries)
+    archived=[hoja for hoja,years in pending.items() if not years]
+    for hoja in archived:
+        wb.remove(wb[hoja])
+        if index is not None:
+            index.archive_sheet(hoja,f"archivo:{hoja}")
+            index.add_kpi({},estados[hoja])
+    if archived:
+        print(f"[INFO] Hojas archivadas y quitadas del workbook activo: {', '.join(archived)}")
+
+KPI_SHEET="Resumen KPI"
+KPI_ORIGINS=["Producto","Otras áreas"]
+NO_ESTADO="(sin estado)"
+
+def kpi_counts(rows):
+    """{(día, origen): filas} de filas de hoja (Fecha aproximada, Origen, ...), sin las borradas en Slack."""
+    return Counter((str(r[0])[:10],r[1] or "") for r in rows if r[0] and not (len(r)>2 and DELETED_TEXT in str(r[2] or "")))
+
+def estado_counts(values):
+    """{ESTADO FINAL: filas} de los valores de la columna F."""
+    return Counter(str(v).strip() if v is not None and str(v).strip() else NO_ESTADO for v in values)
+
+def month_sheet_rows(wb):
+    """Filas de datos (con fecha) de las hojas de mes del workbook."""
+    for hoja in [h for h in wb.sheetnames if h in MONTH_NAMES]:
+        for r in wb[hoja].iter_rows(min_row=2,values_only=True):
+            if r and r[0]:
+                yield r
+
+def sheet_estado(ws):
+    """ESTADO FINAL (columna F) de una hoja de mes."""
+    return estado_counts(v for (v,) in ws.iter_rows(min_row=2,min_col=6,max_col=6,values_only=True))
+
+def open_month(hoja, now_local):
+    """La hoja de mes sigue abierta: mes en curso (o el último con ese nombre) dentro de ARCHIVE_GRACE_DAYS."""
+    month=MONTH_NAMES.index(hoja)+1
+    year=now_local.year if month<=now_local.month else now_local.year-1
+    return not month_closed(year,month,now_local)
+
+def kpi_estado_total(index, sheets, scan):
+    """
+    ESTADO FINAL de la hoja resumen: filas archivadas + hojas de meses cerrados (leídas una sola
+    vez al cerrar el mes; kpi-rebuild las vuelve a leer) + lectura en vivo solo de las hojas de
+    meses abiertos, que son las que el analista sigue editando. scan(hoja) -> Counter de la columna F.
+    """
+    now_local=now_scl()
+    folded=index.folded_sheets()
+    live=Counter()
+    for hoja in [h for h in sheets if h in MONTH_NAMES]:
+        if open_month(hoja,now_local):
+            if hoja in folded:
+                # Mismo nombre un año después (sin rotación): la hoja vuelve a recibir filas
+                index.unfold_estado(hoja)
+            live+=scan(hoja)
+        elif hoja not in folded:
+            index.fold_estado(hoja,scan(hoja))
+    return Counter(index.kpi_estado())+index.folded_estado()+live
+
+@metrics.timed("kpi_seed")
+def seed_kpi(token, wb, index):
+    """
+    Reconstruye desde cero los agregados KPI: filas del workbook activo y de los workbooks de
+    archivo listados en la hoja índice (sin duplicar claves). Es el único punto que lee todo el
+    historial; en cada run los agregados solo suman las filas nuevas. Retorna (daily, estado).
+    """
+    years=set()
+    if INDEX_SHEET in wb.sheetnames:
+        years={int(r[0]) for r in wb[INDEX_SHEET].iter_rows(min_row=2,max_col=1,values_only=True) if r[0]}
+    return seed_kpi_rows(token,month_sheet_rows(wb),years,index)
+
+def seed_kpi_api(token, sid, names, index):
+    """Como seed_kpi, leyendo el workbook activo por la Excel API (usedRange de cada hoja de mes), sin descargarlo."""
+    years=set()
+    if INDEX_SHEET in names:
+        n=used_row_count(token,sid,INDEX_SHEET)
+        if n>1:
+            vals=wb_call(token,sid,"GET",worksheet_path(INDEX_SHEET,f"/range(address='A2:A{n}')?$select=values")).get("values",[])
+            years={int(v[0]) for v in vals if v and str(v[0]).strip().isdigit()}
+
+    def rows():
+        for hoja in [h for h in MONTH_NAMES if h in names]:
+            n=used_row_count(token,sid,hoja)
+            if n>1:
+                yield from (r for r in sheet_rows_loader(token,sid,hoja,n)() if r and r[0])
+
+    return seed_kpi_rows(token,rows(),years,index)
+
+def seed_kpi_rows(token, active_rows, years, index):
+    """seed_kpi sobre las filas del workbook activo y los años archivados (hoja índice)."""
+    daily=Counter()
+    estado=Counter()
+    seen=set()
+    sources=[(active_rows,False)]
+    for year in sorted(years):
+        awb,ameta=open_archive(token,archive_path(year))
+        if ameta is None:
+            print(f"[WARN] KPI: workbook de archivo {archive_path(year)} no encontrado; se omite")
+            continue
+        sources.append((month_sheet_rows(awb),True))
+    for src,archived in sources:
+        fresh=[]
+        for r in src:
+            k=row_dedup_key(r)
+            if k and k in seen:
+                continue
+            seen.add(k)
+            fresh.append(r)
+        daily.update(kpi_counts(fresh))
+        if archived:
+            estado.update(estado_counts(r[5] if len(r)>5 else None for r in fresh))
+    index.reset_kpi(daily,estado)
+    # Refleja el workbook descargado, no lo que este run agregue: se persiste de inmediato
+    index.commit()
+    print(f"[INFO] Agregados KPI reconstruidos: {sum(daily.values())} filas, {len({d for d,_ in daily})} días, {len(sources)-1} workbook(s) de archivo")
+    return daily,estado
+
+def kpi_tables(daily, estado):
+    """Bloques de la hoja resumen: [(columna inicial, header, filas)] por semana, por día y por ESTADO FINAL."""
+    from datetime import date
+    origins=KPI_ORIGINS+sorted({o for _,o in daily}-set(KPI_ORIGINS))
+    by_day={}
+    for (d,o),n in daily.items():
+        by_day.setdefault(d,Counter())[o]+=n
+    by_week={}
+    for d,counts in by_day.items():
+        day=date.fromisoformat(d)
+        y,w,_=day.isocalendar()
+        monday=day-timedelta(days=day.weekday())
+        by_week.setdefault((y,w,monday.isoformat()),Counter()).update(counts)
+
+    def line(counts):
+        total=sum(counts.values())
+        return [counts.get(o,0) for o in origins]+[total,counts.get("Otras áreas",0)/total if total else 0]
+
+    tail=["Total","% Otras áreas"]
+    weekly=[[f"{y}-S{w:02d}",monday]+line(c) for (y,w,monday),c in sorted(by_week.items(),reverse=True)]
+    days=[[d]+line(c) for d,c in sorted(by_day.items(),reverse=True)]
+    estados=[[e,n] for e,n in sorted(estado.items(),key=lambda x:(-x[1],x[0])) if n]
+    week_header=["Semana","Desde"]+origins+tail
+    day_header=["Día"]+origins+tail
+    day_col=len(week_header)+1
+    estado_col=day_col+len(day_header)+1
+    return [("A",week_header,weekly),
+            (chr(ord("A")+day_col),day_header,days),
+            (chr(ord("A")+estado_col),["ESTADO FINAL","Filas"],estados)]
+
+@metrics.timed("kpi_summary")
+def write_kpi_sheet(wb, index):
+    """
+    Re-escribe la hoja "Resumen KPI" desde los agregados persistidos (más el ESTADO FINAL
+    vigente de las hojas activas), sin recorrer el historial. Retorna True si la escribió.
+    """
+    if not kpi_summary or index is None:
+        return False
+    estado=kpi_estado_total(index,wb.sheetnames,lambda hoja: sheet_estado(wb[hoja]))
+    if KPI_SHEET in wb.sheetnames:
+        ws=wb[KPI_SHEET]
+        ws.delete_rows(1,ws.max_row)
+    else:
+        ws=wb.create_sheet(title=KPI_SHEET)
+    ensure_table_styles(wb)
+    for col_letter,header,rows in kpi_tables(index.kpi_daily(),estado):
+        first=ord(col_letter)-ord("A")+1
+        for j,name in enumerate(header):
+            ws.cell(row=1,column=first+j,value=name).style=HEADER_STYLE
+            ws.column_dimensions[chr(ord(col_letter)+j)].width=16
+        for i,r in enumerate(rows,start=2):
+            for j,v in enumerate(r):
+                c=ws.cell(row=i,column=first+j,value=v)
+                c.style=DATA_STYLE
+                if header[j].startswith("%"):
+                    c.number_format="0.0%"
+    return True
+
+def write_kpi_sheet_api(token, sid, names, index):
+    """Como write_kpi_sheet, sobre el workbook remoto (sesión sid): solo lee la columna F de los meses abiertos."""
+    if not kpi_summary or index is None:
+        return False
+
+    def scan(hoja):
+        n=used_row_count(token,sid,hoja)
+        if n<2:
+            return Counter()
+        vals=wb_call(token,sid,"GET",worksheet_path(hoja,f"/range(address='F2:F{n}')?$select=values")).get("values",[])
+        return estado_counts(v[0] for v in vals)
+
+    estado=kpi_estado_total(index,names,scan)
+    if KPI_SHEET not in names:
+        wb_call(token,sid,"POST","/worksheets/add",{"name":KPI_SHEET})
+        names.add(KPI_SHEET)
+    else:
+        wb_call(token,sid,"POST",worksheet_path(KPI_SHEET,"/usedRange/clear"),{"applyTo":"All"})
+    calls=[]
+    for col_letter,header,rows in kpi_tables(index.kpi_daily(),estado):
+        last=chr(ord(col_letter)+len(header)-1)
+        calls.append(("PATCH",worksheet_path(KPI_SHEET,f"/range(address='{col_letter}1:{last}{len(rows)+1}')"),{"values":[header]+rows}))
+        calls+=range_style_calls(KPI_SHEET,f"{col_letter}1:{last}1",header=True)
+        if rows:
+            calls+=range_style_calls(KPI_SHEET,f"{col_letter}2:{last}{len(rows)+1}",header=False)
+            if header[-1].startswith("%"):
+                calls.append(("PATCH",worksheet_path(KPI_SHEET,f"/range(address='{last}2:{last}{len(rows)+1}')"),{"numberFormat":[["0.0%"]]*len(rows)}))
+    wb_batch(token,sid,calls)
+    return True
+
+def workbook_api_path(suffix):
+    """Ruta relativa (para $batch) de un recurso de la Graph Excel API del workbook."""
+    return drive_item_url(onedrive_file_path,f":/workbook{suffix}")[len(graph_base_url):]
+
+def worksheet_path(sheet, suffix=""):
+    return f"/worksheets('{quote(sheet)}'){suffix}"
+
+def wb_call(token, session_id, method, suffix, body=None):
+    """Llamada simple a la Graph Excel API dentro de la sesión de workbook."""
+    headers={"Authorization":f"Bearer {token}"}
+    if session_id:
+        headers["workbook-session-id"]=session_id
+    r=http_request(method,graph_base_url+workbook_api_path(suffix),headers=headers,json=body)
+    if r.status_code>=400:
+        raise RuntimeError(f"workbook: {method} {suffix} falló (status {r.status_code}): {r.text[:500]}")
+    return item_meta(r)
+
+def wb_batch(token, session_id, calls):
+    """
+    Envía [(method, suffix, body)] en requests $batch (máx. 20 por lote) y falla si alguno falló.
+    Graph no garantiza el orden dentro de un lote: cada request depende del anterior (dependsOn),
+    así el append va antes que su formato y las actualizaciones siguientes; los lotes van en secuencia.
+    """
+    for i in range(0,len(calls),20):
+        reqs=[]
+        for n,(method,suffix,body) in enumerate(calls[i:i+20]):
+            req={
+                "id":str(n+1),
+                "method":method,
+                "url":workbook_api_path(suffix),
+                "headers":{"Content-Type":"application/json","workbook-session-id":session_id},
+                "body":body,
+            }
+            if n:
+                req["dependsOn"]=[str(n)]
+            reqs.append(req)
+        r=http_request("POST",f"{graph_base_url}/$batch",headers={"Authorization":f"Bearer {token}"},json={"requests":reqs})
+        if r.status_code>=400:
+            raise RuntimeError(f"workbook: $batch falló (status {r.status_code}): {r.text[:500]}")
+        failed=[x for x in r.json().get("responses",[]) if int(x.get("status",500))>=400]
+        if failed:
+            raise RuntimeError(f"workbook: $batch con {len(failed)} errores: {str(failed[0])[:500]}")
+
+def range_style_calls(sheet, address, header):
+    """Formato de un rango A:F como apply_table_style (header o filas de datos), en llamadas Graph."""
+    base=worksheet_path(sheet,f"/range(address='{address}')/format")
+    calls=[("PATCH",base,{"verticalAlignment":"Center" if header else "Top","wrapText":True,"rowHeight":40,
+                          **({"horizontalAlignment":"Center"} if header else {})}),
+           ("PATCH",base+"/font",{"bold":True,"color":"#FFFFFF","size":12} if header else {"size":11})]
+    if header:
+        calls.append(("PATCH",base+"/fill",{"color":"#366092"}))
+    for edge in ("EdgeTop","EdgeBottom","EdgeLeft","EdgeRight","InsideVertical","InsideHorizontal"):
+        calls.append(("PATCH",base+f"/borders('{edge}')",{"style":"Continuous","color":"#000000"}))
+    return calls
+
+@metrics.timed("append_rows_api")
+def append_rows_api(token, rows, index=None, edits=None):
+    """
+    Backend "workbook_api": agrega las filas nuevas directamente en el workbook remoto
+    (sesión de Graph Excel API), sin descargar ni subir el xlsx. Solo viajan las filas
+    nuevas y su formato; cada fila va a la hoja de su mes. Con edits también actualiza
+    las filas de mensajes editados/borrados; al final re-escribe la hoja resumen KPI.
+    Retorna las claves agregadas.
+    """
+    if not rows and edits is None and not (kpi_summary and index is not None):
+        return []
+    sid=wb_call(token,None,"POST","/createSession",{"persistChanges":True}).get("id")
+    try:
+        names={w.get("name") for w in wb_call(token,sid,"GET","/worksheets?$select=name").get("value",[])}
+        if kpi_summary and index is not None and not index.kpi_seeded():
+            seed_kpi_api(token,sid,names,index)
+        new_keys=[]
+        for hoja,group in group_by_month(rows):
+            new_keys.extend(append_sheet_rows_api(token,sid,names,hoja,group,index))
+        apply_row_updates_api(token,sid,names,edits,index)
+        write_kpi_sheet_api(token,sid,names,index)
+        return new_keys
+    finally:
+        try:
+            wb_call(token,sid,"POST","/closeSession")
+        except Exception as e:
+            print(f"[WARN] No se pudo cerrar la sesión de workbook: {e}")
+
+def sheet_rows_loader(token, sid, hoja, max_row):
+    """load_rows para DedupIndex.sync_rows sobre una hoja remota (hasta la última columna de hilos)."""
+    def load_rows():
+        # Fórmulas (no valores): la celda SLACK se compara/indexa como se escribió
+        last_col=chr(ord("A")+len(sheet_columns())-1)
+        vals=wb_call(token,sid,"GET",worksheet_path(hoja,f"/range(address='A2:{last_col}{max_row}')?$select=formulas")).get("formulas",[])
+        return [tuple(v) for v in vals]
+    return load_rows
+
+def used_row_count(token, sid, hoja):
+    used=wb_call(token,sid,"GET",worksheet_path(hoja,"/usedRange(valuesOnly=true)?$select=address,rowCount"))
+    return int(used.get("rowCount") or 1)
+
+def apply_row_updates_api(token, sid, names, edits, index):
+    """Como apply_row_updates, sobre el workbook remoto: verifica la clave oculta y parcha solo las celdas cambiadas."""
+    if edits is None or index is None:
+        return []
+    present=[h for h in edits.sheets if h in names]
+    sizes={}
+    for hoja in present:
+        sizes[hoja]=used_row_count(token,sid,hoja)
+        index.sync_rows(hoja,sizes[hoja],sheet_rows_loader(token,sid,hoja,sizes[hoja]))
+
+    def keys_at(hoja, rows):
+        lo,hi=min(rows),max(rows)
+        col=KEY_COLUMN_LETTER
+        vals=wb_call(token,sid,"GET",worksheet_path(hoja,f"/range(address='{col}{lo}:{col}{hi}')?$select=values")).get("values",[])
+        return {lo+i: v[0] for i,v in enumerate(vals)}
+
+    def resync(hoja):
+        index.sync_rows(hoja,sizes[hoja],sheet_rows_loader(token,sid,hoja,sizes[hoja]),force=True)
+
+    applied=verified_row_updates(index,edits,present,keys_at,resync)
+    if applied:
+        wb_batch(token,sid,[("PATCH",worksheet_path(u[1],f"/range(address='{col}{u[2]}')"),{"formulas":[[value]]})
+                            for u in applied for col,value in update_cells(u).items()])
+    for u in applied:
+        index.record_update(u)
+    if applied:
+        count_row_updates(applied)
+        print(f"[INFO] Filas actualizadas por {row_updates_summary(applied)} (workbook API)")
+    return applied
+
+def append_sheet_rows_api(token, sid, names, hoja, group, index):
+    """Filas de un mes a su hoja remota, dentro de la sesión sid; retorna las claves agregadas."""
+    cols=sheet_columns()
+    last_col=chr(ord("A")+len(cols)-1)
+    if hoja not in names:
+        wb_call(token,sid,"POST","/worksheets/add",{"name":hoja})
+        names.add(hoja)
+        calls=[("PATCH",worksheet_path(hoja,f"/range(address='A1:{last_col}1')"),{"formulas":[cols]})]
+        calls+=range_style_calls(hoja,"A1:F1",header=True)
+        if len(cols)>KEY_INDEX+1:
+            calls+=range_style_calls(hoja,f"H1:{last_col}1",header=True)
+        for col,w in COLUMN_WIDTHS.items():
+            calls.append(("PATCH",worksheet_path(hoja,f"/range(address='{col}:{col}')/format"),{"columnWidth":w*5.25}))
+        calls.append(("PATCH",worksheet_path(hoja,f"/range(address='{KEY_COLUMN_LETTER}:{KEY_COLUMN_LETTER}')"),{"columnHidden":True}))
+        wb_batch(token,sid,calls)
+        print(f"[INFO] Nueva hoja '{hoja}' creada con estilo (workbook API)")
+        max_row=1
+    else:
+        max_row=used_row_count(token,sid,hoja)
+
+    load_rows=sheet_rows_loader(token,sid,hoja,max_row)
+    candidates=[r for r in group if str(r[2]).strip()]
+    if index is not None:
+        index.sync_rows(hoja,max_row,load_rows)
+        existing_keys=index.existing(r[KEY_INDEX] for r in candidates)
+    else:
+        existing_keys={row_dedup_key(r) for r in (load_rows() if max_row>1 else [])}
+    rows=[]
+    new_keys=[]
+    for r in candidates:
+        key=r[KEY_INDEX]
+        if key and key not in existing_keys:
+            rows.append(r)
+            existing_keys.add(key)
+            new_keys.append(key)
+    first=max_row+1
+    if rows:
+        first,last=max_row+1,max_row+len(rows)
+        calls=[("PATCH",worksheet_path(hoja,f"/range(address='A{first}:{last_col}{last}')"),{"formulas":rows}),
+               # Hojas previas a la columna de claves (o de hilos): header y columna oculta
+               ("PATCH",worksheet_path(hoja,f"/range(address='{KEY_COLUMN_LETTER}1:{last_col}1')"),{"formulas":[cols[KEY_INDEX:]]}),
+               ("PATCH",worksheet_path(hoja,f"/range(address='{KEY_COLUMN_LETTER}:{KEY_COLUMN_LETTER}')"),{"columnHidden":True})]
+        calls+=range_style_calls(hoja,f"A{first}:F{last}",header=False)
+        if len(cols)>KEY_INDEX+1:
+            calls+=range_style_calls(hoja,f"H{first}:{last_col}{last}",header=False)
+        wb_batch(token,sid,calls)
+        max_row=last
+    if index is not None:
+        index.add([index_entry(r,n) for n,r in enumerate(rows,start=first)],hoja,max_row)
+        index.add_kpi(kpi_counts(rows))
+    metrics.inc("rows_added",len(new_keys))
+    metrics.inc("duplicates_skipped",len(group)-len(new_keys))
+    print(f"[INFO] Hoja '{hoja}': filas nuevas agregadas (workbook API): {len(new_keys)} (duplicados ignorados: {len(group) - len(new_keys)})")
+    return new_keys
+
+class WarmState:
+    """
+    Lo que el modo daemon conserva entre ciclos: el índice de duplicados abierto y el
+    workbook ya parseado, válido mientras el tag remoto siga siendo el de nuestra última subida.
+    """
 
-    bio=dl_excel(token)
+    def __init__(self):
+        self.index=None
+        self.wb=None
+        self.wb_tag=None
+
+    def workbook(self, meta):
+        tag=cache_tag(meta)
+        wb=self.wb if tag and tag==self.wb_tag else None
+        # Se va a modificar: hasta subirlo con éxito no corresponde a ninguna versión remota
+        self.wb=self.wb_tag=None
+        return wb
+
+    def keep_workbook(self, wb, meta):
+        self.wb=wb
+        self.wb_tag=cache_tag(meta)
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index=None
+        self.wb=self.wb_tag=None
+
+def open_workbook(token, meta, warm=None):
+    """Descarga (o toma del cache) y parsea el workbook; si no se puede leer, crea uno nuevo."""
+    wb=warm.workbook(meta) if warm is not None else None
+    if wb is not None:
+        print(f"[INFO] Workbook sin cambios remotos (tag {cache_tag(meta)}), reutilizando el parseado en memoria")
+        metrics.inc("workbook_warm_hits")
+        return wb
+    from openpyxl import load_workbook
+    from openpyxl.workbook import Workbook
+    bio=dl_excel(token,meta)
     try:
-        wb=load_workbook(bio)
+        with metrics.span("load_workbook"):
+            wb=load_workbook(bio)
         print("[INFO] Excel cargado")
     except:
         wb=Workbook()
         wb.active.title="TMP"
         print("[WARN] Excel nuevo creado")
+    return wb
 
-    append_rows(wb,df)
-    if not df.empty:
-        sheet_name = get_month_name_from_period(df)
-        print(f"[INFO] Datos procesados en hoja '{sheet_name}'")
+NS_MAIN="http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_DOC_REL="http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PKG_REL="http://schemas.openxmlformats.org/package/2006/relationships"
+SHEET_DATA_RE=re.compile(r"<sheetData\b[^>]*?(/?)>")
+DIMENSION_RE=re.compile(r'(<dimension\b[^>]*?\bref=")([A-Z]+\d+)(?::([A-Z]+)(\d+))?(")')
+XML_ROW_RE=re.compile(r"\s*(<row\b[^>]*?/>|<row\b[^>]*?>.*?</row>)",re.S)
+XML_ROW_NUM_RE=re.compile(r'<row\b[^>]*?\br="(\d+)"')
+XML_CELL_STYLE_RE=re.compile(r'<c\b[^>]*?\br="([A-Z]+)\d+"[^>]*?\bs="(\d+)"')
+XML_CELL_RE=re.compile(r"<c\b[^>]*?(?:/>|>.*?</c>)",re.S)
+XML_ATTR_R_RE=re.compile(r'\br="([A-Z]+)\d+"')
+XML_ATTR_S_RE=re.compile(r'\bs="(\d+)"')
+XML_ATTR_T_RE=re.compile(r'\bt="(\w+)"')
+XML_V_RE=re.compile(r"<v>(.*?)</v>",re.S)
+XML_T_RE=re.compile(r"<t\b[^>]*>(.*?)</t>",re.S)
+ILLEGAL_XML_RE=re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+class StreamingFallback(RuntimeError):
+    """Este run necesita el modo completo (hoja nueva, rotación, header distinto, ...)."""
+
+def xlsx_sheet_parts(zf):
+    """{nombre de hoja: ruta de su parte XML dentro del zip}, desde workbook.xml y sus relaciones."""
+    import xml.etree.ElementTree as ET
+    targets={r.get("Id"):r.get("Target") for r in ET.fromstring(zf.read("xl/_rels/workbook.xml.rels")).iter(f"{{{NS_PKG_REL}}}Relationship")}
+    parts={}
+    for sh in ET.fromstring(zf.read("xl/workbook.xml")).iter(f"{{{NS_MAIN}}}sheet"):
+        target=targets.get(sh.get(f"{{{NS_DOC_REL}}}id")) or ""
+        parts[sh.get("name")]=target.lstrip("/") if target.startswith("/") else "xl/"+target
+    return parts
+
+def xlsx_style_ids(zf):
+    """Índices en cellXfs de los estilos con nombre (header, datos) y del formato 0.0% sobre el de datos."""
+    import xml.etree.ElementTree as ET
+    st=ET.fromstring(zf.read("xl/styles.xml"))
+    named={cs.get("name"):cs.get("xfId") for cs in st.iter(f"{{{NS_MAIN}}}cellStyle")}
+    formats={nf.get("numFmtId"):nf.get("formatCode") for nf in st.iter(f"{{{NS_MAIN}}}numFmt")}
+    xfs=list(st.find(f"{{{NS_MAIN}}}cellXfs") or [])
+    ids={}
+    for i,xf in enumerate(xfs):
+        for name in (HEADER_STYLE,DATA_STYLE):
+            if name not in ids and xf.get("xfId")==named.get(name) and xf.get("numFmtId","0")=="0":
+                ids[name]=str(i)
+        if "percent" not in ids and xf.get("xfId")==named.get(DATA_STYLE) and formats.get(xf.get("numFmtId"))=="0.0%":
+            ids["percent"]=str(i)
+    return ids
+
+def xml_cell(ref, value, style=None):
+    """Celda SpreadsheetML: fórmula si empieza con "=", número, o texto inline (sin tabla de strings compartidos)."""
+    from xml.sax.saxutils import escape
+    s=f' s="{style}"' if style else ""
+    if value is None or value=="":
+        return f'<c r="{ref}"{s}/>'
+    if isinstance(value,(int,float)) and not isinstance(value,bool):
+        return f'<c r="{ref}"{s}><v>{value}</v></c>'
+    text=ILLEGAL_XML_RE.sub("",str(value))
+    if text.startswith("="):
+        return f'<c r="{ref}"{s}><f>{escape(text[1:])}</f><v></v></c>'
+    return f'<c r="{ref}"{s} t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+def xml_sheet_parts(fin):
+    """
+    Recorre en streaming la parte XML de una hoja, sin construir el árbol: ("head", texto hasta
+    <sheetData>), ("row", <row>...</row>) por fila y ("tail", texto) hasta el final.
+    """
+    text=io.TextIOWrapper(fin,encoding="utf-8")
+    buf=""
+    pos=0
+
+    def more():
+        nonlocal buf, pos
+        chunk=text.read(STREAM_CHUNK)
+        buf=buf[pos:]+chunk
+        pos=0
+        return bool(chunk)
+
+    while not SHEET_DATA_RE.search(buf):
+        if not more():
+            raise StreamingFallback("hoja sin <sheetData>")
+    m=SHEET_DATA_RE.search(buf)
+    if m.group(1):
+        raise StreamingFallback("hoja vacía")
+    yield "head", buf[:m.end()]
+    pos=m.end()
+    while True:
+        while buf[pos:pos+1].isspace():
+            pos+=1
+        if buf.startswith("</sheetData>",pos):
+            break
+        r=XML_ROW_RE.match(buf,pos)
+        if r is None:
+            if not more():
+                raise StreamingFallback("hoja truncada")
+            continue
+        yield "row", r.group(1)
+        pos=r.end()
+    yield "tail", buf[pos:]
+    while True:
+        chunk=text.read(STREAM_CHUNK)
+        if not chunk:
+            return
+        yield "tail", chunk
+
+def xml_row_number(row):
+    num=XML_ROW_NUM_RE.match(row)
+    if num is None:
+        raise StreamingFallback("fila sin número")
+    return int(num.group(1))
+
+def xlsx_shared_strings(zf):
+    """Tabla de strings compartidos del xlsx (texto plano de cada <si>)."""
+    import xml.etree.ElementTree as ET
+    if "xl/sharedStrings.xml" not in zf.namelist():
+        return []
+    strings=[]
+    with zf.open("xl/sharedStrings.xml") as f:
+        for _,el in ET.iterparse(f):
+            if el.tag==f"{{{NS_MAIN}}}si":
+                strings.append("".join(t.text or "" for t in el.iter(f"{{{NS_MAIN}}}t")))
+                el.clear()
+    return strings
+
+def xml_cell_value(cell, shared):
+    """Valor de una celda <c> (string compartido, inline, texto de fórmula o número)."""
+    from xml.sax.saxutils import unescape
+    attrs=cell[:cell.find(">")]
+    t=XML_ATTR_T_RE.search(attrs)
+    t=t.group(1) if t else "n"
+    if t=="inlineStr":
+        return unescape("".join(XML_T_RE.findall(cell)))
+    v=XML_V_RE.search(cell)
+    if v is None:
+        return None
+    v=unescape(v.group(1))
+    if t=="s":
+        return shared[int(v)]
+    if t=="n":
+        try:
+            return int(v)
+        except ValueError:
+            return float(v)
+    return v
+
+def scan_sheet_columns(fin, shared, columns, rows=None):
+    """
+    {columna: {fila: valor}} de las columnas pedidas (p.ej. "F", "G") en las filas de datos
+    (o solo en rows), con regex sobre el XML: bastante más liviano que el modo read_only de openpyxl.
+    """
+    found={c:{} for c in columns}
+    for kind,piece in xml_sheet_parts(fin):
+        if kind!="row":
+            continue
+        n=xml_row_number(piece)
+        if n<2 or (rows is not None and n not in rows):
+            continue
+        for cell in XML_CELL_RE.finditer(piece):
+            ref=XML_ATTR_R_RE.search(cell.group(0)[:cell.group(0).find(">")])
+            if ref and ref.group(1) in found:
+                found[ref.group(1)][n]=xml_cell_value(cell.group(0),shared)
+    return found
+
+def patch_row_xml(row, n, cells, styles, data_style):
+    """
+    <row> n con las celdas {columna: valor} reemplazadas (conservan su estilo); las que no
+    existen se insertan en orden de columna con el estilo de la fila de datos anterior.
+    """
+    for col,value in sorted(cells.items(),key=lambda cv: (len(cv[0]),cv[0])):
+        ref=f"{col}{n}"
+        cell=re.search(rf'<c\b[^>]*?\br="{ref}"[^>]*?(?:/>|>.*?</c>)',row,re.S)
+        if cell is not None:
+            style=XML_ATTR_S_RE.search(cell.group(0)[:cell.group(0).find(">")])
+            row=row[:cell.start()]+xml_cell(ref,value,style.group(1) if style else None)+row[cell.end():]
+            continue
+        pos=row.rfind("</row>")
+        if pos<0:
+            raise StreamingFallback(f"fila {n} sin celdas")
+        for c in XML_CELL_RE.finditer(row):
+            r=XML_ATTR_R_RE.search(c.group(0)[:c.group(0).find(">")])
+            if r and (len(r.group(1)),r.group(1))>(len(col),col):
+                pos=c.start()
+                break
+        row=row[:pos]+xml_cell(ref,value,styles.get(col,data_style))+row[pos:]
+    return row
+
+def rewrite_sheet_xml(fin, fout, first_row, new_rows, cell_updates, data_style):
+    """
+    Re-escribe en streaming la parte XML de una hoja: las filas existentes pasan tal cual (salvo
+    las celdas de cell_updates {fila: {columna: valor}}) y las nuevas se agregan al final de <sheetData> desde
+    first_row, con el estilo de la última fila de datos. Lanza StreamingFallback si la hoja no
+    termina donde el índice esperaba.
+    """
+    out=[]
+    pending=0
+
+    def emit(piece):
+        nonlocal pending
+        out.append(piece)
+        pending+=len(piece)
+        if pending>=STREAM_CHUNK:
+            fout.write("".join(out).encode("utf-8"))
+            out.clear()
+            pending=0
+
+    last_row=first_row-1+len(new_rows)
+
+    def dimension(d):
+        col=d.group(3) or "A"
+        return f"{d.group(1)}{d.group(2)}:{col}{max(int(d.group(4) or 1),last_row)}{d.group(5)}"
+
+    seen=0
+    styles={}
+    appended=False
+    for kind,piece in xml_sheet_parts(fin):
+        if kind=="head":
+            emit(DIMENSION_RE.sub(dimension,piece,count=1))
+        elif kind=="row":
+            n=xml_row_number(piece)
+            if n in cell_updates:
+                piece=patch_row_xml(piece,n,cell_updates[n],styles,data_style)
+            if n>1:
+                styles=dict(XML_CELL_STYLE_RE.findall(piece))
+            seen=n
+            emit(piece)
+        else:
+            if not appended:
+                if seen!=first_row-1:
+                    raise StreamingFallback(f"la hoja termina en la fila {seen}, se esperaba {first_row-1}")
+                for n,values in enumerate(new_rows,start=first_row):
+                    cells=[]
+                    for j,v in enumerate(values):
+                        col=chr(ord("A")+j)
+                        cells.append(xml_cell(f"{col}{n}",v,None if j==KEY_INDEX else styles.get(col,data_style)))
+                    emit(f'<row r="{n}" ht="40" customHeight="1">{"".join(cells)}</row>')
+                appended=True
+            emit(piece)
+    fout.write("".join(out).encode("utf-8"))
+
+def kpi_sheet_xml(tables, style_ids):
+    """Parte XML completa de la hoja resumen KPI (se re-escribe entera, es chica)."""
+    rows={}
+    widths=[]
+    for col_letter,header,body in tables:
+        first=ord(col_letter)-ord("A")
+        widths.append((first+1,first+len(header)))
+        for j,name in enumerate(header):
+            rows.setdefault(1,[]).append(xml_cell(f"{chr(ord(col_letter)+j)}1",name,style_ids.get(HEADER_STYLE)))
+        for i,r in enumerate(body,start=2):
+            for j,v in enumerate(r):
+                style=style_ids.get("percent",style_ids.get(DATA_STYLE)) if header[j].startswith("%") else style_ids.get(DATA_STYLE)
+                rows.setdefault(i,[]).append(xml_cell(f"{chr(ord(col_letter)+j)}{i}",v,style))
+    cols="".join(f'<col min="{a}" max="{b}" width="16" customWidth="1"/>' for a,b in widths)
+    data="".join(f'<row r="{i}">{"".join(cells)}</row>' for i,cells in sorted(rows.items()))
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="{NS_MAIN}">'
+            f"<cols>{cols}</cols><sheetData>{data}</sheetData></worksheet>").encode("utf-8")
+
+def copy_xlsx_parts(src, dst, rewrites):
+    """
+    Copia el xlsx src a dst parte por parte, por bloques (las hojas no tocadas no se parsean);
+    rewrites: {parte: fn(entrada, salida)} para las que cambian.
+    """
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst,"w",zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            zi=zipfile.ZipInfo(info.filename,date_time=info.date_time)
+            zi.compress_type=zipfile.ZIP_DEFLATED
+            zi.external_attr=info.external_attr
+            zi.file_size=info.file_size
+            fn=rewrites.get(info.filename)
+            with zin.open(info) as fin, zout.open(zi,"w") as fout:
+                if fn is None:
+                    shutil.copyfileobj(fin,fout,STREAM_CHUNK)
+                else:
+                    fn(fin,fout)
+
+def streaming_for(meta):
+    """¿Modo streaming para este workbook? (WORKBOOK_STREAMING y tamaño remoto)."""
+    if write_backend=="workbook_api" or workbook_streaming=="0":
+        return False
+    return workbook_streaming=="1" or int((meta or {}).get("size") or 0)>=streaming_threshold_bytes
+
+@metrics.timed("stream_write")
+def write_rows_streaming(token, meta, rows, index, edits):
+    """
+    Modo streaming del backend "file" para workbooks grandes: el xlsx va de un archivo (cache o
+    temporal) a otro sin cargar el modelo completo. Header, dimensión e índice salen del modo
+    read_only; la clave oculta (verificación de ediciones) y ESTADO FINAL se escanean con regex sobre
+    el XML. Las hojas tocadas se re-escriben en streaming; el resto se copia sin parsear. Retorna (archivo de salida, claves nuevas, actualizaciones). Lanza StreamingFallback
+    cuando el run necesita el modo completo: hoja de mes nueva, rotación pendiente, header distinto,
+    hoja resumen inexistente o índice local no disponible.
+    """
+    from openpyxl import load_workbook
+    if index is None:
+        raise StreamingFallback("sin índice local")
+    src=dl_excel_file(token,meta)
+    try:
+        with metrics.span("load_workbook"):
+            ro=load_workbook(src,read_only=True)
+        # segunda vista del zip para escanear el XML de las hojas con regex (F y G)
+        zf=zipfile.ZipFile(src)
+        parts=xlsx_sheet_parts(zf)
+        style_ids=xlsx_style_ids(zf)
+        key_col=chr(ord("A")+KEY_INDEX)
+        strings=[]
+
+        def shared():
+            if not strings:
+                strings.append(xlsx_shared_strings(zf))
+            return strings[0]
+
+        try:
+            if kpi_summary and not index.kpi_seeded():
+                seed_kpi(token,ro,index)
+            if kpi_summary and KPI_SHEET not in ro.sheetnames:
+                raise StreamingFallback("hoja resumen KPI inexistente")
+            if archive_rotation:
+                now_local=now_scl()
+                for hoja in [h for h in ro.sheetnames if h in MONTH_NAMES and not open_month(h,now_local)]:
+                    first=next(ro[hoja].iter_rows(min_row=2,max_row=2,max_col=1,values_only=True),(None,))[0]
+                    if closed_row_date(first,now_local):
+                        raise StreamingFallback(f"rotación pendiente de '{hoja}'")
+
+            columns=sheet_columns()
+            sizes={}
+
+            def prepare(hoja):
+                if hoja not in sizes:
+                    ws=ro[hoja]
+                    header=list(next(ws.iter_rows(max_row=1,values_only=True),()))
+                    if header[:len(columns)]!=columns or any(v is not None for v in header[len(columns):]):
+                        raise StreamingFallback(f"header de '{hoja}' distinto al vigente")
+                    if ws.max_row is None:
+                        raise StreamingFallback(f"hoja '{hoja}' sin dimensión")
+                    sizes[hoja]=ws.max_row
+                    index.sync_rows(hoja,ws.max_row,lambda: ws.iter_rows(min_row=2,max_row=ws.max_row,values_only=True))
+                return sizes[hoja]
+
+            appends={}
+            new_keys=[]
+            for hoja,group in group_by_month(rows):
+                if hoja not in ro.sheetnames:
+                    raise StreamingFallback(f"hoja nueva '{hoja}'")
+                max_row=prepare(hoja)
+                group=[r for r in group if str(r[2]).strip()]
+                existing_keys=index.existing(r[KEY_INDEX] for r in group)
+                fresh=[]
+                for r in group:
+                    if r[KEY_INDEX] and r[KEY_INDEX] not in existing_keys:
+                        existing_keys.add(r[KEY_INDEX])
+                        fresh.append(r)
+                if fresh:
+                    appends[hoja]=fresh
+                    index.add([index_entry(r,n) for n,r in enumerate(fresh,start=max_row+1)],hoja,max_row+len(fresh))
+                    index.add_kpi(kpi_counts(fresh))
+                new_keys.extend(r[KEY_INDEX] for r in fresh)
+                metrics.inc("duplicates_skipped",len(group)-len(fresh))
+                print(f"[INFO] Hoja '{hoja}': filas nuevas agregadas (streaming): {len(fresh)} (duplicados ignorados: {len(group)-len(fresh)})")
+
+            updates=[]
+            if edits is not None:
+                present=[h for h in edits.sheets if h in ro.sheetnames]
+                for hoja in present:
+                    prepare(hoja)
+
+                def keys_at(hoja, wanted):
+                    with zf.open(parts[hoja]) as fin:
+                        return scan_sheet_columns(fin,shared(),[key_col],rows=set(wanted))[key_col]
+
+                def resync(hoja):
+                    ws=ro[hoja]
+                    index.sync_rows(hoja,sizes[hoja],lambda: ws.iter_rows(min_row=2,max_row=sizes[hoja],values_only=True),force=True)
+
+                updates=verified_row_updates(index,edits,present,keys_at,resync)
+                for u in updates:
+                    index.record_update(u)
+                if updates:
+                    print(f"[INFO] Filas actualizadas por {row_updates_summary(updates)}")
+
+            kpi=None
+            if kpi_summary:
+                # ESTADO FINAL leído antes de agregar: las filas nuevas se suman aparte
+
+                def scan(hoja):
+                    size=sizes.get(hoja) or ro[hoja].max_row or 1
+                    with zf.open(parts[hoja]) as fin:
+                        values=scan_sheet_columns(fin,shared(),["F"])["F"]
+                    # Filas sin celda F cuentan como sin estado (igual que sheet_estado); las nuevas se suman aparte
+                    return estado_counts(list(values.values())+[None]*(size-1-len(values))+[r[5] for r in appends.get(hoja,[])])
+
+                with metrics.span("scan_estado"):
+                    kpi=kpi_tables(index.kpi_daily(),kpi_estado_total(index,ro.sheetnames,scan))
+        finally:
+            ro.close()
+            zf.close()
+        rewrites={}
+        cell_updates={}
+        for u in updates:
+            cell_updates.setdefault(u[1],{}).setdefault(u[2],{}).update(update_cells(u))
+        for hoja in set(appends)|set(cell_updates):
+            rewrites[parts[hoja]]=functools.partial(rewrite_sheet_xml,first_row=sizes[hoja]+1,new_rows=appends.get(hoja,[]),
+                                                    cell_updates=cell_updates.get(hoja,{}),data_style=style_ids.get(DATA_STYLE))
+        if kpi is not None:
+            xml=kpi_sheet_xml(kpi,style_ids)
+            rewrites[parts[KPI_SHEET]]=lambda fin,fout: fout.write(xml)
+        out=spooled_file()
+        src.seek(0)
+        with metrics.span("wb_save"):
+            copy_xlsx_parts(src,out,rewrites)
+        out.seek(0)
+        print(f"[INFO] Workbook re-escrito en streaming: {len(rewrites)} hoja(s) tocada(s) de {len(parts)}")
+        return out,new_keys,updates
+    finally:
+        src.close()
+
+def ingest_slack(sync_state, on_page=None):
+    """
+    Trae los mensajes nuevos de todos los canales y arma el DataFrame.
+    Ventana incremental: desde el último ts escrito (menos solape) hasta ahora,
+    cada canal con su propio high-water mark; con EDIT_TRACKING_DAYS se extiende
+    hacia atrás para re-leer los mensajes recientes (ediciones/borrados, hilos),
+    como mucho una vez cada EDIT_TRACKING_INTERVAL_SECONDS.
+    on_page: se pasa a fetch_channels (modo pipeline).
+    Retorna (registros, filas, EditWindow o None).
+    """
+    now_local = now_scl()
+    now = datetime.now(tz=timezone.utc).timestamp()
+    latest = str(now)
+    since = now - edit_tracking_days * 86400 if edits_due(sync_state, now) else None
+    windows = {}
+    append_from = {}
+    for ch in channel_ids:
+        oldest, window_desc = sync_window(sync_state, ch, now_local)
+        append_from[ch] = float(oldest)
+        if since is not None and since < float(oldest):
+            oldest = str(since)
+            window_desc += f"; re-lectura de ediciones desde {datetime.fromtimestamp(since, tz=SCL_TZ)}"
+        windows[ch] = (oldest, latest)
+        print(f"[INFO] Ventana Slack {ch}: {window_desc} hasta {now_local}")
+    refresh_origin_members()
+    recs = fetch_channels(windows, on_page)
+    apply_bot_origins(recs)
+    if fetch_replies:
+        enrich_with_replies(recs)
+    print(f"[INFO] Mensajes obtenidos: {len(recs)}")
+    rows = build_rows(recs)
+    edits = edit_window(recs, rows, since, latest)
+    if since is not None:
+        # Solo se agregan los mensajes de la ventana incremental; los anteriores son para ediciones
+        rows = [r for r in rows if float(r[KEY_INDEX].split(":", 1)[1]) > append_from.get(r[KEY_INDEX].split(":", 1)[0], 0.0)]
+    return recs, rows, edits
+
+def write_rows(token, meta, rows, index=None, prefetch=None, warm=None, edits=None):
+    """
+    Escribe las filas en el workbook (cada una en su hoja de mes) con una sola subida.
+    Backend "file": descarga, agrega y sube condicionado al eTag, re-aplicando ante conflicto;
+    con workbooks grandes (WORKBOOK_STREAMING) re-escribe solo las hojas tocadas, en streaming.
+    prefetch: Future con el workbook ya abierto (modo pipeline); warm: WarmState del daemon;
+    edits: EditWindow con ediciones/borrados a reflejar en filas ya escritas.
+    Retorna True si quedó escrito.
+    """
+    if write_backend=="workbook_api":
+        # Append server-side: sin descarga/subida del xlsx completo
+        try:
+            append_rows_api(token,rows,index,edits)
+            upload_success = True
+        except Exception as e:
+            print(f"[ERROR] Error agregando filas vía workbook API: {e}")
+            upload_success = False
+    else:
+        conflicts=0
+        while True:
+            wb=None
+            out=None
+            if prefetch is None and streaming_for(meta):
+                try:
+                    out,new_keys,updates=write_rows_streaming(token,meta,rows,index,edits)
+                except StreamingFallback as e:
+                    if index is not None:
+                        index.rollback()
+                    print(f"[INFO] Modo streaming no aplicable en este run ({e}); se usa el modo completo")
+            if out is None:
+                if prefetch is not None:
+                    try:
+                        wb=prefetch.result()
+                    except Exception as e:
+                        print(f"[ERROR] Pipeline: falló la rama workbook: {e}")
+                        raise
+                    prefetch=None
+                else:
+                    wb=open_workbook(token,meta,warm)
+
+                if kpi_summary and index is not None and not index.kpi_seeded():
+                    seed_kpi(token,wb,index)
+                new_keys=append_rows(wb,rows,index)
+                updates=apply_row_updates(wb,edits,index)
+                # Después del append: filas de meses cerrados (backfill, mensajes tardíos) salen en este mismo run
+                rotate_closed_months(token,wb,index)
+                write_kpi_sheet(wb,index)
+
+                out=io.BytesIO()
+                with metrics.span("wb_save"):
+                    wb.save(out)
+                out.seek(0)
+            if rows:
+                print(f"[INFO] Datos procesados en hojas: {', '.join(h for h,_ in group_by_month(rows))}")
+
+            # Subir condicionado al eTag descargado; si alguien escribió entre medio, re-aplicar sobre la versión nueva
+            try:
+                upload_success = up_excel(token,out,(meta or {}).get("eTag"))
+                if upload_success:
+                    # Contadas aquí (no en append_rows): un re-intento por conflicto re-aplica las mismas filas
+                    metrics.inc("rows_added",len(new_keys))
+                    count_row_updates(updates)
+                    if warm is not None and wb is not None:
+                        warm.keep_workbook(wb,last_uploaded_item)
+                break
+            except UploadConflict as e:
+                if index is not None:
+                    index.rollback()
+                conflicts+=1
+                metrics.inc("upload_conflicts")
+                if conflicts>upload_conflict_attempts:
+                    # Sin respaldo local: las filas quedan pendientes (índice revertido, high-water mark sin avanzar)
+                    print(f"[ERROR] Conflicto persistente al subir (status {e.status}) tras {upload_conflict_attempts} reintentos; se re-aplica en el próximo run")
+                    upload_success = False
+                    break
+                delay=conflict_delay(conflicts-1)
+                print(f"[WARN] Conflicto al subir (status {e.status}); re-aplicando {len(new_keys)} filas nuevas en {delay:.1f}s (intento {conflicts}/{upload_conflict_attempts})")
+                time.sleep(delay)
+                # Solo las filas que eran nuevas; el resto ya estaba en el workbook
+                keep=set(new_keys)
+                rows=[r for r in rows if r[KEY_INDEX] in keep]
+                meta=ensure_file(token)
 
-    out=io.BytesIO()
-    wb.save(out)
-    out.seek(0)
-    
-    # Intentar subir a OneDrive
-    upload_success = up_excel(token,out)
     if upload_success:
         print(f"[INFO] Excel actualizado en OneDrive: {onedrive_file_path}")
+        if index is not None:
+            index.commit()
     else:
+        # Las filas no llegaron al workbook: no registrarlas como existentes
+        if index is not None:
+            index.rollback()
         print(f"[WARN] No se pudo actualizar OneDrive, pero el procesamiento se completó exitosamente")
+    return upload_success
+
+@instrumented("sync")
+def main(warm=None):
+    """
+    Una ejecución de sync. warm: WarmState que el modo daemon mantiene entre ciclos.
+    Retorna True/False según quedó escrito el workbook, o None si no había nada que escribir.
+    """
+    load_config()
+    print(f"[INFO] Inicio ejecución: {now_scl()}")
+    token=acquire_token()
+    print("[INFO] Access token obtenido")
+
+    meta=ensure_file(token)
+
+    # Ejecutar siempre, sin restricción de hora
+    print(f"[INFO] Ejecutando sin restricción de hora (debug_mode: {debug_mode})")
+
+    sync_state = load_sync_state()
+    # En modo pipeline la descarga + parseo del workbook corre mientras se consulta Slack, pero solo
+    # desde la primera página con un mensaje posterior al high-water mark: un run sin mensajes
+    # nuevos no descarga el workbook (ni descarta el que el daemon tiene en memoria).
+    prefetch = None
+    executor = None
+    prefetch_lock = threading.Lock()
+
+    def start_prefetch(page):
+        nonlocal prefetch, executor
+        with prefetch_lock:
+            if prefetch is not None or not any(r.user and past_high_water(sync_state, f"{r.channel}:{r.ts}") for r in page):
+                return
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="workbook")
+            prefetch = executor.submit(open_workbook, token, meta, warm)
+        print("[INFO] Pipeline: mensajes nuevos en Slack, descarga del workbook en paralelo")
 
+    pipeline = pipelined and write_backend!="workbook_api" and not streaming_for(meta)
+    try:
+        recs, rows, edits = ingest_slack(sync_state, start_prefetch if pipeline else None)
+    except Exception as e:
+        if prefetch is not None:
+            print(f"[ERROR] Pipeline: falló la rama Slack: {e}")
+            if prefetch.done() and prefetch.exception() is not None:
+                print(f"[ERROR] Pipeline: también falló la rama workbook: {prefetch.exception()}")
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    if warm is None:
+        index=open_dedup_index()
+    else:
+        if warm.index is None:
+            warm.index=open_dedup_index()
+        index=warm.index
+
+    fetched=len(rows)
+    rows=pending_rows(rows, index, sync_state)
+    if fetched>len(rows):
+        print(f"[INFO] Filas ya escritas en runs anteriores (solape): {fetched-len(rows)}")
+        metrics.inc("duplicates_skipped",fetched-len(rows))
+    if not rows and (edits is None or index is None or not plan_row_updates(index, edits, edits.sheets)):
+        # Nada que escribir: igual avanzamos el high-water mark (p.ej. mensajes sin usuario)
+        advance_sync_state(sync_state, recs, edits)
+        if prefetch is not None and warm is not None:
+            # Workbook sin modificar: sigue correspondiendo a la versión remota
+            try:
+                warm.keep_workbook(prefetch.result(), meta)
+            except Exception as e:
+                print(f"[WARN] Pipeline: falló la rama workbook: {e}")
+        print("[INFO] No hay mensajes nuevos")
+        return None  # status "no_rows" en las métricas
+    print(f"[INFO] Filas a agregar: {len(rows)}")
+    print("[DEBUG] Preview:\n", "\n".join(" | ".join(str(v) for v in r[:3]) for r in rows[:5]))
+
+    upload_success=write_rows(token,meta,rows,index,prefetch,warm,edits)
+    if upload_success:
+        # Solo avanzamos el high-water mark cuando el workbook quedó escrito
+        advance_sync_state(sync_state, recs, edits)
+
+    print(f"[INFO] HTTP status: {metrics.http_summary()}")
     print(f"[INFO] Fin ejecución: {now_scl()}")
+    return upload_success
+
+def parse_local_date(value):
+    """'YYYY-MM-DD' (hora Chile) -> datetime a las 00:00 en America/Santiago."""
+    try:
+        return datetime.strptime(value.strip(),"%Y-%m-%d").replace(tzinfo=SCL_TZ)
+    except ValueError:
+        raise RuntimeError(f"Fecha inválida '{value}' (formato esperado YYYY-MM-DD)")
+
+def month_start(dt, months=0):
+    """00:00 del día 1 del mes de dt (hora local), corrido `months` meses."""
+    y,m=divmod(dt.year*12+dt.month-1+months,12)
+    return datetime(y,m+1,1,tzinfo=dt.tzinfo)
+
+def backfill_slices(start_local, end_local):
+    """
+    Divide [start, end) en tramos de BACKFILL_SLICE_DAYS días, cortados también al inicio de cada
+    mes (cada tramo cae en un solo mes): {"YYYY-MM": [(oldest, latest), ...]} en epoch, por mes en orden.
+    """
+    months={}
+    cur=start_local
+    while cur<end_local:
+        nxt=min(cur+timedelta(days=backfill_slice_days),month_start(cur,1),end_local)
+        months.setdefault(cur.strftime("%Y-%m"),[]).append((cur.timestamp(),nxt.timestamp()))
+        cur=nxt
+    return months
+
+def load_backfill_checkpoint(header):
+    """
+    Estado de un backfill interrumpido: ({slice_key: [MessageRecord]} de tramos descargados
+    de meses aún no escritos, {meses "YYYY-MM" ya escritos}). El checkpoint es JSONL (cabecera +
+    una línea por tramo o por mes escrito); si la cabecera no coincide con el backfill pedido,
+    se ignora y se empieza de cero.
+    """
+    done={}
+    written=set()
+    try:
+        if not os.path.exists(backfill_checkpoint_path):
+            return done, written
+        with open(backfill_checkpoint_path,"r",encoding="utf-8") as f:
+            first=f.readline()
+            if not first or json.loads(first)!=header:
+                print(f"[WARN] Checkpoint de backfill de otro rango en {backfill_checkpoint_path}; se descarta")
+                return {}, set()
+            for line in f:
+                try:
+                    entry=json.loads(line)
+                except ValueError:
+                    break  # última línea a medio escribir (corte abrupto)
+                if "written" in entry:
+                    written.add(entry["written"])
+                else:
+                    done[entry["slice"]]=[MessageRecord(*vals) for vals in entry["records"]]
+    except Exception as e:
+        print(f"[WARN] No se pudo leer checkpoint de backfill {backfill_checkpoint_path}: {e}")
+        return {}, set()
+    return done, written
+
+class BackfillCheckpoint:
+    """
+    Append-only: cada tramo terminado se agrega como una línea y se hace fsync. Al escribir un mes
+    se re-escribe sin los registros de ese mes, así el archivo solo guarda lo aún no escrito.
+    """
+
+    def __init__(self, header, done, written):
+        self.lock=threading.Lock()
+        self.header=header
+        self.written=set(written)
+        d=os.path.dirname(backfill_checkpoint_path)
+        if d:
+            os.makedirs(d,exist_ok=True)
+        self.f=None
+        self.rewrite(done)
+
+    @staticmethod
+    def slice_line(key, recs):
+        return json.dumps({"slice":key,"records":[[getattr(r,a) for a in MessageRecord.__slots__] for r in recs]})
+
+    def rewrite(self, done):
+        """Cabecera + meses escritos + tramos pendientes (descarta también una posible línea truncada)."""
+        if self.f is not None:
+            self.f.close()
+        lines=[json.dumps(self.header)]+[json.dumps({"written":m}) for m in sorted(self.written)]
+        lines+=[self.slice_line(k,recs) for k,recs in done.items()]
+        atomic_write(backfill_checkpoint_path,"\n".join(lines)+"\n")
+        self.f=open(backfill_checkpoint_path,"a",encoding="utf-8")
+
+    def add(self, key, recs):
+        line=self.slice_line(key,recs)
+        with self.lock:
+            self.f.write(line+"\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def month_written(self, month, done):
+        self.written.add(month)
+        self.rewrite(done)
+
+    def close(self):
+        self.f.close()
+
+def check_backfill_months(months, now_local):
+    """
+    Las hojas son por nombre de mes: rechaza rangos que escribirían dos años en la misma hoja.
+    Un nombre repetido en el rango solo funciona si la rotación archiva el primero antes de llegar
+    al segundo (backend file), y nunca un mes con el nombre de la hoja abierta de otro año.
+    """
+    names={}
+    for month in months:
+        names.setdefault(MONTH_NAMES[int(month[5:7])-1],[]).append(month)
+    for hoja,got in names.items():
+        if len(got)>1 and (not archive_rotation or write_backend=="workbook_api"):
+            raise RuntimeError(f"Rango de backfill con '{hoja}' de dos años ({', '.join(got)}) y sin rotación de meses: "
+                               f"dividirlo en rangos de hasta 12 meses")
+        if open_month(hoja,now_local):
+            month=MONTH_NAMES.index(hoja)+1
+            current=f"{now_local.year if month<=now_local.month else now_local.year-1}-{month:02d}"  # como open_month
+            other=[m for m in got if m!=current]
+            if other:
+                raise RuntimeError(f"Backfill de {', '.join(other)}: la hoja '{hoja}' es la de {current}, que sigue abierta; "
+                                   f"empezar el backfill en el mes siguiente o esperar a que se archive")
+
+@instrumented("backfill")
+def backfill(date_from, date_to):
+    """
+    Backfill histórico: trae [date_from, date_to] (fechas locales, ambas inclusive) de todos
+    los canales mes a mes, en tramos paralelos bajo el limitador de Slack, y escribe cada mes con
+    una subida apenas está completo: en memoria queda un mes de historial, no el rango entero.
+    Checkpoint por tramo y por mes escrito para reanudar.
+    """
+    load_config()
+    print(f"[INFO] Inicio backfill: {date_from} a {date_to} ({now_scl()})")
+    start_local=parse_local_date(date_from)
+    end_local=min(parse_local_date(date_to)+timedelta(days=1),now_scl())
+    if start_local>=end_local:
+        raise RuntimeError(f"Rango de backfill vacío: {date_from} a {date_to}")
+    months=backfill_slices(start_local,end_local)
+    check_backfill_months(months, now_scl())
+    header={"from":date_from,"to":date_to,"channels":channel_ids,"slice_days":backfill_slice_days,"batch":"month"}
+    done,written=load_backfill_checkpoint(header)
+    pending=[m for m in months if m not in written]
+    print(f"[INFO] Backfill: {len(channel_ids)} canal(es) x {sum(len(s) for s in months.values())} tramos de hasta {backfill_slice_days} día(s) "
+          f"en {len(months)} mes(es); {len(written)} mes(es) ya escritos, {len(done)} tramos en checkpoint")
+
+    refresh_origin_members()
+    checkpoint=BackfillCheckpoint(header,done,written)
+    token=None
+    index=None
+    total=0
+    try:
+        for month in pending:
+            keys=[]
+            tasks=[]
+            for ch in channel_ids:
+                for oldest,latest in months[month]:
+                    key=f"{ch}:{oldest:.0f}"
+                    keys.append(key)
+                    if key not in done:
+                        # oldest/latest de Slack son exclusivos: oldest un microsegundo antes para incluir el borde
+                        tasks.append((key,ch,f"{oldest-0.000001:.6f}",f"{latest:.6f}"))
+            if tasks:
+                with metrics.span("slack_fetch"), ThreadPoolExecutor(max_workers=max(1,slack_fetch_workers)) as ex:
+                    futures={ex.submit(fetch_messages,oldest,latest,ch):key for key,ch,oldest,latest in tasks}
+                    for n,f in enumerate(as_completed(futures),1):
+                        key=futures[f]
+                        recs=f.result()
+                        checkpoint.add(key,recs)
+                        done[key]=recs
+                        print(f"[INFO] Backfill {month}: tramo {key} listo ({len(recs)} mensajes) [{n}/{len(tasks)}]")
+
+            recs=[r for key in keys for r in done[key]]
+            recs.sort(key=lambda r: float(r.ts or 0))
+            apply_bot_origins(recs)
+            if fetch_replies:
+                enrich_with_replies(recs)
+            rows=build_rows(recs)
+            print(f"[INFO] Backfill {month}: {len(recs)} mensajes, {len(rows)} filas")
+            del recs
+            if rows:
+                if token is None:
+                    token=acquire_token()
+                    index=open_dedup_index()
+                hoja=MONTH_NAMES[int(month[5:7])-1]
+                if index is not None and index.other_month_rows(hoja,month):
+                    # La rotación no sacó la hoja anterior con ese nombre (falló la subida del archivo, o hay filas abiertas)
+                    print(f"[ERROR] Backfill {month}: la hoja '{hoja}' del workbook activo tiene filas de otro año; "
+                          f"se detiene para no mezclarlas (re-ejecutar reanuda desde {backfill_checkpoint_path})")
+                    return False
+                # Metadata fresca en cada mes: la subida anterior cambió el eTag
+                ok=write_rows(token,ensure_file(token),rows,index)
+                if not ok:
+                    print(f"[WARN] Backfill {month} descargado pero no escrito; re-ejecutar reanuda desde {backfill_checkpoint_path}")
+                    return False
+                total+=len(rows)
+            for key in keys:
+                done.pop(key,None)
+            checkpoint.month_written(month,done)
+    finally:
+        checkpoint.close()
+
+    # Completo: el checkpoint ya no sirve. El high-water mark de la ejecución incremental no se toca
+    os.remove(backfill_checkpoint_path)
+    print(f"[INFO] Backfill: {total} filas escritas en {len(pending)} mes(es)")
+    print(f"[INFO] HTTP status: {metrics.http_summary()}")
+    print(f"[INFO] Fin backfill: {now_scl()}")
+    return True
+
+@instrumented("kpi_rebuild")
+def kpi_rebuild():
+    """
+    Recalcula los agregados KPI leyendo todo el historial (workbook activo + archivos),
+    informa las diferencias con los agregados incrementales y re-escribe la hoja resumen.
+    """
+    load_config()
+    if not kpi_summary:
+        raise RuntimeError("KPI_SUMMARY=0: la hoja resumen KPI está desactivada")
+    print(f"[INFO] Inicio reconstrucción KPI: {now_scl()}")
+    index=open_dedup_index()
+    if index is None:
+        raise RuntimeError("La hoja resumen KPI requiere el índice local (DEDUP_INDEX_PATH)")
+    token=acquire_token()
+    meta=ensure_file(token)
+    before=(index.kpi_daily(),index.kpi_estado()) if index.kpi_seeded() else None
+    daily,estado=seed_kpi(token,open_workbook(token,meta),index)
+    if before is not None:
+        diff=sorted(k for k in set(before[0])|set(daily) if before[0].get(k,0)!=daily.get(k,0))
+        diff_estado=sorted(k for k in set(before[1])|set(estado) if before[1].get(k,0)!=estado.get(k,0))
+        if diff or diff_estado:
+            print(f"[WARN] Agregados incrementales distintos del recálculo: {len(diff)} (día, origen), {len(diff_estado)} estados archivados")
+            for d,o in diff[:10]:
+                print(f"[WARN]   {d} {o}: incremental {before[0].get((d,o),0)}, recalculado {daily.get((d,o),0)}")
+        else:
+            print("[INFO] Agregados incrementales coinciden con el recálculo completo")
+    ok=write_rows(token,meta,[],index)
+    print(f"[INFO] Fin reconstrucción KPI: {now_scl()}")
+    return ok
+
+def parse_cron_field(field, lo, hi):
+    """Un campo cron ('*', '*/5', '1-5', '0,30', '8-18/2') -> conjunto de valores."""
+    values=set()
+    for part in field.split(","):
+        rng,_,step=part.partition("/")
+        step=int(step) if step else 1
+        if rng=="*":
+            a,b=lo,hi
+        elif "-" in rng:
+            a,b=(int(x) for x in rng.split("-",1))
+        else:
+            a=int(rng)
+            b=hi if step>1 else a
+        if a<lo or b>hi or a>b or step<1:
+            raise RuntimeError(f"Campo cron fuera de rango: '{field}' ({lo}-{hi})")
+        values.update(range(a,b+1,step))
+    return values
+
+def parse_cron(expr):
+    """Expresión cron de 5 campos: minuto hora día-mes mes día-semana (0 o 7 = domingo)."""
+    fields=expr.split()
+    if len(fields)!=5:
+        raise RuntimeError(f"Expresión cron inválida '{expr}' (se esperan 5 campos)")
+    minutes=parse_cron_field(fields[0],0,59)
+    hours=parse_cron_field(fields[1],0,23)
+    days=parse_cron_field(fields[2],1,31)
+    months=parse_cron_field(fields[3],1,12)
+    weekdays={d%7 for d in parse_cron_field(fields[4],0,7)}
+    # Como cron: si día-mes y día-semana están restringidos, basta con que coincida uno
+    day_any=fields[2]=="*"
+    weekday_any=fields[4]=="*"
+    return minutes,hours,days,months,weekdays,day_any,weekday_any
+
+def next_cron_time(cron, after):
+    """
+    Próximo instante (estrictamente posterior a after, hora local de after) que cumple la expresión.
+    Los campos se comparan en hora local; una hora que no existe por el cambio de horario (p.ej. 00:30
+    el día que se adelanta el reloj) se corre al instante real siguiente, como hace cron.
+    """
+    minutes,hours,days,months,weekdays,day_any,weekday_any=cron
+    t=after.replace(second=0,microsecond=0)+timedelta(minutes=1)
+    limit=t+timedelta(days=366*4)
+    while t<limit:
+        day_ok=t.day in days
+        weekday_ok=(t.isoweekday()%7) in weekdays
+        if day_any or weekday_any:
+            day_match=day_ok and weekday_ok
+        else:
+            day_match=day_ok or weekday_ok
+        if t.month not in months or not day_match:
+            t=(t+timedelta(days=1)).replace(hour=0,minute=0)
+        elif t.hour not in hours:
+            t=(t+timedelta(hours=1)).replace(minute=0)
+        elif t.minute not in minutes:
+            t+=timedelta(minutes=1)
+        else:
+            # Ida y vuelta por UTC: normaliza horas locales inexistentes
+            return t.astimezone(timezone.utc).astimezone(t.tzinfo)
+    raise RuntimeError("Expresión cron sin próximas ejecuciones")
+
+def seconds_until(when):
+    """Segundos hasta when (aware). Restar dos datetimes con el mismo tzinfo usa la hora local, no UTC."""
+    return (when.astimezone(timezone.utc)-datetime.now(timezone.utc)).total_seconds()
+
+def daemon(interval_seconds=None, cron_expr=None):
+    """
+    Proceso residente: ejecuta main() cada interval_seconds o según cron_expr (hora Chile),
+    manteniendo caliente token, sesiones HTTP, cliente Slack, índice y workbook parseado.
+    SIGTERM/SIGINT terminan el ciclo en curso y salen limpiamente.
+    """
+    load_config()
+    interval_seconds=daemon_interval_seconds if interval_seconds is None else interval_seconds
+    cron=parse_cron(cron_expr) if cron_expr else None
+    if cron is None and interval_seconds<=0:
+        raise RuntimeError("DAEMON_INTERVAL_SECONDS debe ser mayor que 0")
+    stop=threading.Event()
+
+    def on_signal(signum, frame):
+        print(f"[INFO] Señal {signal.Signals(signum).name} recibida: terminando después del ciclo en curso")
+        stop.set()
+
+    signal.signal(signal.SIGTERM,on_signal)
+    signal.signal(signal.SIGINT,on_signal)
+    schedule=f"cron '{cron_expr}'" if cron else f"cada {interval_seconds:.0f}s"
+    print(f"[INFO] Modo daemon: sync {schedule} (PID {os.getpid()})")
+
+    warm=WarmState()
+    cycles=0
+    try:
+        while not stop.is_set():
+            if cron is not None:
+                wait=seconds_until(next_cron_time(cron,now_scl()))
+                if stop.wait(max(wait,0)):
+                    break
+            started=time.monotonic()
+            cycles+=1
+            try:
+                main(warm)
+            except Exception as e:
+                # Un ciclo fallido no tumba el daemon: el siguiente reintenta con el mismo high-water mark
+                print(f"[ERROR] Ciclo {cycles} falló: {e}")
+                warm.wb=warm.wb_tag=None
+            if cron is None:
+                stop.wait(max(interval_seconds-(time.monotonic()-started),0))
+    finally:
+        warm.close()
+        finish_background_tasks()
+        print(f"[INFO] Daemon detenido tras {cycles} ciclo(s)")
+
+# Módulos pesados que se importan de forma diferida, y qué ejecuciones los necesitan
+LAZY_MODULES=[
+    ("msal","cache de tokens (todas)"),
+    ("slack_sdk","fetch Slack (todas)"),
+    ("openpyxl","WRITE_BACKEND=file"),
+    ("numpy","lotes > ROWS_VECTORIZE_THRESHOLD"),
+    ("pandas","lotes > ROWS_VECTORIZE_THRESHOLD"),
+]
+
+def timed_python(code, runs=3):
+    """Mejor tiempo (ms) de un proceso python nuevo ejecutando code."""
+    best=None
+    for _ in range(runs):
+        t0=time.perf_counter()
+        subprocess.run([sys.executable,"-c",code],check=True,cwd=os.path.dirname(os.path.abspath(__file__)))
+        ms=(time.perf_counter()-t0)*1000
+        best=ms if best is None else min(best,ms)
+    return best
+
+def startup_report():
+    """
+    Dónde se va el arranque: intérprete, import de app (sin config ni secretos), cada
+    módulo pesado diferido y los imports más caros de app según python -X importtime.
+    """
+    print("[INFO] Reporte de arranque (ms, mejor de 3 procesos nuevos)")
+    interp=timed_python("pass")
+    print(f"  {'intérprete (python -c pass)':<40} {interp:8.1f}")
+    print(f"  {'import app':<40} {timed_python('import app')-interp:8.1f}")
+    for mod,used_by in LAZY_MODULES:
+        ms=timed_python(f"import {mod}")-interp
+        print(f"  {'import '+mod+' (diferido)':<40} {ms:8.1f}   usado por: {used_by}")
+    # Detalle de python -X importtime para "import app": acumulado por módulo de primer nivel
+    r=subprocess.run([sys.executable,"-X","importtime","-c","import app"],capture_output=True,text=True,check=True,
+                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    top=[]
+    pending=[]
+    for line in r.stderr.splitlines():
+        parts=line.split("|")
+        if len(parts)!=3 or not parts[0].startswith("import time:") or not parts[1].strip().isdigit():
+            continue
+        name=parts[2][1:].rstrip()
+        depth=(len(name)-len(name.lstrip()))//2
+        # importtime lista los hijos antes que el padre: los de nivel 1 previos a "app" son sus imports directos
+        if depth==0:
+            if name=="app":
+                top=pending
+                break
+            pending=[]
+        elif depth==1:
+            pending.append((int(parts[1])/1000,name.strip()))
+    top.sort(reverse=True)
+    print("[INFO] Imports directos más caros de app (python -X importtime, acumulado, ms):")
+    for ms,name in top[:10]:
+        print(f"  {name:<40} {ms:8.1f}")
+
+def cli(argv=None):
+    parser=argparse.ArgumentParser(description="Slack -> Excel (OneDrive)")
+    sub=parser.add_subparsers(dest="command")
+    bf=sub.add_parser("backfill",help="Backfill histórico de un rango de fechas (hora Chile)")
+    bf.add_argument("--from",dest="date_from",required=True,metavar="YYYY-MM-DD")
+    bf.add_argument("--to",dest="date_to",required=True,metavar="YYYY-MM-DD")
+    sub.add_parser("kpi-rebuild",help="Recalcula desde cero los agregados de la hoja resumen KPI y la re-escribe")
+    parser.add_argument("--daemon",action="store_true",help="Proceso residente: sync periódico (DAEMON_INTERVAL_SECONDS o DAEMON_CRON)")
+    parser.add_argument("--interval",type=float,metavar="SEGUNDOS",help="Intervalo del modo daemon (reemplaza DAEMON_INTERVAL_SECONDS)")
+    parser.add_argument("--cron",metavar="EXPR",help="Expresión cron del modo daemon, hora Chile (reemplaza DAEMON_CRON)")
+    parser.add_argument("--profile",metavar="ARCHIVO",help="Perfil cProfile de una ejecución (sync o backfill) guardado en ARCHIVO")
+    parser.add_argument("--startup-report",action="store_true",help="Mide el costo de arranque (intérprete e imports) y sale")
+    args=parser.parse_args(argv)
+    if args.startup_report:
+        startup_report()
+        return
+    load_config()
+    if args.daemon:
+        if args.profile:
+            print("[WARN] --profile no aplica a --daemon; se ignora")
+        daemon(args.interval,args.cron or (None if args.interval else daemon_cron) or None)
+        return
+    profiler=None
+    if args.profile:
+        import cProfile
+        profiler=cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.command=="backfill":
+            ok=backfill(args.date_from,args.date_to)
+        elif args.command=="kpi-rebuild":
+            ok=kpi_rebuild()
+        else:
+            ok=main()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"[INFO] Perfil cProfile guardado en {args.profile} (ver con: python -m pstats {args.profile})")
+    if args.command in ("backfill","kpi-rebuild") and not ok:
+        sys.exit(1)
 
 if __name__=="__main__":
-    main()
+    cli()
@@ -0,0 +1,807 @@
+"""
+Benchmarks offline de app.py: historial Slack sintético, WebClient stub y un servidor local
+que imita los endpoints de drive de Graph (metadata, GET/PUT de contenido, sesiones de upload
+e inyección de 423/409), los de la Excel API que usa WRITE_BACKEND=workbook_api (sesiones,
+hojas, rangos y $batch) y el token endpoint de login (refresh_token -> access token). No usa red ni secretos; todo el estado vive en un directorio temporal.
+
+    python bench.py                          # e2e + micro 1k/10k/100k, compara con bench_baseline.json
+    python bench.py --sizes 1000,10000       # tamaños de los micro-benchmarks
+    python bench.py --inject 423,409         # las primeras subidas del e2e responden 423 y luego 409
+    python bench.py --modes file,stream      # solo esos escenarios del e2e (default: todos, ver E2E_MODES)
+    python bench.py --rotation 20000         # e2e con historial de un año: rotación de meses cerrados al archivo
+    python bench.py --repeat 1 --no-memory   # pasada rápida: una corrida por medición, sin tracemalloc
+    python bench.py --save-baseline          # guarda los resultados como nueva línea base
+
+El e2e mide también el pico de memoria de cada fase (spans de app.metrics) en una pasada aparte.
+Sale con código 1 si el total de algún run o un micro-benchmark es más lento que la línea base por sobre
+--tolerance; las fases de cada run se muestran como detalle (son muy cortas para un umbral relativo).
+La línea base depende de la máquina: cada equipo graba la suya (bench_baseline.json no se versiona)
+y una grabada en otro equipo solo se muestra, sin hacer fallar el run.
+No forma parte de la imagen (el Dockerfile copia solo app.py y get_refresh_token.py).
+"""
+import os, io, re, gc, sys, json, time, random, argparse, platform, tempfile, threading, tracemalloc, contextlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import app
+
+REAL_ACQUIRE_TOKEN=app.acquire_token  # configure() lo reemplaza; bench_token usa el real
+
+BASELINE_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)),"bench_baseline.json")
+CHANNEL="CBENCH"
+WORDS=("error","factura","cliente","pedido","stock","sistema","no","carga","reporte","ayuda","urgente",
+       "precio","despacho","bodega","usuario","clave","acceso","pago","boleta","nota")
+
+def user_ids(users=40, dev_ratio=0.3):
+    """(ids "dev" para DEV_TEAM_MEMBER_IDS, ids del resto de las áreas)."""
+    devs=[f"UDEV{i:03d}" for i in range(max(1,int(users*dev_ratio)))]
+    return devs, [f"UOTR{i:03d}" for i in range(max(1,users-len(devs)))]
+
+def synthetic_history(n, days=30, text_len=(20,400), dev_ratio=0.3, reply_ratio=0.2, users=40, seed=1, now=None):
+    """
+    n mensajes Slack (dicts como los de conversations.history, del más nuevo al más viejo)
+    repartidos en los últimos `days` días, con largo de texto y mezcla de usuarios configurables.
+    """
+    rnd=random.Random(seed)
+    now=now or time.time()
+    devs,others=user_ids(users,dev_ratio)
+    stamps=sorted({round(now-rnd.uniform(60,days*86400),6) for _ in range(n)})
+    while len(stamps)<n:  # colisiones de ts (improbables)
+        stamps=sorted(set(stamps)|{round(now-rnd.uniform(60,days*86400),6)})
+    msgs=[]
+    for ts in reversed(stamps):
+        size=rnd.randint(*text_len)
+        words=[]
+        while sum(len(w)+1 for w in words)<size:
+            words.append(rnd.choice(WORDS))
+        text=" ".join(words)
+        if rnd.random()<0.1:
+            text=f'"{text}"\n{rnd.choice(WORDS)}'  # comillas y saltos de línea: ejercita el escape
+        m={"ts":f"{ts:.6f}","text":text,"type":"message"}
+        if rnd.random()>0.02:  # algunos mensajes de sistema/bots sin usuario
+            m["user"]=rnd.choice(devs) if rnd.random()<dev_ratio else rnd.choice(others)
+        if rnd.random()<reply_ratio:
+            m["reply_count"]=rnd.randint(1,5)
+            m["latest_reply"]=f"{ts+rnd.uniform(60,3600):.6f}"
+        msgs.append(m)
+    return msgs
+
+class FakeWebClient:
+    """Stub de slack_sdk.WebClient sobre un historial en memoria, con paginación por cursor."""
+
+    def __init__(self, history):
+        self.history=history  # {channel: [mensajes del más nuevo al más viejo]}
+        self.calls=0
+
+    def conversations_history(self, channel, limit=100, cursor=None, oldest=None, latest=None, **kwargs):
+        self.calls+=1
+        lo=float(oldest or 0)
+        hi=float(latest or "inf")
+        msgs=[m for m in self.history.get(channel,[]) if lo<float(m["ts"])<hi]
+        start=int(cursor or 0)
+        page=msgs[start:start+limit]
+        nxt=str(start+limit) if start+limit<len(msgs) else ""
+        return {"ok":True,"messages":page,"has_more":bool(nxt),"response_metadata":{"next_cursor":nxt}}
+
+    def conversations_replies(self, channel, ts, limit=200, cursor=None, **kwargs):
+        self.calls+=1
+        return {"ok":True,"messages":[{"ts":ts,"user":"UPARENT"},{"ts":f"{float(ts)+120:.6f}","user":"UREPLY"}],
+                "response_metadata":{"next_cursor":""}}
+
+class FakeDrive:
+    """Archivos del drive falso (por ruta, p.ej. "/Documents/BlackBox.xlsx") y sus sesiones de upload."""
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.files={}  # ruta -> {"content": bytes, "version": n}; ausente: 404
+        self.inject=[]  # status a responder en las próximas escrituras (423/409)
+        self.sessions={}
+        self.drop_chunk=False  # cada sesión de upload responde 500 a su segundo chunk (una vez)
+        self.requests=0
+        self.token_requests=0
+        self.workbooks=FakeWorkbooks(self)
+
+    def meta(self, path):
+        f=self.files[path]
+        tag=f"{{BENCH-{path}}},{f['version']}"
+        return {"eTag":f'"{tag}"',"cTag":f'"c:{tag}"',"size":len(f["content"]),"webUrl":f"https://bench.invalid{path}"}
+
+    def write(self, path, content):
+        f=self.files.setdefault(path,{"content":b"","version":0})
+        f["content"]=content
+        f["version"]+=1
+        return self.meta(path)
+
+# Propiedades que Graph acepta en cada recurso de rango; el resto responde 400 como el servicio real
+RANGE_PROPS={"values","formulas","numberFormat","columnHidden","rowHidden"}
+FORMAT_PROPS={"columnWidth","rowHeight","horizontalAlignment","verticalAlignment","wrapText"}
+FONT_PROPS={"bold","italic","color","size","name"}
+FILL_PROPS={"color"}
+BORDER_PROPS={"style","color","weight"}
+WORKSHEET_RE=re.compile(r"^/worksheets\('([^']*)'\)(.*)$")
+RANGE_RE=re.compile(r"^/range\(address='([^']*)'\)(/.*)?$")
+
+class FakeWorkbooks:
+    """
+    Excel API mínima sobre los archivos del drive falso: la sesión parsea el xlsx con openpyxl
+    y closeSession lo guarda (nueva versión). Hojas, rangos (valores, fórmulas, formato) y
+    usedRange; valida propiedades y dimensiones como Graph para detectar llamadas inválidas.
+    """
+
+    def __init__(self, drive):
+        self.drive=drive
+        self.sessions={}  # id -> {"path", "wb", "dirty"}
+        self.opened=0
+
+    def call(self, method, path, suffix, body, session_id):
+        """(status, body) de method /workbook{suffix} sobre el archivo path."""
+        from openpyxl import load_workbook
+        suffix=suffix.split("?",1)[0]
+        if suffix=="/createSession":
+            if path not in self.drive.files:
+                return 404,{"error":{"code":"itemNotFound"}}
+            self.opened+=1
+            sid=f"bench-session-{self.opened}"
+            self.sessions[sid]={"path":path,"wb":load_workbook(io.BytesIO(self.drive.files[path]["content"])),"dirty":False}
+            return 201,{"id":sid,"persistChanges":True}
+        s=self.sessions.get(session_id)
+        if s is None:
+            return 404,{"error":{"code":"InvalidSessionId"}}
+        wb=s["wb"]
+        if suffix=="/closeSession":
+            del self.sessions[session_id]
+            if s["dirty"]:
+                out=io.BytesIO()
+                wb.save(out)
+                self.drive.write(path,out.getvalue())
+            return 204,None
+        if suffix=="/worksheets" and method=="GET":
+            return 200,{"value":[{"name":n} for n in wb.sheetnames]}
+        if suffix=="/worksheets/add" and method=="POST":
+            if body["name"] in wb.sheetnames:
+                return 409,{"error":{"code":"ItemAlreadyExists"}}
+            wb.create_sheet(title=body["name"])
+            s["dirty"]=True
+            return 201,{"name":body["name"]}
+        m=WORKSHEET_RE.match(suffix)
+        if m is None or m.group(1) not in wb.sheetnames:
+            return 404,{"error":{"code":"ItemNotFound"}}
+        ws=wb[m.group(1)]
+        rest=m.group(2)
+        if rest=="/usedRange(valuesOnly=true)" and method=="GET":
+            used=max((c.row for row in ws.iter_rows() for c in row if c.value is not None),default=1)
+            return 200,{"address":f"{ws.title}!A1:{app.KEY_COLUMN_LETTER}{used}","rowCount":used}
+        if rest=="/usedRange/clear" and method=="POST":
+            ws.delete_rows(1,ws.max_row)
+            s["dirty"]=True
+            return 200,{}
+        r=RANGE_RE.match(rest)
+        if r is None:
+            return 404,{"error":{"code":"ItemNotFound"}}
+        return self.range_call(s,ws,method,r.group(1),r.group(2) or "",body or {})
+
+    def range_call(self, s, ws, method, address, sub, body):
+        from openpyxl.utils.cell import range_boundaries, get_column_letter
+        min_col,min_row,max_col,max_row=range_boundaries(address)
+        if method=="GET" and not sub:
+            vals=[[c.value for c in row] for row in ws.iter_rows(min_row=min_row,max_row=max_row,min_col=min_col,max_col=max_col)]
+            return 200,{"address":address,"values":vals,"formulas":vals}
+        if method!="PATCH":
+            return 405,{"error":{"code":"MethodNotAllowed"}}
+        allowed={"":RANGE_PROPS,"/format":FORMAT_PROPS,"/format/font":FONT_PROPS,"/format/fill":FILL_PROPS}.get(sub)
+        if allowed is None and sub.startswith("/format/borders("):
+            allowed=BORDER_PROPS
+        if allowed is None:
+            return 404,{"error":{"code":"ItemNotFound"}}
+        unknown=set(body)-allowed
+        if unknown:
+            return 400,{"error":{"code":"InvalidArgument","message":f"propiedades inválidas para {sub or '/range'}: {sorted(unknown)}"}}
+        s["dirty"]=True
+        columns=[get_column_letter(c) for c in range(min_col,max_col+1)]
+        if "columnHidden" in body:
+            for col in columns:
+                ws.column_dimensions[col].hidden=bool(body["columnHidden"])
+        if "columnWidth" in body and min_row is None:
+            for col in columns:
+                ws.column_dimensions[col].width=body["columnWidth"]/5.25
+        for prop in ("values","formulas","numberFormat"):
+            if prop not in body:
+                continue
+            grid=body[prop]
+            if min_row is None or len(grid)!=max_row-min_row+1 or any(len(row)!=len(columns) for row in grid):
+                return 400,{"error":{"code":"InvalidArgument","message":f"{prop}: dimensiones distintas a {address}"}}
+            for i,row in enumerate(grid):
+                for j,v in enumerate(row):
+                    c=ws.cell(row=min_row+i,column=min_col+j)
+                    if prop=="numberFormat":
+                        c.number_format=v
+                    else:
+                        c.value=v
+        return 200,{"address":address}
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+    drive=None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=b"", ctype="application/json"):
+        if body is None:
+            body=b""
+        elif isinstance(body,dict):
+            body=json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type",ctype)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def workbook(self, method, data=b""):
+        """Atiende /…/drive/root:<ruta>:/workbook… y /$batch; False si la URL es de otro recurso."""
+        d=self.drive
+        if self.path.split("?",1)[0]=="/$batch":
+            # Como Graph, sin orden garantizado: cada request corre después de sus dependsOn (424 si alguna
+            # falló) y las independientes en orden inverso, para que un lote sin encadenar se note
+            pending=list(reversed(json.loads(data or b"{}").get("requests",[])))
+            statuses={}
+            responses=[]
+            while pending:
+                req=next((r for r in pending if all(dep in statuses for dep in r.get("dependsOn") or ())),pending[0])
+                pending.remove(req)
+                if any(statuses.get(dep,424)>=400 for dep in req.get("dependsOn") or ()):
+                    status,body=424,{"error":{"code":"failedDependency"}}
+                else:
+                    path,suffix=unquote(req["url"].split("/drive/root:",1)[-1]).split(":/workbook",1)
+                    status,body=d.workbooks.call(req["method"],path,suffix,req.get("body"),(req.get("headers") or {}).get("workbook-session-id"))
+                statuses[req["id"]]=status
+                responses.append({"id":req["id"],"status":status,"body":body})
+            self.send(200,{"responses":responses})
+            return True
+        path=unquote(self.path.split("/drive/root:",1)[-1])
+        if ":/workbook" not in path:
+            return False
+        path,suffix=path.split(":/workbook",1)
+        status,body=d.workbooks.call(method,path,suffix,json.loads(data) if data else None,self.headers.get("workbook-session-id"))
+        self.send(status,body)
+        return True
+
+    def item(self):
+        """(ruta del item, sufijo) de /users/<upn>/drive/root:<ruta>[:/content|:/createUploadSession]."""
+        path=unquote(self.path.split("/drive/root:",1)[-1])
+        for suffix in (":/content",":/createUploadSession"):
+            if path.endswith(suffix):
+                return path[:-len(suffix)], suffix
+        return path, ""
+
+    def injected(self, path):
+        """Consume el próximo status inyectado (423 bloqueado / 409 conflicto), si hay."""
+        d=self.drive
+        if d.inject and path in d.files:  # solo sobre un archivo ya existente (no al crearlo)
+            status=d.inject.pop(0)
+            self.send(status,{"error":{"code":"resourceLocked" if status==423 else "nameAlreadyExists"}})
+            return True
+        return False
+
+    def precondition_failed(self, path):
+        im=self.headers.get("If-Match")
+        if im and (path not in self.drive.files or im!=self.drive.meta(path)["eTag"]):
+            self.send(412,{"error":{"code":"resourceModified"}})
+            return True
+        return False
+
+    def do_GET(self):
+        d=self.drive
+        with d.lock:
+            d.requests+=1
+            if self.path.startswith("/upload/"):
+                s=d.sessions.get(self.path)
+                return self.send(200,{"nextExpectedRanges":[f"{len(s['data'])}-"]}) if s else self.send(404)
+            if self.workbook("GET"):
+                return
+            path,suffix=self.item()
+            if path not in d.files:
+                return self.send(404,{"error":{"code":"itemNotFound"}})
+            if suffix==":/content":
+                return self.send(200,d.files[path]["content"],app.XLSX_CONTENT_TYPE)
+            return self.send(200,d.meta(path))
+
+    def do_POST(self):
+        d=self.drive
+        with d.lock:
+            d.requests+=1
+            data=self.body()
+            if self.path.endswith("/oauth2/v2.0/token"):
+                # Como login.microsoftonline.com: scopes con el prefijo del recurso Graph
+                d.token_requests+=1
+                return self.send(200,{"token_type":"Bearer","expires_in":3600,"access_token":f"bench-at-{d.token_requests}",
+                                      "refresh_token":"bench-rt","scope":"https://graph.microsoft.com/Files.ReadWrite https://graph.microsoft.com/User.Read"})
+            if self.workbook("POST",data):
+                return
+            path,suffix=self.item()
+            if suffix!=":/createUploadSession":
+                return self.send(404)
+            if self.injected(path) or self.precondition_failed(path):
+                return
+            sid=f"/upload/{len(d.sessions)+1}"
+            d.sessions[sid]={"path":path,"data":bytearray()}
+            host,port=self.server.server_address[:2]
+            return self.send(200,{"uploadUrl":f"http://{host}:{port}{sid}"})
+
+    def do_PATCH(self):
+        d=self.drive
+        data=self.body()
+        with d.lock:
+            d.requests+=1
+            if not self.workbook("PATCH",data):
+                self.send(404)
+
+    def do_PUT(self):
+        d=self.drive
+        data=self.body()
+        with d.lock:
+            d.requests+=1
+            if self.path.startswith("/upload/"):
+                s=d.sessions.get(self.path)
+                if s is None:
+                    return self.send(404)
+                rng,total=self.headers["Content-Range"].split(" ")[1].split("/")
+                if int(rng.split("-")[0])!=len(s["data"]):
+                    return self.send(416)
+                if d.drop_chunk and s["data"] and not s.get("dropped"):
+                    s["dropped"]=True  # el cliente debe consultar la sesión y retomar desde lo aceptado
+                    return self.send(500,{"error":{"code":"generalException"}})
+                s["data"]+=data
+                if len(s["data"])<int(total):
+                    return self.send(202,{"nextExpectedRanges":[f"{len(s['data'])}-"]})
+                del d.sessions[self.path]
+                return self.send(201,d.write(s["path"],bytes(s["data"])))
+            path,suffix=self.item()
+            if suffix!=":/content":
+                return self.send(404)
+            if self.injected(path) or self.precondition_failed(path):
+                return
+            return self.send(200,d.write(path,data))
+
+def start_fake_graph():
+    drive=FakeDrive()
+    handler=type("Handler",(FakeGraphHandler,),{"drive":drive})
+    srv=ThreadingHTTPServer(("127.0.0.1",0),handler)
+    threading.Thread(target=srv.serve_forever,name="fake-graph",daemon=True).start()
+    return srv, drive
+
+def configure(workdir, graph_url):
+    """Config de app apuntando solo a recursos locales (nunca a Slack/Graph reales)."""
+    os.environ.update({
+        "SLACK_BOT_TOKEN":"xoxb-bench",
+        "SLACK_CHANNEL_ID":CHANNEL,
+        "AZURE_CLIENT_ID":"bench",
+        "ONEDRIVE_UPN":"bench@example.com",
+        "GRAPH_BASE_URL":graph_url,
+        "AZURE_LOGIN_URL":graph_url,
+        "REFRESH_TOKEN_PATH":os.path.join(workdir,"graph_refresh_token"),
+        "DEV_TEAM_MEMBER_IDS":",".join(user_ids()[0]),
+        "HTTP_BACKOFF_SECONDS":"0.01",
+        "UPLOAD_CONFLICT_BACKOFF_SECONDS":"0.01",
+        "WRITE_BACKEND":"file",
+        "PIPELINED":"0",
+    })
+    for k in ("METRICS_JSONL_PATH","METRICS_PROM_PATH","SYNC_STATE_PATH","DEDUP_INDEX_PATH","TOKEN_CACHE_PATH",
+              "WORKBOOK_CACHE_PATH","REPLIES_CACHE_PATH","BACKFILL_CHECKPOINT_PATH"):
+        os.environ.pop(k,None)
+    app.load_config()
+    # Imports diferidos de app fuera de las mediciones (el arranque se mide con app.py --startup-report)
+    import openpyxl.styles, pandas
+    app.acquire_token=lambda *args, **kwargs: "bench-token"
+
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+        return
+    with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def measure(results, name, fn, memory=True):
+    """
+    Una corrida de fn (se conserva el mejor tiempo entre llamadas) y, si memory, una más bajo
+    tracemalloc (pico de memoria).
+    """
+    gc.collect()
+    t0=time.perf_counter()
+    out=fn()
+    keep_best(results,name,time.perf_counter()-t0)
+    if memory:
+        tracemalloc.start()
+        fn()
+        results[name]["peak_mb"]=round(tracemalloc.get_traced_memory()[1]/2**20,2)
+        tracemalloc.stop()
+    return out
+
+def keep_best(results, name, seconds):
+    prev=results.get(name)
+    if prev is None:
+        results[name]={"seconds":round(seconds,4),"peak_mb":None}
+    elif seconds<prev["seconds"]:
+        prev["seconds"]=round(seconds,4)
+
+def check_workbook(drive, rows_added):
+    """Filas de datos y columna de claves oculta en el xlsx del drive falso (tras el e2e)."""
+    from openpyxl import load_workbook
+    wb=load_workbook(io.BytesIO(drive.files[app.onedrive_file_path]["content"]))
+    months=[wb[h] for h in wb.sheetnames if h in app.MONTH_NAMES]
+    rows=sum(ws.max_row-1 for ws in months)
+    hidden=all(ws.column_dimensions[app.KEY_COLUMN_LETTER].hidden for ws in months)
+    if rows!=rows_added or not hidden:
+        raise RuntimeError(f"workbook del e2e inconsistente: {rows} filas (esperadas {rows_added}), columna de claves oculta: {hidden}")
+
+class PhaseMemory:
+    """
+    Pico de memoria (tracemalloc) de cada span de app.metrics, medido sobre lo asignado al entrar
+    a la fase; lo de una fase anidada cuenta también para la externa. Solo spans del hilo principal
+    (los hilos de réplicas/prefetch no anidan con él). tracemalloc distorsiona los tiempos:
+    usar en una pasada aparte de la que se cronometra.
+    """
+
+    def __init__(self):
+        self.thread=threading.current_thread()
+        self.stack=[]
+        self.peaks={}
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        current,peak=tracemalloc.get_traced_memory()
+        if self.stack:  # reset_peak borra el pico en curso: se lo traspasa a la fase externa
+            self.stack[-1][1]=max(self.stack[-1][1],peak)
+        tracemalloc.reset_peak()
+        self.stack.append([current,0])
+        try:
+            yield
+        finally:
+            start,inner=self.stack.pop()
+            peak=max(inner,tracemalloc.get_traced_memory()[1])
+            if self.stack:
+                self.stack[-1][1]=max(self.stack[-1][1],peak)
+            self.peaks[name]=max(self.peaks.get(name,0),peak-start)
+
+    def __enter__(self):
+        original=app.metrics.span
+
+        @contextlib.contextmanager
+        def span(phase):
+            if threading.current_thread() is not self.thread:
+                with original(phase):
+                    yield
+                return
+            with self.measure(phase), original(phase):
+                yield
+
+        tracemalloc.start()
+        app.metrics.span=span  # atributo de instancia: metrics.timed lo resuelve en cada llamada
+        return self
+
+    def __exit__(self, *exc):
+        del app.metrics.span
+        tracemalloc.stop()
+
+    def take(self):
+        """{fase: MB} acumulado desde la última llamada."""
+        peaks,self.peaks=self.peaks,{}
+        return {name:round(v/2**20,2) for name,v in peaks.items()}
+
+# Escenarios del e2e: prefijo de las mediciones y globals de app que cambian respecto de configure()
+E2E_MODES={
+    "file":("e2e",{}),
+    "workbook_api":("e2e_api",{"write_backend":"workbook_api"}),
+    "stream":("e2e_stream",{"workbook_streaming":"1"}),
+    "pipelined":("e2e_pipelined",{"pipelined":True}),
+    "replies":("e2e_replies",{"fetch_replies":True}),
+    # Toda subida por sesión, en chunks chicos (el Graph falso no exige múltiplos de 320 KiB)
+    # y con un chunk rechazado por sesión: ejercita la reanudación
+    "session":("e2e_session",{"upload_session_threshold_bytes":0,"upload_chunk_bytes":32*1024}),
+}
+
+@contextlib.contextmanager
+def app_config(**values):
+    """Cambia globals de app durante el bloque y después restaura los anteriores."""
+    saved={k:getattr(app,k) for k in values}
+    for k,v in values.items():
+        setattr(app,k,v)
+    try:
+        yield
+    finally:
+        for k,v in saved.items():
+            setattr(app,k,v)
+
+def edit_history(history, size):
+    """Edita ~1% y borra ~0.5% de los mensajes del historial en memoria (run "edits")."""
+    rnd=random.Random(size+2)
+    picks=rnd.sample(range(len(history)),max(2,len(history)*3//200))
+    edited=picks[:len(picks)*2//3]
+    for i in edited:
+        m=dict(history[i])
+        m["text"]=f"{m['text']} (editado)"
+        m["edited"]={"user":m.get("user",""),"ts":f"{time.time():.6f}"}
+        history[i]=m
+    for i in sorted(picks[len(edited):],reverse=True):
+        del history[i]
+
+def bench_e2e(results, size, workdir, drive, inject, memory, verbose, attempt=0, mode="file"):
+    """
+    main() completo contra el Graph falso: run en frío (archivo inexistente), run incremental sobre el
+    mismo historial (todo duplicado: sale antes de abrir el workbook), run "fresh" con size/100 mensajes
+    nuevos (descarga, append y subida) y run "edits" con ediciones y borrados en Slack (re-lectura de la
+    ventana de ediciones). Las fases salen de app.metrics; results conserva el mejor tiempo entre llamadas
+    (attempt 0 imprime el resumen). Con memory, la pasada va bajo tracemalloc y solo registra el pico
+    por fase y total de cada run (peak_mb): tracemalloc distorsiona los tiempos.
+    mode: escenario de E2E_MODES (backend, streaming, pipeline, hilos o subida por sesión con reanudación).
+    """
+    prefix,overrides=E2E_MODES[mode]
+    # Historial de hasta hace una hora; los mensajes nuevos caen en la última media hora
+    base=synthetic_history(size,days=2,now=time.time()-3600)
+
+    def scenario(report, tracer=None):
+        # Desde cero: archivo remoto inexistente y sin estado local (sync state, índice, caches)
+        drive.files.clear()
+        drive.sessions.clear()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir,name))
+        history=list(base)
+        app._slack_client=FakeWebClient({CHANNEL:history})
+        for run in ("cold","incremental","fresh","edits"):
+            if run=="fresh":
+                history[:0]=synthetic_history(max(1,size//100),days=1800/86400,seed=size+1)
+            if run=="edits":
+                edit_history(history,size)
+            drive.inject=list(inject) if run=="cold" else []
+            requests_before=drive.requests
+            # Las ediciones se re-leen como mucho una vez por intervalo: en "edits" ya toca
+            interval=0 if run=="edits" else app.edit_tracking_interval_seconds
+            gc.collect()  # la basura de runs anteriores no se cobra en las fases de este
+            t0=time.perf_counter()
+            with quiet(verbose), app_config(edit_tracking_interval_seconds=interval), \
+                    (tracer.measure("total") if tracer else contextlib.nullcontext()):
+                app.main()
+            seconds=time.perf_counter()-t0
+            report(run,seconds,app.metrics.snapshot("sync","bench"),drive.requests-requests_before)
+
+    def timings():
+        def report(run, seconds, snap, requests):
+            keep_best(results,f"{prefix}.{size}.{run}.total",seconds)
+            for phase,v in snap["phases"].items():
+                keep_best(results,f"{prefix}.{size}.{run}.{phase}",v["seconds"])
+            c=snap["counters"]
+            if run=="cold":
+                check_workbook(drive,c.get("rows_added",0))
+                if mode=="session" and not c.get("upload_resumes"):
+                    raise RuntimeError(f"{prefix}: la subida no pasó por la reanudación de la sesión")
+            if run=="edits" and not (c.get("rows_updated") and c.get("rows_deleted")):
+                raise RuntimeError(f"{prefix}: run edits sin filas editadas/eliminadas ({c.get('rows_updated',0)}/{c.get('rows_deleted',0)})")
+            if attempt==0:
+                print(f"[INFO] {prefix} {run}: {seconds:.2f}s, filas {c.get('rows_added',0)}, duplicados {c.get('duplicates_skipped',0)}, "
+                      f"editadas {c.get('rows_updated',0)}, eliminadas {c.get('rows_deleted',0)}, conflictos {c.get('upload_conflicts',0)}, "
+                      f"reanudaciones {c.get('upload_resumes',0)}, bytes up {c.get('upload_bytes',0)}, requests Graph {requests}")
+        return report
+
+    drive.drop_chunk=mode=="session"
+    try:
+        with app_config(_slack_limiter=app.RateLimiter(10**9),**overrides):
+            if not memory:
+                scenario(timings())
+            else:
+                with PhaseMemory() as tracer:
+                    def report(run, seconds, snap, requests):
+                        for phase,mb in tracer.take().items():
+                            name=f"{prefix}.{size}.{run}.{phase}"
+                            if name not in results:  # fase que no apareció en las pasadas cronometradas
+                                keep_best(results,name,seconds if phase=="total" else snap["phases"][phase]["seconds"])
+                            results[name]["peak_mb"]=mb
+                    scenario(report,tracer)
+    finally:
+        drive.drop_chunk=False
+
+def bench_token(results, workdir, drive, verbose):
+    """
+    acquire_token real contra el token endpoint falso: el primer run canjea el refresh token y
+    el siguiente debe tomar el access token del cache MSAL persistido, sin request al endpoint.
+    """
+    if os.path.exists(app.token_cache_path):
+        os.remove(app.token_cache_path)
+    with open(app.refresh_token_path,"w",encoding="utf-8") as f:
+        f.write("bench-rt")
+    stub=app.acquire_token
+    app.acquire_token=REAL_ACQUIRE_TOKEN
+    try:
+        for run in ("refresh","cached"):
+            before=drive.token_requests
+            t0=time.perf_counter()
+            with quiet(verbose):
+                app.acquire_token()
+            seconds=time.perf_counter()-t0
+            results[f"token.{run}.total"]={"seconds":round(seconds,4),"peak_mb":None}
+            print(f"[INFO] token {run}: {seconds*1000:.1f}ms, requests al token endpoint {drive.token_requests-before}")
+        if drive.token_requests!=1:
+            raise RuntimeError(f"token: {drive.token_requests} requests al token endpoint; el segundo acquire_token no usó el cache")
+    finally:
+        app.acquire_token=stub
+
+def bench_rotation(results, size, workdir, drive, verbose):
+    """
+    Workbook activo con ~11 meses de historial (size filas) y un run incremental chico:
+    sin rotación, con rotación (archiva los meses cerrados) y el run siguiente, ya con el workbook chico.
+    """
+    from openpyxl.workbook import Workbook
+    recs=[app.MessageRecord.from_message(m,CHANNEL) for m in reversed(synthetic_history(size,days=330,seed=7))]
+    wb=Workbook()
+    with quiet(verbose):
+        app.append_rows(wb,app.build_rows(recs))
+    out=io.BytesIO()
+    wb.save(out)
+    seeded=out.getvalue()
+    app._slack_client=FakeWebClient({CHANNEL:synthetic_history(200,days=1,seed=8)})
+    app._slack_limiter=app.RateLimiter(10**9)
+    for rotation,runs in ((False,("off",)),(True,("rotating","after"))):
+        drive.files.clear()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir,name))
+        drive.write(app.onedrive_file_path,seeded)
+        app.archive_rotation=rotation
+        for run in runs:
+            t0=time.perf_counter()
+            with quiet(verbose):
+                app.main()
+            seconds=time.perf_counter()-t0
+            results[f"rotation.{size}.{run}.total"]={"seconds":round(seconds,4),"peak_mb":None}
+            hot=len(drive.files[app.onedrive_file_path]["content"])
+            archives=sorted(p for p in drive.files if p!=app.onedrive_file_path)
+            print(f"[INFO] rotación {run}: {seconds:.2f}s, workbook activo {hot/2**20:.2f} MiB, archivos: {', '.join(archives) or '-'}")
+    app.archive_rotation=True
+
+def bench_micro(results, size, memory, verbose, attempt=0):
+    """
+    build_rows (Python y pandas), append_rows, apply_table_style, wb.save y load_workbook con `size` filas.
+    Una corrida por llamada (attempt 0 imprime el resumen); results conserva el mejor tiempo.
+    """
+    from openpyxl import load_workbook
+    from openpyxl.workbook import Workbook
+    history=synthetic_history(size,days=28,seed=size)
+    recs=[app.MessageRecord.from_message(m,CHANNEL) for m in reversed(history)]
+    p=f"micro.{size}"
+    app.build_df(recs[:10])  # import de pandas fuera de la medición
+    measure(results,f"{p}.record_rows",lambda: app.record_rows(recs),memory)
+    measure(results,f"{p}.build_df",lambda: app.build_df(recs).values.tolist(),memory)
+    rows=app.build_rows(recs)
+
+    def append():
+        wb=Workbook()
+        with quiet(verbose):
+            app.append_rows(wb,rows)
+        return wb
+    wb=measure(results,f"{p}.append_rows",append,memory)
+    ws=max(wb.worksheets,key=lambda w: w.max_row)
+    measure(results,f"{p}.apply_table_style",lambda: app.apply_table_style(ws,ws.max_row),memory)
+
+    def save():
+        out=io.BytesIO()
+        wb.save(out)
+        return out.getvalue()
+    data=measure(results,f"{p}.wb_save",save,memory)
+    measure(results,f"{p}.load_workbook",lambda: load_workbook(io.BytesIO(data)),memory)
+    if attempt==0:
+        print(f"[INFO] micro {size}: {len(rows)} filas, xlsx {len(data)/2**20:.1f} MiB")
+
+def calibrate(rounds=5):
+    """
+    Segundos de una carga fija (workbook openpyxl de 2000 filas, append y save): mide la velocidad
+    del equipo en este momento. compare() escala la línea base por calibración actual / grabada,
+    así la carga de la VM que cambia entre corridas no se reporta como regresión.
+    """
+    from openpyxl.workbook import Workbook
+    best=None
+    for _ in range(rounds):
+        gc.collect()
+        t0=time.perf_counter()
+        wb=Workbook()
+        ws=wb.active
+        for i in range(2000):
+            ws.append([i,f"U{i:05d}",f"mensaje {i} "*8,i*0.5,"2026-01-01 00:00:00"])
+        wb.save(io.BytesIO())
+        elapsed=time.perf_counter()-t0
+        best=elapsed if best is None else min(best,elapsed)
+    return best
+
+def machine_id():
+    """Equipo en que se grabó la línea base: los tiempos absolutos solo se comparan en el mismo."""
+    return f"{platform.node()} {platform.machine()} {os.cpu_count()} cpus, python {sys.version.split()[0]}"
+
+def compare(results, baseline, tolerance, calibration):
+    """Tabla contra la línea base, escalada por la calibración de ambas corridas. Retorna la lista de regresiones."""
+    regressions=[]
+    scale=calibration/baseline["calibration"] if baseline.get("calibration") else 1.0
+    if scale!=1.0:
+        print(f"[INFO] Calibración {calibration:.4f}s (base {baseline['calibration']:.4f}s): línea base escalada x{scale:.2f}")
+    print(f"{'medición':<44} {'seg':>9} {'base':>9} {'delta':>8} {'pico MB':>9}")
+    for name,r in results.items():
+        b=(baseline.get("results") or {}).get(name)
+        base=round(b["seconds"]*scale,4) if b else None
+        delta=""
+        flag=""
+        if base:
+            change=(r["seconds"]-base)/base
+            delta=f"{change:+.0%}"
+            # Piso de ruido de 10 ms; las fases sueltas solo se muestran (su suma está en el total del run)
+            gated=name.endswith(".total") or name.startswith("micro.")
+            if gated and change>tolerance and r["seconds"]-base>0.01:
+                flag="  REGRESIÓN"
+                regressions.append(name)
+        peak="" if r["peak_mb"] is None else f"{r['peak_mb']:.1f}"
+        print(f"{name:<44} {r['seconds']:9.4f} {base if base is not None else '':>9} {delta:>8} {peak:>9}{flag}")
+    return regressions
+
+def main():
+    parser=argparse.ArgumentParser(description="Benchmarks offline de app.py")
+    parser.add_argument("--sizes",default="1000,10000,100000",help="Filas de los micro-benchmarks, separadas por coma")
+    parser.add_argument("--e2e-size",type=int,default=1000,help="Mensajes en el historial del e2e (0 = omitir)")
+    parser.add_argument("--modes",default=",".join(E2E_MODES),help="Escenarios del e2e, separados por coma: "+", ".join(E2E_MODES))
+    parser.add_argument("--rotation",type=int,default=0,metavar="FILAS",help="Bench de rotación con FILAS de historial previo (0 = omitir)")
+    parser.add_argument("--inject",default="",help="Status a inyectar en las primeras subidas del e2e, p.ej. 423,409")
+    parser.add_argument("--repeat",type=int,default=3,help="Corridas por medición, intercaladas entre escenarios; se reporta la mejor")
+    parser.add_argument("--no-memory",action="store_true",help="Sin medición de pico de memoria (tracemalloc)")
+    parser.add_argument("--baseline",default=BASELINE_PATH)
+    parser.add_argument("--save-baseline",action="store_true",help="Guarda los resultados como línea base")
+    parser.add_argument("--tolerance",type=float,default=0.25,help="Regresión si es más lento que la base por sobre esta fracción")
+    parser.add_argument("--verbose",action="store_true",help="Muestra los logs de app")
+    args=parser.parse_args()
+
+    results={}
+    memory=not args.no_memory
+    inject=[int(s) for s in args.inject.split(",") if s.strip()]
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        srv,drive=start_fake_graph()
+        try:
+            configure(workdir,f"http://127.0.0.1:{srv.server_port}")
+            calibration=calibrate()
+            bench_token(results,workdir,drive,args.verbose)
+            modes=[m.strip() for m in args.modes.split(",") if m.strip()] if args.e2e_size else []
+            sizes=[int(s) for s in args.sizes.split(",") if s.strip()]
+            # Repeticiones intercaladas: una ráfaga de carga del equipo no cae sobre todas las corridas de una medición
+            for attempt in range(args.repeat):
+                for mode in modes:
+                    bench_e2e(results,args.e2e_size,workdir,drive,inject,False,args.verbose,attempt,mode)
+                for size in sizes:
+                    bench_micro(results,size,memory and attempt==0,args.verbose,attempt)
+            if memory:
+                for mode in modes:
+                    bench_e2e(results,args.e2e_size,workdir,drive,inject,True,args.verbose,mode=mode)
+            if args.rotation:
+                bench_rotation(results,args.rotation,workdir,drive,args.verbose)
+            calibration=(calibration+calibrate())/2  # al inicio y al final: promedia la carga del equipo en el run
+        finally:
+            srv.shutdown()
+
+    baseline={}
+    if os.path.exists(args.baseline):
+        with open(args.baseline,"r",encoding="utf-8") as f:
+            baseline=json.load(f)
+    regressions=compare(results,baseline,args.tolerance,calibration)
+    if args.save_baseline:
+        with open(args.baseline,"w",encoding="utf-8") as f:
+            json.dump({"created":datetime.now(tz=timezone.utc).isoformat(timespec="seconds"),
+                       "machine":machine_id(),"calibration":round(calibration,4),"results":results},f,indent=2,sort_keys=True)
+            f.write("\n")
+        print(f"[INFO] Línea base guardada en {args.baseline}")
+    elif not baseline:
+        print(f"[INFO] Sin línea base en {args.baseline}: grabar la de este equipo con --save-baseline")
+    elif baseline.get("machine")!=machine_id():
+        print(f"[WARN] Línea base grabada en otro equipo ({baseline.get('machine') or 'desconocido'}): "
+              f"comparación solo informativa, regrabar con --save-baseline")
+    elif regressions:
+        print(f"[WARN] {len(regressions)} regresiones sobre la línea base (tolerancia {args.tolerance:.0%})")
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()